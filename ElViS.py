@@ -28,7 +28,7 @@ import datetime
 mpl.use('QT4Agg')
 #from pylab import Line2D
 import numpy as np
-import sys,os
+import sys,os,threading,time,socket
 from matplotlib.backend_bases import NavigationToolbar2, Event
 from matplotlib.backends.backend_qt4agg import(
     FigureCanvasQTAgg as FigureCanvas,
@@ -44,8 +44,16 @@ import amq2py as AMQ
 # util class for Open Street Map
 from osm import OSM as osm
 # UI modules
-from UIModules import zoomForm,messagesWidget,alertPanel,homeDialog,eventDialog
+from UIModules import zoomForm,messagesWidget,alertPanel,homeDialog,eventDialog,metricsPanel
 import alertmodule as ALRT
+# broker free replay of logs
+import replay as RPL
+import scenario as SCN
+import eventstore as ES
+import metrics as MTR
+import stations as STA
+import colormaps as CLR
+from collections import OrderedDict,deque
 
 # defaults - can be set similarly in a configuration file given as a commandline parameter
 FONTSIZE='8'
@@ -54,7 +62,7 @@ TRIGGERtopic='/topic/eew.alg.elarms.trigger.data' # trigger and trigger paramete
 ALARMStopic='/topic/eew.alg.elarms.data' # E2 alarms AMQ topic
 DMtopic='/topic/eew.sys.dm.data' # DM event AMQ topic
 EDATAtopic='/topic/eew.alg.elarms.event.data' # event raw data topic
-STATIONS_FILE = '/home/sysop/EEWS/run/bin/stations.cfg' # file with stations ([net] [sta] [lat] [lon])
+STATIONS_FILE = '/home/sysop/EEWS/run/bin/stations.cfg' # file with stations ([net] [sta] [lat] [lon]) or StationXML (.xml, needs obspy)
 HomeLat=31.7722064 # latitude of "home" location
 HomeLon=35.1958522 # longitude of "home" location
 HomeSize=6 # size of "home" marker
@@ -71,7 +79,42 @@ AMQDMUSER='decimod' # user of decision module
 AMQDMPASSWD='decimod' # password for decision module
 AMQHOST='localhost' # AMQ host
 AMQPORT=61613 # AMQ port
+AMQMAXMESSAGES=200 # number of recent messages kept in memory
+AMQMAXBYTES=0 # total size (bytes) of recent messages kept in memory. 0 for no limit
+AMQWORKERS=1 # number of message decoding threads. 0 to decode on the receiving thread. a lane (events, triggers, peaks) is decoded by one thread at a time, in order, so more than 3 don't help
+AMQQUEUESIZE=1000 # maximal number of messages waiting for decoding (per priority lane)
+AMQSHARDS={'alarms':{'topics':['alarms','dm']}, # topic groups with their own connection, receiver thread, buffers and workers
+           'triggers':{'topics':['trigger']}, # add 'hosts':[(host,port),...] to a shard for a failover list (default AMQHOST,AMQPORT)
+           'peaks':{'topics':['gmpeak','waveforms']}} # topics not listed use one default connection. {} for a single connection
+AMQOVERFLOW='drop-oldest' # what to do when the decoding queue is full [ drop-oldest | drop-newest | block ]
+AMQBATCH=16 # queued gmpeak messages a decoding worker takes at once. the decoding processes decode them together
+DECODEPROCESSES=2 # gmpeak decoding processes used at high message rates. 0 to always decode in this process
+DECODEPOOLRATE=200 # gmpeak messages per second above which decoding moves to the processes (off again below half)
+LOGFLUSHSIZE=65536 # bytes of pending log writes that trigger a flush
+LOGFLUSHINTERVAL=1.0 # maximal seconds between log flushes
+LOGFSYNC=False # sync log files to disk on every flush [True | False]
+LOGTRIGINDEX=True # write an index file next to the triggers log (see triglog.py) [True | False]
 watchingGMValue='amax' # station values to monitor
+COLORSCALES={'amax':{'colors':'acc','vmin':0.0,'vmax':98.1}, # station colors per watched value (see colormaps.py). acceleration [cm/s^2] up to 10% g
+             'vmax':{'colors':['blue','skyblue','cyan','green','yellow','gold','darkorange','red','maroon'], # velocity [cm/s] bands
+                     'bounds':[4e-4,8e-4,1.5e-3,4e-3,1.2e-2,3e-2,6e-2,1.5e-1]},
+             'dmax':{'colors':'acc','vmin':1e-9,'vmax':10.0,'log':True}} # displacement [cm], order of magnitude from a nanometer
+INVENTORYCACHE='cache' # directory of the parsed stations cache. '' to always parse the stations file
+INVENTORYCHECK=10 # seconds between checks of the stations file for changes (reloaded in place). 0 to disable
+HOVERRADIUS=8.0 # pixels around the mouse pointer where stations and events show their tooltip
+TRIGGERHIGHLIGHT=5.0 # seconds a triggered station stays highlighted
+STATIONTIMEOUT=60.0 # seconds without values after which a station is marked inactive
+PEAKSWINDOW=250 # milliseconds between station value updates. peaks arriving in between are coalesced per station
+PEAKSMODE='max' # how peaks are coalesced per station [ max | latest ]
+LATENCYWINDOW=10000 # latency samples kept per message type and stage (see Connection > Latency)
+LATENCYSTATIONWINDOW=500 # latency samples kept per station and stage
+METRICSPORT=0 # port of the local Prometheus metrics endpoint (http://METRICSHOST:METRICSPORT/metrics). 0 to disable
+METRICSHOST='127.0.0.1' # interface of the metrics endpoint. '' to accept remote scrapes
+DRAWWINDOW=1000 # canvas draw durations kept for the metrics
+EVENTSDB='log/events.db' # event history database (see eventstore.py). in memory when replaying or offline
+EVENTSKEEP=100 # events kept in memory and on the map. older events stay in the event history database
+EVENTSOLUTIONS=50 # solutions kept in memory and on the map per event
+EVENTSHISTORYHOURS=24 # hours of events listed by Event > History
 GRIDON=False # grid on or off [True | False]
 VERBOSE=False # printout message
 
@@ -99,6 +142,9 @@ parser = argparse.ArgumentParser(
 (ran.nof@gmail.com)''')
 parser.add_argument('cfgfile',nargs='?',default=None,help='Configuration file.',type=argparse.FileType('r'))
 parser.add_argument('--replay',default=False,action='store_true', help='Replay mode')
+parser.add_argument('--replay-logs',dest='replaylogs',nargs='+',default=None,metavar='LOG',help='Replay triggers (.trig) and events (.log) log files without an ActiveMQ server')
+parser.add_argument('--offline',default=False,action='store_true',help="Don't connect to the ActiveMQ server and don't write logs (testing)")
+parser.add_argument('--speed',default=1.0,type=float,help='Replay speed factor (%s-%s, 0 for as fast as possible)'%(RPL.MINSPEED,RPL.MAXSPEED))
 ##################### Some matplotlib Black Magic ##########################################################
 ## This part will redirect some matplotlib toolbar and canvas callbacks
 ## adjusting navigation bar for capturing after zoom/pan events
@@ -182,33 +228,59 @@ class AppForm(QMainWindow):
     self.osm = osm(self.ax,OSMTILEURL,OSMTILEPAT,OSMTILEARCHIVE) # add open street map generator
     splash.showMessage('Loading stations...',Qt.AlignCenter)
     QApplication.processEvents()
-    self.replay = args.replay # replay mode indicator
+    self.replay = args.replay or bool(args.replaylogs) # replay mode indicator
+    self.replayer = None # replays log files when running with --replay-logs
+    self.scenarioplayer = None # plays a scenario file to the AMQ server (Event > Play Scenario)
     self.timeshift = 0 # time shift will be determined by the first gm param packet
-    self.stations = []
+    self.stations = None # all station markers. see stations.StationMarkers
+    self.stationsfile = None # (path,size,mtime) of the loaded stations file
+    self.stationindex = STA.StationIndex() # station id -> station record (position in self.stations)
+    self.hover = STA.HoverIndex(HOVERRADIUS) # finds stations and events under the mouse pointer
+    self._hoverview = None # map view the hover index was built for
+    self._hoverstale = True # stations or events changed since the hover index was built
+    self.trigedlist = STA.Expiry(TRIGGERHIGHLIGHT) # triggered station records, highlighted until they expire
+    self.activeStationsList = STA.Expiry(STATIONTIMEOUT) # currently active station records, until no values arrive for a while
+    self.peaks = AMQ.PeakCoalescer(PEAKSMODE,self.stationindex) # ground motion peaks waiting for the next station values update
+    self.colorscales = CLR.colorscales(COLORSCALES) # station colors per watched value
     self.load_stations(STATIONS_FILE) # load stations
     self.set_home(lat=HomeLat,lon=HomeLon,label=HomeLabel,markersize=HomeSize,color=HomeColor,marker=HomeMarker) # set "home" location
     self.homeDialog = homeDialog(self.home._y[0],self.home._x[0],Label=HomeLabel,Markersize=HomeSize,Color=HomeColor,Marker=HomeMarker) # init and update home dialog
     self.eventDialog = eventDialog() # init an event dialog
     self.zoomform = zoomForm()
-    self.trigedlist = {} # A dictionary of triggered stations. will hold mpl lines
-    self.activeStationsList = {} # A dictionary of currently active stations. mpl lines
-    self.eventsList = {} # A dictionary of all events. holds event messages and parameters inc. updates
+    self.eventsList = OrderedDict() # A dictionary of recent events, oldest first. holds event messages and parameters inc. updates. bounded by EVENTSKEEP
+    self.eventsLock = threading.RLock() # eventsList is filled by the AMQ thread and trimmed by the GUI thread
     self.activeWarnings = {} # A dictionary of all current warnings running. mpl lines
+    self.latency = AMQ.LatencyMonitor(LATENCYWINDOW,LATENCYSTATIONWINDOW,source=not self.replay) # end to end latency. source stamps are meaningless when replaying
+    self.drawtimes = deque(maxlen=DRAWWINDOW) # recent canvas draw durations (seconds)
     self.lastEvent = None # a reference to the latest event
     self.sysmsg.add('System Start.',True) # start system message
     # adjusting AMQListner message processing functions replacing original with self functions
     splash.showMessage('Connecting to ActiveMQ server...',Qt.AlignCenter)
     QApplication.processEvents()
-    AMQ.AMQListener.processMessages = self.processAMQmsg # what to do with messages
     AMQ.AMQListener.on_connecting = self.on_connecting # what to do on connection
     AMQ.AMQListener.on_disconnected = self.on_disconnected # what to do on disconnection
-    self.amq = AMQ.AMQListener(usr=AMQUSER,passwd=AMQPASSWD,host_and_ports=[(AMQHOST,AMQPORT)],name='ActiveMQ',ID=1,log=True,verbose=VERBOSE) # create AMQ listener
-    self.connectToAMQ() # connect listener to server
-    self.subscribeToAMQ(topics) # subscribe listener to topics
+    self.decodepool = AMQ.GMPeakPool(DECODEPROCESSES,DECODEPOOLRATE) if DECODEPROCESSES else None # start decoding processes before any other thread
+    self.logwriter = AMQ.LogWriter(flushsize=LOGFLUSHSIZE,flushinterval=LOGFLUSHINTERVAL,fsync=LOGFSYNC) # writes logs in the background
+    self.amqshards = AMQ.ListenerShards(AMQSHARDS,'ActiveMQ',usr=AMQUSER,passwd=AMQPASSWD,host_and_ports=[(AMQHOST,AMQPORT)],ID=1,log=not (args.replaylogs or args.offline),verbose=VERBOSE,maxmessages=AMQMAXMESSAGES,maxbytes=AMQMAXBYTES,workers=AMQWORKERS,queuesize=AMQQUEUESIZE,overflow=AMQOVERFLOW,batch=AMQBATCH,logwriter=self.logwriter,trigindex=LOGTRIGINDEX,latency=self.latency,pool=self.decodepool) # create AMQ listeners, one per topic group
+    self.amqshards.processMessages = self.processAMQmsg # what to do with messages
+    self.amq = self.amqshards.listener() # default listener. replayed logs are fed to it
+    self.eventstore = ES.EventStore(EVENTSDB if self.amq.logit else ':memory:') # event history. written in the background
+    if args.replaylogs: # replay logs instead of listening to the server
+      self.start_replay(args.replaylogs,args.speed)
+    elif not args.offline:
+      self.connectToAMQ() # connect listener to server
+      self.subscribeToAMQ(topics) # subscribe listener to topics
     self.start_timers() # start QT Timers to process triggers, station values (colors) and EQ warnings.
     self.init_connections() # connect signals and functions
-    self.acmap = cm.acc # set colormap for accelerations
     self.chkconn() # check connection and update icons
+    self.metricsPanel = metricsPanel(self.metricstext,parent=self) # live metrics (Connection > Metrics)
+    self.metricsserver = None # serves the metrics to Prometheus
+    if METRICSPORT:
+      try:
+        self.metricsserver = MTR.MetricsServer(self.collectmetrics,METRICSHOST,METRICSPORT).start()
+        self.sysmsg.add('Serving metrics on http://%s:%d/metrics'%(METRICSHOST or socket.gethostname(),METRICSPORT),True)
+      except socket.error,msg:
+        self.errmsg.add("Can't serve metrics on port %d: %s"%(METRICSPORT,msg),True)
     splash.showMessage('Starting...',Qt.AlignCenter)
     QApplication.processEvents()
 
@@ -223,6 +295,13 @@ class AppForm(QMainWindow):
     self.ActiveWarningsTimer = QTimer(self) # EQ warnings Timer
     self.ActiveWarningsTimer.timeout.connect(self.processwarnings) # will run processwarnings
     self.ActiveWarningsTimer.start(300) # every 300 milliseconds
+    self.PeaksTimer = QTimer(self) # station values Timer
+    self.PeaksTimer.timeout.connect(self.processpeaks) # will run processpeaks
+    self.PeaksTimer.start(PEAKSWINDOW) # every PEAKSWINDOW milliseconds
+    if INVENTORYCHECK:
+      self.StationsFileTimer = QTimer(self) # stations file changes Timer
+      self.StationsFileTimer.timeout.connect(self.checkstations) # will run checkstations
+      self.StationsFileTimer.start(int(INVENTORYCHECK*1000)) # every INVENTORYCHECK seconds
 
   def init_connections(self):
     '''Connect signals to functions.
@@ -232,6 +311,7 @@ class AppForm(QMainWindow):
     self.connect(self,SIGNAL('redrawbgmapSignal'),self.redrawbgmap) # readraw background map
     self.connect(self,SIGNAL('addPanelSignal'),self.alertPanel.addPanel) # add EQ alert info panel
     self.connect(self,SIGNAL('updatePanelSignal'),self.alertPanel.updatePanel) # update EQ alert panel
+    self.connect(self,SIGNAL('trimEventsSignal'),self.trimevents) # forget old events and solutions, remove their panels
     self.connect(self,SIGNAL('drawSignal'),self.draw) # draw canvas
     # connect widget ok buttons to functions
     self.homeDialog.accepted.connect(self.onSetHomeLocationAccepted) # connect home settings dialog ok button
@@ -248,6 +328,7 @@ class AppForm(QMainWindow):
     self.canvas.mpl_connect('button_press_event',self.on_click) # connect click on canvas
     self.canvas.mpl_connect('button_release_event',self.on_unclick) # connect mouse button release on canvas
     self.canvas.mpl_connect('resize_event',self.resizeEvent) # connect resize event
+    self.canvas.mpl_connect('draw_event',self.on_draw) # stamp applied messages as drawn
     # connect messages signals
     self.connect(self,SIGNAL('sysMsgSignal'),self.sysmsg.add) # add system message
     self.connect(self,SIGNAL('trigMsgSignal'),self.trigmsg.add) # add trigger message
@@ -257,12 +338,23 @@ class AppForm(QMainWindow):
   def draw(self,idle=True):
     'Draw the figure on canvas.'
     self._drawing = True # entering a drawing mode
+    if self.stations is not None: self.stations.update() # apply station changes to the markers
     if idle:
       self.canvas.draw_idle() # draw idle (see matplotlib for details)
     else:
       self.canvas.draw() # draw anyways.
     self._drawing = False # leaving drawing mode
 
+  def timeddraw(self):
+    'replaces canvas.draw. keeps the draw durations for the metrics'
+    t = time.time()
+    self._canvasdraw()
+    self.drawtimes.append(time.time()-t)
+
+  def on_draw(self,evt):
+    'runs after every canvas draw'
+    self.latency.drawn() # everything applied so far is on screen now
+
   def grid(self):
     'toggle grid on or off'
     self.ax.grid()
@@ -284,22 +376,22 @@ class AppForm(QMainWindow):
   def subscribeToAMQ(self,topics):
     'subscribe to topics on AMQ server.'
     for topic in topics:
-      if self.amq.subscribeToActiveMQ(topics[topic],topic):
+      if self.amqshards.subscribeToActiveMQ(topics[topic],topic):
         self.sysmsg.add('Subscribed to '+topics[topic],True) # send system message
         self.topics[topic] = topics[topic] # save a list of topics
       else:
         self.sysmsg.add("Can't subscribed to "+topics[topic],True)
 
   def connectToAMQ(self):
-    'connect listener to AMQ server'
-    self.amq.connectToActiveMQ()
+    'connect listeners to AMQ server'
+    self.amqshards.connectToActiveMQ()
 
   def disconnectAMQ(self):
     'Diconnect Listener from AMQ server'
     for topic in topics:
-      if self.amq.unsubscribeToActiveMQ(topic):
+      if self.amqshards.unsubscribeToActiveMQ(topic):
         self.topics[topic] = None # remove topics from list
-    self.amq.conn.disconnect()
+    self.amqshards.disconnectToActiveMQ()
 
   def reconnectToAMQ(self):
     'reconnect to AMQ server'
@@ -316,20 +408,96 @@ class AppForm(QMainWindow):
     self.message(self.connectToNewAMQ.__doc__,'To Do List')
 
   def statusAMQ(self):
-    'Display info on AMQ connection'
-    maxmessages = self.amq.maxmessages # messages buffer size
-    usr = self.amq.usr # user
-    passwd = self.amq.passwd # password
-    name = self.amq.name # listener name
-    host,port = self.amq.conn.transport.current_host_and_port or self.amq.host_and_ports[0] # host and port used
-    nmessages = len(self.amq.MESSAGES) # number of current messages
+    'Display info on AMQ connections. one section per listener (topic group)'
     isconn = lambda x: "connected" if x else "not connected" # lambda expression for connection status
-    connected = isconn(self.amq.conn.is_connected()) # connection status
-    topics = self.amq.SUBSCRIBES # subsciption list
-    msg = 'AMQ Listner "%s" is %s to %s:%s@%s:%d\nMessages: %d (max: %d)\nTopics:\n  %s' \
-          %(name,connected,usr,passwd,host,port,nmessages,maxmessages,'\n  '.join([': '.join([k,v]) for k,v in topics.items()]))
+    sections = []
+    for l in self.amqshards: # every listener has its own connection, buffer and decoding queue
+      host,port = l.conn.transport.current_host_and_port or l.host_and_ports[0] # host and port used
+      buf = l.MESSAGES # recent messages buffer
+      queue = l.queue # decoding queue
+      sections.append('AMQ Listner "%s" is %s to %s:%s@%s:%d (hosts: %s)\nMessages: %d (max: %d) %d bytes (max: %s)\nReceived: %d Evicted: %d Dropped: %d\nDecoding queue: %d %s (%d workers, %s) Dropped: %d\nTopics:\n  %s' \
+          %(l.name,isconn(l.conn.is_connected()),l.usr,l.passwd,host,port,', '.join(['%s:%d'%tuple(h) for h in l.host_and_ports]),len(buf),l.maxmessages,buf.nbytes,buf.maxbytes or 'unlimited',buf.received,buf.evicted,buf.dropped,
+            queue.depth(),queue.depths(),len(l.workers),queue.policy,queue.dropped,'\n  '.join([': '.join([k,v]) for k,v in l.SUBSCRIBES.items()]) or 'none'))
+    log = self.logwriter # log writer, shared by all listeners
+    msg = '\n\n'.join(sections)+'\n\nLog writer: %d bytes written, %d pending, %d errors'%(log.byteswritten,log.depth(),log.errors)
+    pool = self.decodepool # gmpeak decoding processes
+    if pool: msg += '\nDecoding processes: %d %s (%.0f gmpeak msgs/s, on above %s) %d decoded %d failed%s'%(len(pool.processes),'on' if pool.active else 'off',pool.currentrate,pool.rate,pool.decoded,pool.failures,' (disabled)' if pool.disabled else '')
     self.message(msg, 'ElViS - AMQ Connection Status')
 
+  def statusLatency(self):
+    'Display end to end latency of messages per type and the slowest stations'
+    slowest = sorted([r for r in self.latency.summary(False,True) if r[1]=='console'],key=lambda r:-r[4])[:10] # by p90
+    stations = '\n'.join(['%-14s %10.2f %10.2f'%(r[0],r[4]*1e3,r[6]*1e3) for r in slowest])
+    msg = '<pre>%s\n\nSlowest stations (console p90[ms] max[ms]):\n%s</pre>'%(self.latency.report(),stations or 'none')
+    self.message(msg, 'ElViS - Latency Status')
+
+  def exportLatency(self):
+    'save latency summary and histograms of all types and stations to a file'
+    fileurl = str(QFileDialog.getSaveFileName(self, 'Export latency','latency_%s.txt'%datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S'))) # get the file name
+    if not fileurl: return
+    try:
+      self.latency.export(fileurl)
+    except IOError,msg:
+      self.message("Can't export latency: %s"%msg)
+
+  def collectmetrics(self):
+    'ingest and render health as [(name,type,help,samples)] for the metrics endpoint. runs in the server thread'
+    received,decoded,errors,dropped,depths,connected,age = [],[],[],[],[],[],[]
+    now = time.time()
+    for l in self.amqshards: # per listener (topic group)
+      name = {'listener':l.name}
+      received += [(dict(name,topic=t or ''),n) for t,n in l.MESSAGES.topicreceived.items()]
+      decoded += [(dict(name,type=t),n) for t,n in l.decoded.items()]
+      errors += [(dict(name,reason='decode'),l.decodeerrors),(dict(name,reason='unknown'),l.unknown),(dict(name,reason='process'),l.processerrors)]
+      dropped += [(dict(name,reason='oversize',lane=''),l.MESSAGES.dropped)]
+      dropped += [(dict(name,reason='overflow',lane=lane),n) for lane,n in zip(l.queue.lanenames,l.queue.lanedropped)]
+      depths += [(dict(name,lane=lane),n) for lane,n in zip(l.queue.lanenames,l.queue.depths())]
+      connected.append((name,int(l.conn.is_connected())))
+      if l._lastStamps: age.append((name,now-l._lastStamps[0]))
+    latency = self.latency.summary() # (type,stage,n,p50,p90,p99,max)
+    drawtimes = list(self.drawtimes)
+    draw = [({},len(drawtimes))+tuple(np.percentile(drawtimes,[50,90,99]))+(sum(drawtimes),)] if drawtimes else []
+    hits,misses,downloads = osm.tilehits,osm.tilemisses,osm.tiledownloads
+    log = self.logwriter
+    metrics = [
+      ('elvis_messages_received_total','counter','Messages received per listener and topic.',received),
+      ('elvis_messages_decoded_total','counter','Messages decoded per listener and message type.',decoded),
+      ('elvis_messages_failed_total','counter','Messages that could not be decoded (decode, unknown) or processed (process).',errors),
+      ('elvis_messages_dropped_total','counter','Messages dropped before decoding: oversize (buffer) or overflow (decoding queue lane).',dropped),
+      ('elvis_queue_depth','gauge','Messages waiting for decoding per listener and lane.',depths),
+      ('elvis_connected','gauge','1 if the listener is connected to the AMQ server.',connected),
+      ('elvis_last_message_age_seconds','gauge','Seconds since the last message received by the listener.',age),
+      ('elvis_decode_seconds','summary','Receive to decoded (queueing and decoding) over the recent messages per type.',
+        MTR.summary([({'type':r[0]},None)+r[3:6]+(None,) for r in latency if r[1]=='decode'])),
+      ('elvis_latency_seconds','summary','Recent message latency per type and stage (console is receive to drawn).',
+        MTR.summary([({'type':r[0],'stage':r[1]},None)+r[3:6]+(None,) for r in latency if r[1]!='decode'])),
+      ('elvis_latency_station_dropped_total','counter','Station latency samples dropped before they were sorted into the stations.',[({},self.latency.stationdropped)]),
+      ('elvis_draw_seconds','summary','Duration of the recent canvas draws.',MTR.summary(draw)),
+      ('elvis_tile_cache_hits_total','counter','Map tiles served from the memory cache.',[({},hits)]),
+      ('elvis_tile_cache_misses_total','counter','Map tiles read from the archive or downloaded.',[({},misses)]),
+      ('elvis_tile_cache_hit_ratio','gauge','Map tile memory cache hit ratio.',[({},float(hits)/(hits+misses) if hits+misses else None)]),
+      ('elvis_tile_downloads_total','counter','Map tiles fetched from the tile server.',[({},downloads)]),
+      ('elvis_active_stations','gauge','Stations that sent peaks recently (see STATIONTIMEOUT).',[({},len(self.activeStationsList))]),
+      ('elvis_triggered_stations','gauge','Stations currently highlighted as triggered.',[({},len(self.trigedlist))]),
+      ('elvis_active_warnings','gauge','Earthquake warnings currently running.',[({},len(self.activeWarnings))]),
+      ('elvis_log_pending_bytes','gauge','Log bytes waiting to be written.',[({},log.pendingbytes)]),
+      ('elvis_log_errors_total','counter','Failed log writes.',[({},log.errors)]),
+      ('elvis_eventstore_pending','gauge','Event solutions waiting to be written to the history.',[({},self.eventstore.depth())])]
+    if self.decodepool:
+      metrics += [('elvis_decode_pool_active','gauge','1 if gmpeak messages are decoded by the processes.',[({},int(self.decodepool.active))]),
+                  ('elvis_gmpeak_rate','gauge','Recent gmpeak messages per second.',[({},self.decodepool.currentrate)]),
+                  ('elvis_decode_pool_failures_total','counter','Batches of gmpeak messages the processes failed to decode in time (decoded here instead).',[({},self.decodepool.failures)])]
+    return metrics
+
+  def metricstext(self):
+    'the metrics as text for the metrics panel'
+    return MTR.formatmetrics(self.collectmetrics(),comments=False)
+
+  def showMetrics(self):
+    'show the live metrics panel'
+    self.metricsPanel.show()
+    self.metricsPanel.raise_()
+
   def connstat(self,connected,details):
     'update AMQ connection status'
     if not connected:
@@ -348,50 +516,94 @@ class AppForm(QMainWindow):
 
   def chkconn(self):
     'check current connection to AMQ server.'
-    host,port=self.amq.host_and_ports[0]
-    if self.amq.conn.transport.is_connected():
-      self.connstat(True,'Connected to ActiveMQ server @ '+':'.join([host,str(port)]))
+    listeners = [l for l in self.amqshards if l.SUBSCRIBES] or [self.amq] # listeners in use
+    hosts = lambda l: ':'.join([str(i) for i in l.conn.transport.current_host_and_port or l.host_and_ports[0]]) # host:port of a listener
+    down = [l for l in listeners if not l.conn.transport.is_connected()] # disconnected listeners
+    if not down:
+      self.connstat(True,'Connected to ActiveMQ server @ '+', '.join(['%s (%s)'%(hosts(l),l.name) for l in listeners]))
       self.status_text.setText('Monitoring.')
       return 1
     else:
-      self.connstat(False,'No Connection to '+':'.join([host,str(port)]))
+      self.connstat(False,'No Connection to '+', '.join(['%s (%s)'%(hosts(l),l.name) for l in down]))
       self.status_text.setText('Not Monitoring.')
       return 0
 
-  def processAMQmsg(self):
-    'Runs automatically every time a message arrives from AMQ server'
-    ts = datetime.datetime.utcnow() # get current time stamp
+  def processAMQmsg(self,l=None):
+    'Runs automatically every time a message arrives from AMQ server to listener l (default self.amq)'
     self.emit(SIGNAL('togconnstatsignal')) # toggle AMQ connection icon
-    l = self.amq # easier shortcut
+    l = l or self.amq # easier shortcut
     message = l._lastMessage # get last message
+    received,decoded = l._lastStamps # when it was received and decoded
     if message.type=='T': # trigger message
       self.emit(SIGNAL('trigMsgSignal'),str(message),datetime.datetime.utcnow().strftime('[%T.%f] ')) # send a trigger message
-      stationID = AMQ.ID(message.packets)[0][:-7] # get station ID
-      station = [i for i in self.stations if stationID in i.get_label()][0] # find first station in self.stations (matplotlib lines) with a label similar to stationID
-      self.trigstation(station) # Mark station as triggered
-      self.trigedlist[station]=ts # add time stamp to triggered station list
+      i = self.stationindex.get(AMQ.ID(message.packets)[0]) # get station record by net.sta.loc.chn
+      if i is not None: # ignore stations we don't have on the map
+        self.trigstation(i) # Mark station as triggered
+        self.trigedlist.touch([i]) # (re)start the highlight time of the station
+      self.latency.applied('T',received,decoded,[message.net+'.'+message.sta]) # will be on screen after the next draw
       self.emit(SIGNAL('drawSignal'),True) # redraw figure if idle
     if message.type=='G': # ground values
-      stationIDs = AMQ.ID(message.packets) # get station IDs in message
-      params = message.packets[self._watchingGMValue] # get parameter (dmax,vmax,amax for displacement,velocity or acceleration)
-      stations = [i for i in self.stations if i.get_label().split()[0] in [s[:-7] for s in stationIDs]] # get mpl lines objects for stations
-      if self.replay and not self.timeshift:  # if we are in a replay mode
+      if self.replay and not self.timeshift and not self.replayer:  # if we are in a replay mode of a server
         ptime = datetime.datetime.utcfromtimestamp(message.packets['ts'][0])  # get first packet time stamp
         self.timeshift = (datetime.datetime.utcnow() - ptime).total_seconds()  # determine timeshift
-      for station in stations:
-        self.activeStationsList[station]=ts # add a timestamp for station activity
-        vals = [abs(v) for i,v in zip(stationIDs,params) if station.get_label().split()[0] in i] # get values for station from all channels (E,N,Z)
-        val = max(vals) # get maximal value
-        color = self.color(val) # get color by value
-        station.set_markerfacecolor(color) # set station color
-        station.set_zorder(10) # move station to front of visibility
-        station.set_label(station.get_label().split()[0]+' (%s=%0.2e)'%(self._watchingGMValue,val)) # set station label with value
-      self.emit(SIGNAL('drawSignal'),True) # redraw figure if idle
+      self.peaks.add(message.packets,received,decoded) # keep for the next station values update. see processpeaks
     if message.type=='X': # event message (X=xml)
       self.emit(SIGNAL('evntMsgSignal'),str(message),True) # send an event message
+      self.eventstore.add(message,received) # keep in the event history
       self.processEvent(message) # process the event
+      self.latency.applied('X',received,decoded) # will be on screen after the next draw
   ########## AMQ related functions END ###########
 
+  ########## Replay related functions ###########
+  def start_replay(self,logs,speed=1.0):
+    'replay triggers (.trig) and events (.log) log files through the AMQ listener'
+    trigs = [l for l in logs if l.endswith('.trig')]
+    events = [l for l in logs if not l.endswith('.trig')]
+    try:
+      self.replayer = RPL.Replay(self.amq,trigs,events,speed) # see replay module for details
+    except Exception,msg:
+      self.sysmsg.add("Can't replay logs: %s"%msg,True)
+      return
+    self.sysmsg.add('Replaying %d messages from %s at x%s'%(len(self.replayer),', '.join(logs),speed or 'max'),True)
+    self.replayer.start()
+    self.replay_menu.setEnabled(True)
+
+  def now(self):
+    'current time. replay time if replaying logs.'
+    if self.replayer: return self.replayer.now()
+    return datetime.datetime.utcnow()
+
+  def togglereplay(self):
+    'pause or resume the replay'
+    if not self.replayer: return
+    if self.replayer.paused:
+      self.replayer.resume()
+      self.statusBar().showMessage('Replay resumed at %s'%self.replayer.now().isoformat(),2000)
+    else:
+      self.replayer.pause()
+      self.statusBar().showMessage('Replay paused at %s'%self.replayer.now().isoformat(),2000)
+
+  def setreplayspeed(self):
+    'ask for a new replay speed'
+    if not self.replayer: return
+    speed,ok = QInputDialog.getDouble(self,'ElViS - Replay speed','Speed factor (%s-%s, 0 for as fast as possible):'%(RPL.MINSPEED,RPL.MAXSPEED),self.replayer.speed,0,RPL.MAXSPEED,1)
+    if not ok: return
+    try:
+      self.replayer.setspeed(speed)
+    except ValueError,msg:
+      self.message(str(msg),'ElViS - Replay')
+
+  def seekreplay(self):
+    'ask for a time to move the replay to'
+    if not self.replayer: return
+    t,ok = QInputDialog.getText(self,'ElViS - Replay seek','Time (YYYY-MM-DDTHH:MM:SS UTC):',QLineEdit.Normal,self.replayer.now().strftime('%Y-%m-%dT%H:%M:%S'))
+    if not ok: return
+    try:
+      self.replayer.seek(str(t))
+    except ValueError,msg:
+      self.message(str(msg),'ElViS - Replay')
+  ########## Replay related functions END ###########
+
   def processEvent(self,m):
     '''Process an event message from AMQ server.
      This will be called by AMQ event processor for each event message'''
@@ -403,11 +615,14 @@ class AppForm(QMainWindow):
     m.point = mpl.lines.Line2D([m.lon],[m.lat],marker='o',ms=10,mew=3,mec=(1.0,0,0,1.0),mfc=(1.0,0,0,0.5),label=lbl) # create a point at location
     if m.azimuth<0: m.azimuth+=360.0 # correct for 0-360 azimuth range
     self.lastEvent = m # set last event variable
-    if not m.Eid in self.eventsList: # if this is first time we see this event ID
-      self.eventsList[m.Eid] = [m] # add to event list
-    else:
-      self.eventsList[m.Eid].append(m) # or append to solutions record of the event
-    self.starteventwarning(m) # start a warning or update an active one
+    with self.eventsLock:
+      if not m.Eid in self.eventsList: # if this is first time we see this event ID
+        self.eventsList[m.Eid] = [m] # add to event list
+      else:
+        self.eventsList[m.Eid].append(m) # or append to solutions record of the event
+      self.starteventwarning(m) # start a warning or update an active one
+    self.emit(SIGNAL('trimEventsSignal'),m.Eid) # keep memory bounded. history is in the event store. widgets are closed by the GUI thread
+    self._hoverstale = True # the new location can be hovered
     # uncomment for a zoom to event
     #self.ax.set_ylim(m.lat-0.5,m.lat+0.5)
     #self.ax.set_xlim(m.lon-0.5,m.lon+0.5)
@@ -417,14 +632,41 @@ class AppForm(QMainWindow):
 
   def clear_events(self):
     'Clear all events from memory and map except for the active events'
-    for Eid in self.eventsList.keys(): # for every event
-      if not self.activeWarnings.has_key(Eid): # if not active warning
-        for m in self.eventsList[Eid]: # for every solution fount and displayed
-          m.point.remove() # remove the point from map
-        self.eventsList.pop(Eid) # remove event form event list
-        if Eid in self.alertPanel.eq: self.alertPanel.eq[Eid].widget.parent().close() # remove panel if still visible
+    with self.eventsLock:
+      for Eid in self.eventsList.keys(): # for every event
+        if not self.activeWarnings.has_key(Eid): # if not active warning
+          self.forgetevent(Eid)
     self.emit(SIGNAL('drawSignal'))
 
+  def forgetevent(self,Eid):
+    'remove an event from memory and map. it is still in the event store. GUI thread only'
+    with self.eventsLock: solutions = self.eventsList.pop(Eid)
+    for m in solutions: # for every solution fount and displayed
+      m.point.remove() # remove the point from map
+    if Eid in self.alertPanel.eq: self.alertPanel.eq[Eid].widget.parent().close() # remove panel if still visible
+    self._hoverstale = True
+
+  def trimevents(self,Eid):
+    '''keep up to EVENTSKEEP events and EVENTSOLUTIONS solutions of event Eid in memory. active events are kept.
+       GUI thread only. processEvent calls it with trimEventsSignal'''
+    with self.eventsLock:
+      solutions = self.eventsList.get(Eid,[]) # might be forgotten already
+      while len(solutions)>EVENTSOLUTIONS: # oldest solutions of this event
+        m = solutions.pop(0)
+        m.point.remove() # remove the point from map
+      for old in self.eventsList.keys()[:max(0,len(self.eventsList)-EVENTSKEEP)]: # oldest events first
+        if not old in self.activeWarnings: self.forgetevent(old)
+    self._hoverstale = True
+
+  def showEventHistory(self):
+    'list the events of the last EVENTSHISTORYHOURS hours from the event store'
+    self.eventstore.flush() # include the last solutions
+    events = self.eventstore.events(self.now()-datetime.timedelta(hours=EVENTSHISTORYHOURS))[::-1] # newest first
+    lines = ['%s %-12s %5.1f%-3s %8.4f %9.4f %6.1f %4d'%(e.orig_time.strftime('%Y-%m-%d %H:%M:%S'),e.eid,e.mag,e.magu,e.lat,e.lon,e.depth,e.nsolutions) for e in events[:100]]
+    header = '%-19s %-12s %8s %8s %9s %6s %4s'%('origin time (UTC)','id','mag','lat','lon','depth','#')
+    msg = '<pre>%d events in the last %s hours%s\n\n%s\n%s</pre>'%(len(events),EVENTSHISTORYHOURS,' (newest 100)' if len(events)>100 else '',header,'\n'.join(lines))
+    self.message(msg,'ElViS - Event History')
+
   def starteventwarning(self,m):
     '''Add an event warning panel or update an existing one.
        also update event location on map.
@@ -469,7 +711,7 @@ class AppForm(QMainWindow):
       depth0 = params['depth'] # depth
       S = params['S'] # S wave mpl line
       P = params['P'] # P wave mpl line
-      now = datetime.datetime.utcnow() # get the current time
+      now = self.now() # get the current time
       dt =  (now-ot).total_seconds() # calculate time difference since origin time
       if dt>180: # if we are 3 minutes after the event
         self.ax.lines.remove(P) # remove the P wave line
@@ -488,79 +730,67 @@ class AppForm(QMainWindow):
         self.emit(SIGNAL('updatePanelSignal'),Eid,params,0) # or just put a zero if S wave has passed, hoping someone is still there to see it.
     if redraw: self.emit(SIGNAL('drawSignal')) # update the map with all changes
 
+  def processpeaks(self):
+    '''update station colors and labels with ground motion peaks coalesced since the last call.
+    will be called by a timer every PEAKSWINDOW milliseconds. work is done once per reporting station.
+    '''
+    batch = self.peaks.pop() # {net.sta: {'amax':..,'vmax':..,'dmax':..}} since last call
+    if not batch: return # nothing new
+    applied = {} # (received,decoded) -> stations updated with peaks of that message
+    ids = batch.keys() # reporting stations
+    records = self.stationindex.records(ids) # get their station records
+    ids = [stationID for stationID,i in zip(ids,records) if i>=0] # only stations on the map
+    records = records[records>=0]
+    if not len(records): return # no news from stations on the map
+    for stationID in ids:
+      if 'received' in batch[stationID]: applied.setdefault((batch[stationID]['received'],batch[stationID]['decoded']),[]).append(stationID)
+    self.activeStationsList.touch(records.tolist()) # (re)start the activity time of the stations
+    vals = [batch[stationID][self._watchingGMValue] for stationID in ids] # get maximal values
+    colors = self.colors(vals) # get colors by value in one lookup
+    self.stations.setvalues(records,vals,self._watchingGMValue,colors) # set values and colors. labels are made on demand
+    for (received,decoded),stations in applied.items():
+      self.latency.applied('G',received,decoded,stations) # will be on screen after the next draw
+    self.emit(SIGNAL('drawSignal'),True) # redraw figure if idle
+
   def processactivestations(self):
     '''process active station. update non-active stations.
-    will be called by a timer every 1 second.
+    will be called by a timer every 1 second. only stations that expired are visited.
     '''
-    redraw = False # don't draw if no changes are needed
-    ts = datetime.datetime.utcnow() # get the time
-    for station in self.stations: # for every station
-      if station in self.activeStationsList: # if station is listed as active (i.e. got a message from it)
-        if (ts-self.activeStationsList[station]).total_seconds()>60: # if last message from station is over a minute ago
-          redraw = True # don't forget to update at the end
-          station.set_markerfacecolor('k') # turn station color to black (not active)
-          self.emit(SIGNAL('errMsgSignal'),'Station %s is inactive for the last 60 sec.' % station.get_label().split()[0],True) # send an error message
-          self.activeStationsList.pop(station) # remove form active station list
-    if redraw: self.emit(SIGNAL('drawSignal')) # update map if needed.
+    expired = self.activeStationsList.expired() # stations without values for the last STATIONTIMEOUT seconds
+    if not expired: return # don't draw if no changes are needed
+    self.stations.deactivate(expired) # turn station color to black (not active)
+    for i in expired:
+      self.emit(SIGNAL('errMsgSignal'),'Station %s is inactive for the last %g sec.' % (self.stations.ids[i],STATIONTIMEOUT),True) # send an error message
+    self.emit(SIGNAL('drawSignal')) # update map
 
   def processtrigs(self):
     '''Process triggered stations.
-       remove highlighting of triggered stations after 5 seconds
+       remove highlighting of triggered stations after TRIGGERHIGHLIGHT seconds.
+       only stations that expired are visited.
     '''
-    redraw = False # don't update map if no changes are made
-    for station in self.stations: # for each station
-      if station in self.trigedlist: # if it was triggered during a trigger message
-        if (datetime.datetime.utcnow()-self.trigedlist[station]).total_seconds()>5: # and it was over 5 seconds ago
-          redraw = True # don't forget to update the map
-          self.untrigstation(station) # un-trigger the station (i.e. remove highlighting)
-          self.trigedlist.pop(station) # remove station from triggered station list
-    if redraw: self.emit(SIGNAL('drawSignal')) # update map if needed
+    expired = self.trigedlist.expired() # stations triggered over TRIGGERHIGHLIGHT seconds ago
+    if not expired: return # don't update map if no changes are made
+    self.untrigstation(expired) # un-trigger the stations (i.e. remove highlighting)
+    self.emit(SIGNAL('drawSignal')) # update map
 
   def trigstation(self,station):
     '''mark station marker as triggered.
        called by AMQ message processor when a trigger message arrives'''
-    station.set_zorder(999) # bring to front
-    station.set_markersize(10) # enlarge marker size
-    station.set_markeredgecolor('red') # highlight edge in red
+    self.stations.trigger([station]) # enlarge marker, highlight edge in red and bring to front
 
-  def untrigstation(self,station):
-    '''un mark station marker as triggered.
+  def untrigstation(self,stations):
+    '''un mark station markers as triggered.
     called by processtrigs (wich is called every 1 second)
-    if trigger was over 5 seconds ago.
+    if trigger was over TRIGGERHIGHLIGHT seconds ago.
     '''
-    station.set_markersize(6) # back to normal size
-    station.set_markeredgecolor('black') # un-highlight edge
+    self.stations.untrigger(stations) # back to normal size and edge
 
 
-  def color(self,val):
-    '''determin the color of a station by data value.
-       Note that Elarms output is in cm.
+  def colors(self,vals):
+    '''colors (RGBA rows) of an array of station values of the watched value type.
+       see COLORSCALES and the colormaps module.
     '''
-    if self._watchingGMValue=="vmax": # velocity color scheme
-      v = val*1000000.0
-      if v>150000:
-        color='maroon'
-      if v<150000:
-        color='red'
-      if v<60000:
-        color='darkorange'
-      if v<30000:
-        color='gold'
-      if v<12000:
-        color='yellow'
-      if v<4000:
-        color='green'
-      if v<1500:
-        color='cyan'
-      if v<800:
-        color='skyblue'
-      if v<400:
-        color='blue'
-      return color
-    elif self._watchingGMValue=="amax": # acceleration value
-      return self.acmap(int(255*(abs(val)/98.1))) # normilized cm/s^2 to g percentage
-    elif self._watchingGMValue=="dmax":
-      return self.acmap(int(255*(np.log10(abs(val)/1e-9))/10.0)) # order of magnitude with respect to nanometer
+    return self.colorscales[self._watchingGMValue](vals)
 
   def resizeEvent(self,event):
     '''called by any resize event of the map'''
@@ -618,12 +848,10 @@ class AppForm(QMainWindow):
         self.statusBar().showMessage('Distance: %lfkm'%ALRT.cutil.geo_to_km(self.meter._xorig[0],self.meter._yorig[0],self.meter._xorig[-1],self.meter._yorig[-1])[0]) # show user the distance
         self.emit(SIGNAL('drawSignal'),True) # draw the map
         return # we're done here
-      hide = True # unless we don't measure but simply pointing along the map
-      label = [] # a list of labels to present in a tooltip
-      for l in self.ax.hitlist(evt): # see if mouse points at objects of the map
-        if l in self.ax.lines: # if object is a line
-          label += [l.get_label()] # get it's label to the list
-          hide=False # a flag for tooltip widget
+      label = [self.hoverlabel(k) for k in self.hoverindex().query(evt.x,evt.y)] # labels of stations and events under the pointer, made for them only
+      for params in self.activeWarnings.values(): # the few moving P and S wave lines are hit tested directly
+        label += [params[w].get_label() for w in ('P','S') if params[w].contains(evt)[0]]
+      hide = not label # a flag for tooltip widget
       if not hide: # if we don't hide the tooltip
         self.stationNameWidget.setText('\n---\n'.join(label)) # set text in tooltip
         self.stationNameWidget.move(QCursor.pos()+QPoint(5,5)) # move the tooltip to the pointer position. might be out of screen area if on edges
@@ -631,6 +859,25 @@ class AppForm(QMainWindow):
         self.stationNameWidget.show() # show the widget
       else: self.stationNameWidget.hide() # if nothing is on the hit list - hide the tooltip widget
 
+  def hoverindex(self):
+    'the screen space index of stations, events and home. built again when the view or the items changed'
+    view = (tuple(self.ax.get_xlim()),tuple(self.ax.get_ylim()),tuple(self.ax.bbox.bounds)) # map limits and axes size
+    if view!=self._hoverview or self._hoverstale:
+      self._hoverview,self._hoverstale = view,False
+      with self.eventsLock: points = [m.point for solutions in self.eventsList.values() for m in solutions]+[self.home] # event locations and home. the AMQ thread adds events
+      lonlat = [(np.ravel(p.get_xdata())[0],np.ravel(p.get_ydata())[0]) for p in points]
+      keys = points
+      if self.stations is not None and len(self.stations):
+        lonlat = np.concatenate([self.stations.positions,np.reshape(lonlat,(-1,2))])
+        keys = range(len(self.stations))+keys # station records, then lines
+      self.hover.build(self.ax.transData.transform(np.reshape(lonlat,(-1,2))),keys,self.ax.bbox.extents)
+    return self.hover
+
+  def hoverlabel(self,key):
+    'tooltip label of a hover index key: a station record or a line'
+    if isinstance(key,(int,long)): return self.stations.label(key)
+    return key.get_label()
+
   def on_click(self,evt):
     'handle mouse clicks'
     if evt.button==1 and not evt.dblclick: # in case its a single left button click
@@ -687,6 +934,7 @@ class AppForm(QMainWindow):
     [t.set_va('bottom') for t in self.ax.yaxis.get_majorticklabels()] # adjust y ticks
     self.ax.drag_pan = self.drag_pan # replacing original drag_pan function of axes to home made one to make sure no panning out of geo bounderies
     self.canvas = FigureCanvas(self.fig) # set the canvas of figure
+    self._canvasdraw,self.canvas.draw = self.canvas.draw,self.timeddraw # time every draw (draw_idle ends up here too)
     self.canvas.setParent(self.viewer) # place canvas in viewer
     self.toolbar = NavigationToolbar(self.canvas, self.viewer) # add the toolbar of the canvas
     self.vbox.addWidget(self.canvas) # add canvas to layout
@@ -752,21 +1000,42 @@ class AppForm(QMainWindow):
          [network] [station] [latitude] [longitude]
        additional columns will be ignored
        for comments in file use '#'
+       StationXML files (.xml) are read with obspy.
+       the parsed stations are cached in INVENTORYCACHE until the file changes (see stations module).
+       reloading keeps the state of stations that are still listed.
     '''
     try:
-      stations = np.loadtxt(fileurl,dtype=np.dtype([('net','|S2'),('sta','|S5'),('lat',float),('lon',float)]),usecols=xrange(4)) # read file
+      stations = STA.loadinventory(fileurl,INVENTORYCACHE) # read file or its cache
+      stat = os.stat(fileurl) # to notice changes of the file
     except Exception,msg:
 #      self.message("Can't load stations from %s: \n"%(fileurl)+msg.message,'ElViS - Error loading stations') # show a message window if failed
       return
-    ids = ['.'.join([n,s]) for n,s in zip(stations['net'],stations['sta'])] # get stations ids as net.sta
-    stations = [mpl.lines.Line2D([stations['lon'][i]],[stations['lat'][i]],marker='^',c='k',ms=6,label=ids[i]) for i in range(len(ids))] # create lines (a marker) for each station
-    [station.remove() for station in self.stations] # remove old stations if available
-    self.trigedlist = {} # refresh the list of triggered stations
-    self.activeStationsList = {} # refresh the list of active stations
-    self.stations = stations # set new stations
-    [self.ax.add_line(station) for station in stations] # add stations locations to map
+    index = STA.StationIndex(stations['net'],stations['sta']) # index of stations ids (net.sta)
+    ids = index.ids # get stations ids as net.sta
+    if self.stations is None: # first time
+      self.stations = STA.StationMarkers(self.ax,stations['lon'],stations['lat'],ids) # add stations locations to map. one collection for all markers
+    else: # update the markers in place
+      added,removed,moved = STA.diffinventory(zip(self.stations.ids,*self.stations.positions.T),zip(ids,stations['lon'],stations['lat'])) # what changed
+      records = self.stations.reload(stations['lon'],stations['lat'],ids) # old station record -> new station record
+      self.trigedlist.remap(records) # keep triggered stations
+      self.activeStationsList.remap(records) # keep active stations
+      self.sysmsg.add('Stations loaded from %s: %d stations, %d added, %d removed, %d moved'%(fileurl,len(ids),len(added),len(removed),len(moved)),True)
+    self.stationsfile = (fileurl,stat.st_size,stat.st_mtime) # loaded stations file
+    self.stationindex = index # set new stations index
+    self.peaks.setindex(index) # pending peaks of old stations are discarded
+    self._hoverstale = True # stations changed
     self.draw(True) # redraw the map
 
+  def checkstations(self):
+    'reload the stations file if it changed. called by a timer every INVENTORYCHECK seconds'
+    if not self.stationsfile: return
+    fileurl,size,mtime = self.stationsfile
+    try:
+      stat = os.stat(fileurl)
+    except OSError:
+      return # moved away. keep the current stations
+    if (stat.st_size,stat.st_mtime)!=(size,mtime): self.load_stations(fileurl)
+
   def set_home(self,lat=HomeLat,lon=HomeLon,label=HomeLabel,markersize=HomeSize,color=HomeColor,marker=HomeMarker):
     'plot the "home" location on map'
     if not 'home' in self.__dict__: # if this is the first time we set the home location
@@ -777,6 +1046,7 @@ class AppForm(QMainWindow):
     self.home.set_markersize(markersize) # update marker size
     self.home.set_color(color) # update marker color
     self.home.set_marker(marker) # update marker type
+    self._hoverstale = True # home moved
     self.emit(SIGNAL('drawSignal'),True) # redraw the map
 
   def setHomeLocation(self):
@@ -821,15 +1091,45 @@ class AppForm(QMainWindow):
     needs to be more agile and configurable '''
     lat,lon,depth,label,mag,delay = [str(i) for i in self.eventDialog.getParams()] # get parameters
     body = AMQ.getDMxmlmsg(label,mag,lat,lon,depth,float(delay)) # get DM xml message. see amq2py for details.
-    writer = AMQ.AMQWriter(usr=AMQDMUSER,passwd=AMQDMPASSWD,verbose=False,host_and_ports=[(AMQHOST,AMQPORT)]) # see amq2py module for details
+    writer = AMQ.getAMQWriter(usr=AMQDMUSER,passwd=AMQDMPASSWD,host_and_ports=[(AMQHOST,AMQPORT)],verbose=False) # shared writer with a persistent connection. see amq2py module for details
     self.evntmsg.add("Attempting to send an event message",True)
-    self.sysmsg.add("Writer connecting to ActiveMQ server...",True)
-    writer.connectToActiveMQ() # connect to amq server
     self.sysmsg.add("Writer sending message to ActiveMQ server...",True)
-    writer.sendActiveMQmsg(body) # send the message
-    self.sysmsg.add("Writer disconnecting from ActiveMQ server...",True)
-    writer.disconnectToActiveMQ() # disconnect from amq server
-    self.sysmsg.add("You should see an alert now...",True)
+    writer.send(body,callback=self.onNewEventSent) # send in the background. don't block the GUI
+
+  def playScenario(self):
+    'play a scenario file of timed events and synthetic station messages to the AMQ server. see scenario module'
+    fileurl = str(QFileDialog.getOpenFileName(self, 'Open scenario file')) # get the file name
+    if not fileurl: return
+    try:
+      scenario = SCN.Scenario(fileurl) # parse and check the whole file first
+    except (ValueError,IOError),msg:
+      self.message("Can't load scenario: %s"%msg,'ElViS - Scenario')
+      return
+    if self.scenarioplayer: self.scenarioplayer.stop() # one scenario at a time
+    writer = AMQ.getAMQWriter(usr=AMQDMUSER,passwd=AMQDMPASSWD,host_and_ports=[(AMQHOST,AMQPORT)],verbose=False) # shared writer. see amq2py module for details
+    self.scenarioplayer = SCN.ScenarioPlayer(writer,scenario)
+    self.sysmsg.add('Playing %d scenario messages from %s over %.1f seconds'%(len(scenario),fileurl,scenario.duration()),True)
+    threading.Thread(target=self._startScenario,args=(self.scenarioplayer,)).start() # rendering and connecting may take a while
+
+  def _startScenario(self,player):
+    try:
+      player.start()
+    except Exception,msg:
+      self.emit(SIGNAL('errMsgSignal'),"Can't play scenario: %s"%msg,True)
+
+  def stopScenario(self):
+    'stop a playing scenario'
+    if not self.scenarioplayer: return
+    self.scenarioplayer.stop()
+    self.sysmsg.add('Scenario stopped after %d messages'%self.scenarioplayer.sent,True)
+    self.scenarioplayer = None
+
+  def onNewEventSent(self,ok,error):
+    'runs in the writer thread once a test event was sent or given up on'
+    if ok:
+      self.emit(SIGNAL('sysMsgSignal'),"You should see an alert now...",True)
+    else:
+      self.emit(SIGNAL('errMsgSignal'),"Writer failed to send the event message: %s"%error,True)
 
   def set_watch_value(self,text):
     'change station monitoring value type (displacement,velocity or acceleration'
@@ -914,9 +1214,20 @@ class AppForm(QMainWindow):
     event_action = self.create_action("Create &Event",
             shortcut="Shift+Ctrl+E", slot=self.setNewEvent,
             icon='preferences-system',tip="Fire a New Event.")
+    # play a scenario file
+    scenario_action = self.create_action("Play &Scenario...",
+            slot=self.playScenario,
+            icon='media-playback-start',tip="Play timed events and synthetic messages from a scenario file.")
+    stopscenario_action = self.create_action("S&top Scenario",
+            slot=self.stopScenario,
+            icon='media-playback-stop',tip="Stop the playing scenario.")
+    # list past events
+    history_action = self.create_action("&History",
+            shortcut="Shift+Ctrl+W", slot=self.showEventHistory,
+            icon='appointment',tip="List recent events from the event history.")
     # populate the Edit menu
     self.add_actions(self.edit_menu,
-            [event_action])
+            [event_action,history_action,None,scenario_action,stopscenario_action])
     # Add Connection submenu
     self.connection_menu = self.menuBar().addMenu("&Connection")
     reconnect_action = self.create_action("&Reconnect",
@@ -931,9 +1242,31 @@ class AppForm(QMainWindow):
     status_action = self.create_action("St&atus",
             shortcut="Shift+Ctrl+A", slot=self.statusAMQ,
             icon='dialog-question',tip="AMQ Server connection detail and status")
+    latency_action = self.create_action("&Latency",
+            shortcut="Shift+Ctrl+Y", slot=self.statusLatency,
+            icon='dialog-information',tip="End to end message latency per type and station")
+    metrics_action = self.create_action("&Metrics",
+            shortcut="Shift+Ctrl+M", slot=self.showMetrics,
+            icon='utilities-system-monitor',tip="Live ingest and render health metrics")
+    exportLatency_action = self.create_action("E&xport Latency...",
+            slot=self.exportLatency,
+            icon='document-save',tip="Save latency summary and histograms to a file")
     # populate the connection submenu
     self.add_actions(self.connection_menu,
-                     (connectTo_action,reconnect_action,disconect_action,None,status_action))
+                     (connectTo_action,reconnect_action,disconect_action,None,status_action,latency_action,exportLatency_action,metrics_action))
+    # Add Replay submenu. enabled when replaying logs
+    self.replay_menu = self.menuBar().addMenu("&Replay")
+    pause_action = self.create_action("&Pause/Resume",
+            shortcut="Ctrl+P", slot=self.togglereplay,
+            icon='media-playback-pause',tip="Pause or resume the replay.")
+    speed_action = self.create_action("&Speed...",
+            slot=self.setreplayspeed,
+            icon='media-seek-forward',tip="Set the replay speed.")
+    seek_action = self.create_action("S&eek...",
+            slot=self.seekreplay,
+            icon='media-skip-forward',tip="Move the replay to a time.")
+    self.add_actions(self.replay_menu,(pause_action,speed_action,seek_action))
+    self.replay_menu.setEnabled(False)
     # Add help submenu
     self.help_menu = self.menuBar().addMenu("&Help")
     # Help
@@ -1069,6 +1402,12 @@ def main(args):
   appwin = AppForm(splash,args)
   appwin.show()
   splash.finish(appwin)
+  app.aboutToQuit.connect(AMQ.closeAMQWriters) # send pending test events and close writer connections
+  app.aboutToQuit.connect(appwin.eventstore.close) # write pending event solutions
+  if appwin.decodepool: app.aboutToQuit.connect(appwin.decodepool.close) # stop decoding processes
+  if appwin.metricsserver: app.aboutToQuit.connect(appwin.metricsserver.stop) # stop serving metrics
+  app.aboutToQuit.connect(appwin.logwriter.close) # flush pending log writes and close the log files
+  app.aboutToQuit.connect(appwin.latency.close) # stop sorting station latency samples
   # run the application
   sys.exit(app.exec_())
 
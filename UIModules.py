@@ -313,6 +313,42 @@ class messagesWidget(QTabWidget):
   def cleartabtxt(self):
     tab = self.currentWidget().clear()
 
+# Metrics Panel
+class metricsPanel(QDialog):
+  '''A live view of the health metrics. source() returns the text to show.
+     refreshed every interval milliseconds while visible.'''
+  def __init__(self,source,interval=1000,parent=None):
+    QDialog.__init__(self,parent=parent)
+    self.setWindowTitle('ElViS - Metrics')
+    self.source = source
+    vbox = QVBoxLayout(self)
+    self.text = QPlainTextEdit()
+    self.text.setReadOnly(True)
+    self.text.setLineWrapMode(QPlainTextEdit.NoWrap)
+    self.text.setFont(QFont('Monospace'))
+    vbox.addWidget(self.text)
+    self.buttons = QDialogButtonBox(QDialogButtonBox.Close,Qt.Horizontal, self)
+    vbox.addWidget(self.buttons)
+    self.buttons.rejected.connect(self.reject)
+    self.timer = QTimer(self)
+    self.timer.timeout.connect(self.refresh)
+    self.interval = interval
+    self.resize(640,480)
+  def refresh(self):
+    pos = self.text.verticalScrollBar().value() # keep the scroll position
+    try:
+      self.text.setPlainText(self.source())
+    except Exception,msg:
+      self.text.setPlainText("Can't collect metrics: %s"%(str(msg) or type(msg).__name__))
+    self.text.verticalScrollBar().setValue(pos)
+  def showEvent(self,evt):
+    self.refresh()
+    self.timer.start(self.interval)
+    QDialog.showEvent(self,evt)
+  def hideEvent(self,evt):
+    self.timer.stop()
+    QDialog.hideEvent(self,evt)
+
 # Alert Panel Widget
 class alertPanel(QMainWindow):
   '''Alert panel where ETA of S wave will be shown.
@@ -18,13 +18,18 @@
 #*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
 #***********************************************************************************/
 
-import sys,os,threading
-import stomp,datetime,zlib
-from numpy import frombuffer,dtype,array, zeros
+import sys,os,threading,time,calendar,Queue
+import multiprocessing
+from multiprocessing import sharedctypes
+from multiprocessing.queues import SimpleQueue
+from collections import deque
+import stomp,datetime,zlib,struct
+from numpy import frombuffer,dtype,zeros,logspace,histogram,percentile,median,clip,array,asarray,argsort,flatnonzero,maximum,empty,nan,isnan,inf,column_stack
 from xml.dom import minidom
+from xml.parsers import expat
 import logging
 logging.basicConfig()
-msglock = threading.Lock()
+msglock = threading.Lock() # serializes calls to processMessages
 
 def ID(a):
   'get network,station,location,channal from a Structured Array.'
@@ -34,65 +39,160 @@ def ID(a):
   loc = a['loc']
   return ['.'.join([n,s,l,c]) for n,s,l,c in zip(net,sta,loc,chn)]
 
+def sec2ts(sec,msec):
+  'convert seconds and milliseconds arrays to a datetime64[us] array in one vectorized step.'
+  return (sec.astype('i8')*1000000+msec.astype('i8')*1000).view('M8[us]')
+
+# message data types. built once here and shared by all decoders.
+# see data structure in GMPeak.h, TrigParams.h and Trigger.h
+HEADERtype = dtype([('type', 'S1'), ('version','>i4'),('source', 'S20'), ('id', '>i4'), ('npackets', '>i4')])
+GMPeakheadertype = HEADERtype
+GMPeakdatatype = dtype([('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8'), ('ts', '>f8'), ('nsamps', '>i4'), ('samprate', '>f4'), ('dmax', '>f4'), ('vmax', '>f4'), ('amax', '>f4'), ('dindex', '>i4'), ('vindex', '>i4'), ('aindex', '>i4'), ('latency', '>f4')])
+GMPeaknativetype = GMPeakdatatype.newbyteorder('=') # same fields in machine byte order
+TrigParamheadertype = HEADERtype
+TrigParamvaluestype = dtype([('tauP','>f4'),('tauPsnr','>f4'),('ttime','>i4'),('d','>f4'),('dsnr','>f4'),('dtime','>i4'),('v','>f4'),('vsnr','>f4'),('vtime','>i4'),('a','>f4'),('asnr','>f4'),('atime','>i4')])
+TrigParamrawtype = dtype([('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8')\
+                         ,('sec', '>i4'),('msec','>i4'), ('packlength', '>i4')\
+                         ,('recent_sample', '>i4'),('samplerate', '>f4'),('toffset', '>f4'),('arrtime', '>f8')\
+                         ,('protime', '>f4'),('fndtime', '>f4'),('quetime', '>f4'),('sndtime', '>f4')\
+                         ,('trigvalues',TrigParamvaluestype,10)])
+_TrigParamtsview = dtype({'names':[n if not n=='sec' else 'ts' for n in TrigParamrawtype.names],
+                          'formats':[TrigParamrawtype[n] for n in TrigParamrawtype.names]}) # raw layout with sec named ts
+TrigParamdatatype = dtype([('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8')\
+                          ,('ts', 'M8[us]'),('msec','>i4'),('packlength', '>i4')\
+                          ,('recent_sample', '>i4'),('samplerate', '>f4'),('toffset', '>f4'),('arrtime', '>f8')\
+                          ,('protime', '>f4'),('fndtime', '>f4'),('quetime', '>f4'),('sndtime', '>f4')\
+                          ,('trigvalues',TrigParamvaluestype,10)])
+Triggerrawtype = dtype([('type', 'S1'),('version','>i4'), ('source', 'S20'), ('id', '>i4'), ('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8'), ('sec', '>i4'), ('msec', '>i4')])
+Triggerdatatype = dtype([('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8'), ('ts', datetime.datetime)])
+RawDataheadertype = HEADERtype
+_npacketsfmt = struct.Struct('>i') # npackets field of a message header
+_lengthfmt = struct.Struct('>i') # length prefix of frames in the triggers log
+_npacketsoffset = HEADERtype.fields['npackets'][1]
+_zlibproto = zlib.decompressobj() # a fresh decompressor. copy it instead of building a new one
+
+# message records. dtypes are class attributes so constructing a record allocates only the record itself.
 class GMPeak(object):
+  __slots__ = ('raw','header','packets')
+  type = 'G'
+  headertype = GMPeakheadertype
+  datatype = GMPeakdatatype
   def __init__(self,m=None):
-    self.type='G'
-    # see data structure in GMPeak.h
-    self.headertype = dtype([('type', 'S1'), ('version','>i4'),('source', 'S20'), ('id', '>i4'), ('npackets', '>i4')])
-    self.datatype = dtype([('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8'), ('ts', '>f8'), ('nsamps', '>i4'), ('samprate', '>f4'), ('dmax', '>f4'), ('vmax', '>f4'), ('amax', '>f4'), ('dindex', '>i4'), ('vindex', '>i4'), ('aindex', '>i4'), ('latency', '>f4')])
-    self.header = array([],dtype=self.headertype)
-    self.packets= array([],dtype=self.datatype)
+    self.raw = None
+    self.header = None
+    self.packets = None
     if m: self.decode(m)
   def decode(self,m):
     self.raw=m
     header = frombuffer(m,self.headertype,1)
-    try:
-      data = zlib.decompress(m[self.headertype.itemsize+1:])
-    except:
-      data = m[self.headertype.itemsize+1:]
+    offset = self.headertype.itemsize+1
     self.header = header
-    self.packets = frombuffer(data,self.datatype,header['npackets'])
+    try:
+      data = zlib.decompress(buffer(m,offset)) # buffer - don't copy the payload
+      self.packets = frombuffer(data,self.datatype,header['npackets'])
+    except zlib.error:
+      self.packets = frombuffer(m,self.datatype,header['npackets'],offset)
   def __call__(self,m):
     self.decode(m)
   def __str__(self):
     return '\n'.join([datetime.datetime.utcfromtimestamp(p['ts']).isoformat()+' | G: '+' '.join([str(p[n]) for n in self.packets.dtype.names if not n=='ts' ]) for p in self.packets])
 
+class GMPeakBatch(object):
+  '''Decode a batch of raw gmpeak frames into one preallocated native-endian structured array.
+     packets returned by decode are a view on the internal buffer and are valid until the next call.
+     out is an array of GMPeaknativetype to decode into (e.g. a GMPeakPool slot). it is not grown.'''
+  def __init__(self,size=4096,out=None):
+    self.fixed = out is not None
+    self.buffer = out if self.fixed else zeros(size,dtype=GMPeaknativetype)
+  def decode(self,frames):
+    '''decode a list of raw gmpeak frames.
+       returns packets, offsets where packets[offsets[i]:offsets[i+1]] came from frames[i],
+       and the sorted indices of frames that could not be decoded (their packets are not valid)'''
+    failed = []
+    counts = []
+    for i,m in enumerate(frames):
+      try:
+        n = _npacketsfmt.unpack_from(m,_npacketsoffset)[0]
+      except struct.error: # shorter than a header
+        n = -1
+      if n<0:
+        failed.append(i)
+        n = 0
+      counts.append(n)
+    offsets = zeros(len(frames)+1,dtype=int)
+    offsets[1:] = counts
+    offsets = offsets.cumsum()
+    if offsets[-1]>len(self.buffer): # grow the buffer to fit the batch
+      if self.fixed: raise ValueError('%d packets do not fit a buffer of %d'%(offsets[-1],len(self.buffer)))
+      self.buffer = zeros(max(offsets[-1],2*len(self.buffer)),dtype=GMPeaknativetype)
+    start = GMPeakheadertype.itemsize+1
+    for i,m in enumerate(frames):
+      a,b = offsets[i],offsets[i+1]
+      if a==b: continue
+      try:
+        try:
+          data = _zlibproto.copy().decompress(buffer(m,start))
+          self.buffer[a:b] = frombuffer(data,GMPeakdatatype,b-a) # byte swapping is done on assignment
+        except zlib.error:
+          self.buffer[a:b] = frombuffer(m,GMPeakdatatype,b-a,start)
+      except ValueError: # fewer packets than the header says
+        failed.append(i)
+    return self.buffer[:offsets[-1]],offsets,sorted(failed)
+  def records(self,frames):
+    'GMPeak records of a list of raw gmpeak frames, None for frames that could not be decoded'
+    packets,offsets,failed = self.decode(frames)
+    return _gmpeakrecords(frames,packets.copy(),offsets,failed) # the buffer is reused by the next batch
+  def __call__(self,frames):
+    return self.decode(frames)
+
+def _gmpeakrecords(frames,packets,offsets,failed=()):
+  'GMPeak records of frames whose packets are packets[offsets[i]:offsets[i+1]]. None for failed frames'
+  records = []
+  for i,m in enumerate(frames):
+    if i in failed:
+      records.append(None)
+      continue
+    g = GMPeak()
+    g.raw = m
+    g.header = frombuffer(m,GMPeakheadertype,1)
+    g.packets = packets[offsets[i]:offsets[i+1]]
+    records.append(g)
+  return records
+
 class TrigParam(object):
+  __slots__ = ('raw','header','packets')
+  type = 'P'
+  headertype = TrigParamheadertype
+  trigvaluestype = TrigParamvaluestype
+  rawtype = TrigParamrawtype
+  datatype = TrigParamdatatype
   def __init__(self,m=None):
-    self.type='P'
-    # see data structure in TrigParams.h
-    self.headertype = dtype([('type', 'S1'),('version','>i4'), ('source', 'S20'), ('id', '>i4'), ('npackets', '>i4')])
-    self.trigvaluestype = dtype([('tauP','>f4'),('tauPsnr','>f4'),('ttime','>i4'),('d','>f4'),('dsnr','>f4'),('dtime','>i4'),('v','>f4'),('vsnr','>f4'),('vtime','>i4'),('a','>f4'),('asnr','>f4'),('atime','>i4')])
-    self.rawtype = dtype([('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8')\
-                           ,('sec', '>i4'),('msec','>i4'), ('packlength', '>i4')\
-                           ,('recent_sample', '>i4'),('samplerate', '>f4'),('toffset', '>f4'),('arrtime', '>f8')\
-                           ,('protime', '>f4'),('fndtime', '>f4'),('quetime', '>f4'),('sndtime', '>f4')\
-                           ,('trigvalues',self.trigvaluestype,10)])
-    self.datatype = dtype([('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8')\
-						   ,('ts', datetime.datetime),('msec','>i4'),('packlength', '>i4')\
-                           ,('recent_sample', '>i4'),('samplerate', '>f4'),('toffset', '>f4'),('arrtime', '>f8')\
-                           ,('protime', '>f4'),('fndtime', '>f4'),('quetime', '>f4'),('sndtime', '>f4')\
-                           ,('trigvalues',self.trigvaluestype,10)])
-    self.header = array([],dtype=self.headertype)
-    self.packets= array([],dtype=self.datatype)
+    self.raw = None
+    self.header = None
+    self.packets = None
     if m: self.decode(m)
   def decode(self,m):
     self.raw=m
     header = frombuffer(m,self.headertype,1)
-    data = zlib.decompress(m[self.headertype.itemsize+1:])
+    data = zlib.decompress(buffer(m,self.headertype.itemsize+1))
     self.header = header
-    packets = frombuffer(data,self.rawtype,header['npackets'])
-    names = ' '.join(packets.dtype.names).replace('sec','ts',1).split()
-    packets.dtype.names = names
+    packets = frombuffer(data,_TrigParamtsview,header['npackets'])
     self.packets = packets.astype(self.datatype)
-    self.packets['ts'] = [datetime.datetime.utcfromtimestamp(float('.'.join([str(p['ts']),str(p['msec'])]))) for p in packets]
+    self.packets['ts'] = sec2ts(packets['ts'],packets['msec']) # vectorized. no per packet string formatting
+  def __call__(self,m):
+    self.decode(m)
   def __str__(self):
-    return '\n'.join(['%s | P: %s %s %s %s %f %f %f'% tuple([p['ts'].isoformat()]+[p[i] for i in range(6)]+[p[7]]) +\
+    return '\n'.join(['%s | P: %s %s %s %s %f %f %f'% tuple([p['ts'].astype(datetime.datetime).isoformat()]+[p[i] for i in range(6)]+[p[7]]) +\
       '\n'+'\n'.join(['\t'+' %10.6f'*len(v) % tuple(v) for v in p['trigvalues']]) for p in self.packets])
 
 class Trigger(object):
+  __slots__ = ('raw','packets','sta','chn','net','loc','lat','lon','ts')
+  type = 'T'
+  rawtype = Triggerrawtype
+  datatype = Triggerdatatype
   def __init__(self,m=None):
-    self.type='T'
+    self.raw = None
+    self.packets = None
     self.sta=''
     self.chn=''
     self.net=''
@@ -100,18 +200,15 @@ class Trigger(object):
     self.lat=0.0
     self.lon=0.0
     self.ts=datetime.datetime.min
-    self.rawtype = dtype([('type', 'S1'),('version','>i4'), ('source', 'S20'), ('id', '>i4'), ('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8'), ('sec', '>i4'), ('msec', '>i4')])
-    self.datatype = dtype([('sta', 'S5'), ('chn', 'S4'), ('net', 'S3'), ('loc', 'S3'), ('lat', '>f8'), ('lon', '>f8'), ('ts', datetime.datetime)])
     if m: self.decode(m)
   def decode(self,m):
     self.raw=m
     data = frombuffer(m,self.rawtype,1)
-    ts = float('.'.join([data['sec'].astype(str)[0], data['msec'].astype(str)[0]]))
-    self.packets = array(zeros(len(data)),dtype=self.datatype)
+    self.packets = zeros(len(data),dtype=self.datatype)
     for k in self.datatype.names:
       if k in self.rawtype.names:
-        self.packets[k] = data[k] 
-    self.packets['ts'] = datetime.datetime.utcfromtimestamp(ts)
+        self.packets[k] = data[k]
+    self.packets['ts'] = sec2ts(data['sec'],data['msec']).astype(datetime.datetime)
     self.sta= self.packets['sta'][0]
     self.chn= self.packets['chn'][0]
     self.net= self.packets['net'][0]
@@ -125,19 +222,70 @@ class Trigger(object):
     return self.ts.isoformat()+' | T: '+' '.join(['',self.net,self.sta,self.loc,self.chn,str(self.lat),str(self.lon)])
 
 class RawData(object):
+  __slots__ = ('raw',)
+  type = 'D'
+  headertype = RawDataheadertype
   def __init__(self,m=None):
-    self.type='D'
-    self.headertype = dtype([('type', 'S1'),('version','>i4'), ('source', 'S20'), ('id', '>i4'), ('npackets', '>i4')])
+    self.raw = None
     if m: self.decode(m)
   def decode(self,m):
     self.raw=m
     pass
+  def __call__(self,m):
+    self.decode(m)
   def __str__(self):
     return 'Data packets are not supported at this version'
 
+class _coreInfoDone(Exception):
+  'raised by coreInfoParser to stop parsing once core_info is closed'
+  pass
+
+class coreInfoParser(object):
+  '''Single pass expat parser for event messages.
+     collects the event_message attributes and the first value of each core_info field,
+     and stops as soon as core_info is closed.'''
+  fields = ('mag','lat','lon','depth','orig_time')
+  def __init__(self,m=None):
+    self.attributes = {} # event_message attributes
+    self.values = {} # core_info values as text
+    self.Eid = None
+    self.magU = None
+    self._tag = None # field we are collecting text for
+    self._text = []
+    if m: self.parse(m)
+  def parse(self,m):
+    p = expat.ParserCreate()
+    p.buffer_text = True
+    p.StartElementHandler = self.start
+    p.EndElementHandler = self.end
+    p.CharacterDataHandler = self.data
+    try:
+      p.Parse(m,True)
+    except _coreInfoDone:
+      pass
+  def start(self,name,attrs):
+    if name=='event_message':
+      self.attributes = attrs
+    elif name=='core_info' and self.Eid is None:
+      self.Eid = attrs['id']
+    elif name in self.fields and not name in self.values:
+      if name=='mag': self.magU = attrs['units']
+      self._tag = name
+      self._text = []
+  def end(self,name):
+    if name==self._tag:
+      self.values[name] = ''.join(self._text)
+      self._tag = None
+    elif name=='core_info':
+      raise _coreInfoDone
+  def data(self,d):
+    if self._tag: self._text.append(d)
+
 class algXML(object):
+  __slots__ = ('raw','Eid','msgorigsys','msgtime','msgtype','lat','lon','depth','orig_time','mag','magU',
+               'intensity','dist','azimuth','point') # the last ones are set by the viewer (see ElViS.processEvent)
+  type = 'X'
   def __init__(self,m=None):
-    self.type='X'
     self.lat=0.0
     self.lon=0.0
     self.depth=0.0
@@ -151,6 +299,21 @@ class algXML(object):
     self.magU = None
     if m: self.decode(m)
   def decode(self,m):
+    self.raw = m
+    p = coreInfoParser(m)
+    em = p.attributes
+    self.Eid=p.Eid
+    self.msgorigsys=em['orig_sys']
+    self.msgtime=datetime.datetime.strptime(em['timestamp'],'%Y-%m-%dT%H:%M:%S.%fZ')
+    self.msgtype=em['message_type']
+    self.lat=float(p.values['lat'])
+    self.lon=float(p.values['lon'])
+    self.depth=float(p.values['depth'])
+    self.orig_time=datetime.datetime.strptime(p.values['orig_time'],'%Y-%m-%dT%H:%M:%S.%fZ')
+    self.mag=float(p.values['mag'])
+    self.magU=p.magU
+  def decode_dom(self,m):
+    'decode using a full minidom DOM. slower, kept for reference and benchmarking.'
     self.raw = m
     xmldoc=minidom.parseString(m)
     em = xmldoc.getElementsByTagName('event_message')[0]
@@ -169,12 +332,777 @@ class algXML(object):
   def __str__(self):
     return '%s | E: %s (%s - %s) %f %f %f %f%s (%f)'%(self.orig_time.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),self.Eid,self.msgorigsys,self.msgtype,self.lat,self.lon,self.depth,self.mag,self.magU,(self.msgtime-self.orig_time).total_seconds())
 
+# process pool decoding of gmpeak frames
+def _gmpeakworker(tasks,results,inputs,buffers):
+  '''decode chunks of gmpeak frames from shared memory input slots into shared memory packet slots with GMPeakBatch.
+     runs in a pool process. replies 'K' and the packet offsets and failed frames (int32), or 'E' and an error'''
+  batchers = [GMPeakBatch(out=frombuffer(b,GMPeaknativetype)) for b in buffers] # decode straight into the slots
+  while True:
+    task = tasks.get()
+    if task is None: return
+    slot,lengths = task
+    frames = []
+    start = 0
+    for length in lengths:
+      frames.append(buffer(inputs[slot],start,length)) # the raw frames. not copied
+      start += length
+    try:
+      packets,offsets,failed = batchers[slot].decode(frames)
+      results[slot].send_bytes('K'+array(offsets.tolist()+failed,dtype='i4').tostring())
+    except Exception,msg:
+      results[slot].send_bytes('E'+(str(msg) or type(msg).__name__))
+
+class GMPeakPool(object):
+  '''Decode gmpeak frames in worker processes so zlib and array decoding don't hold this process GIL.
+     raw frames are passed to the processes and packets come back in shared memory slots
+     (native byte order, see GMPeaknativetype), not pickled. decodebatch splits a batch of frames
+     into about one chunk per process, submits all chunks and collects them in order, so all processes
+     decode at once. a slot holds a chunk of up to slotsize packets and maxframe bytes, larger frames are
+     left to the caller. use() tells if the gmpeak rate is high enough to use the pool:
+     it is switched on above rate frames per second and off below half of it.
+     a chunk not decoded within timeout seconds (a dead or stuck process) is left to the caller and its
+     slot is retired, since a late result could still land in it. the pool is disabled once all
+     processes died or all slots were retired.
+     processes are started here, so create the pool before starting other threads.'''
+  def __init__(self,processes=2,rate=200.0,slots=16,slotsize=4096,timeout=1.0):
+    self.rate = rate
+    self.timeout = timeout
+    self.slotsize = slotsize
+    self.maxframe = GMPeakheadertype.itemsize+1+slotsize*GMPeakdatatype.itemsize+1024 # uncompressed frames, or poorly compressed ones
+    self.inputs = [sharedctypes.RawArray('c',self.maxframe) for i in range(slots)] # raw frames
+    self._inputs = [frombuffer(b,'u1') for b in self.inputs] # copying a frame through numpy is a memcpy. ctypes copies byte by byte
+    self.buffers = [sharedctypes.RawArray('c',slotsize*GMPeaknativetype.itemsize) for i in range(slots)] # decoded packets
+    self.slots = [frombuffer(b,GMPeaknativetype) for b in self.buffers]
+    self.tasks = SimpleQueue() # (slot,frame lengths) and None to stop
+    pipes = [multiprocessing.Pipe(False) for i in range(slots)]
+    self.results = [r for r,w in pipes] # packet offsets of the frames decoded into a slot, or an error message
+    self.free = Queue.Queue() # free slot numbers
+    [self.free.put(i) for i in range(slots)]
+    self.processes = [multiprocessing.Process(target=_gmpeakworker,args=(self.tasks,[w for r,w in pipes],self.inputs,self.buffers),name='gmpeak-decoder-%d'%i) for i in range(processes)]
+    for p in self.processes:
+      p.daemon = True
+      p.start()
+    self.active = False # decoding in the pool
+    self.lock = threading.Lock()
+    self._count = 0 # frames in the current rate window
+    self._t0 = time.time() # start of the current rate window
+    self.currentrate = 0.0 # gmpeak frames per second in the last window
+    self.decoded = 0 # frames decoded by the pool
+    self.switches = 0 # times the pool was switched on or off
+    self.failures = 0 # chunks the processes failed to return in time
+    self.retired = set() # slots not used again after a failure
+    self.disabled = False # no process or slot left
+
+  def use(self,window=1.0,n=1):
+    'count n gmpeak frames. True if they should be decoded by the pool'
+    if self.disabled: return False
+    with self.lock:
+      self._count += n
+      t = time.time()
+      if t-self._t0>=window:
+        self.currentrate = self._count/(t-self._t0)
+        self._count = 0
+        self._t0 = t
+        active = self.currentrate>self.rate if not self.active else self.currentrate>self.rate/2.0
+        if active!=self.active:
+          self.active = active
+          self.switches += 1
+      return self.active
+
+  def decode(self,m):
+    'a GMPeak record of a raw gmpeak frame, decoded by a pool process or here if the pool fails'
+    g = self.decodebatch([m])[0]
+    return g if g is not None else GMPeak(m)
+
+  def decodebatch(self,frames):
+    '''GMPeak records of raw gmpeak frames, in order, decoded by all pool processes at once.
+       None for a frame the pool did not decode (bad, too large or the pool failed). decode it with GMPeak'''
+    records = [None]*len(frames)
+    if self.disabled: return records
+    inflight = deque() # (slot,chunk) submitted, oldest first
+    for chunk in self._chunks(frames):
+      slot = self._slot(frames,inflight,records)
+      if slot is None: break # slots are stuck. the rest is left to the caller
+      start = 0
+      for i in chunk:
+        m = frames[i]
+        self._inputs[slot][start:start+len(m)] = frombuffer(m,'u1')
+        start += len(m)
+      self.tasks.put((slot,[len(frames[i]) for i in chunk]))
+      inflight.append((slot,chunk))
+    while inflight: self._collect(frames,inflight.popleft(),records)
+    return records
+
+  def _chunks(self,frames):
+    'frame indices in chunks that fit a slot, about one chunk per process. frames larger than a slot are left out'
+    size = max(1,-(-len(frames)//len(self.processes))) # frames per chunk
+    chunks,chunk,nbytes,npackets = [],[],0,0
+    for i,m in enumerate(frames):
+      try:
+        n = max(0,_npacketsfmt.unpack_from(m,_npacketsoffset)[0])
+      except struct.error:
+        n = 0 # GMPeakBatch reports it as failed
+      if len(m)>self.maxframe or n>self.slotsize: continue
+      if chunk and (len(chunk)>=size or nbytes+len(m)>self.maxframe or npackets+n>self.slotsize):
+        chunks.append(chunk)
+        chunk,nbytes,npackets = [],0,0
+      chunk.append(i)
+      nbytes += len(m)
+      npackets += n
+    if chunk: chunks.append(chunk)
+    return chunks
+
+  def _slot(self,frames,inflight,records):
+    'a free slot. collects the oldest submitted chunk while none is free. None if slots are stuck'
+    while True:
+      try:
+        return self.free.get_nowait()
+      except Queue.Empty:
+        if not inflight: break
+        self._collect(frames,inflight.popleft(),records)
+    try:
+      return self.free.get(timeout=self.timeout)
+    except Queue.Empty:
+      return None
+
+  def _collect(self,frames,(slot,chunk),records):
+    'wait for the records of a submitted chunk'
+    try:
+      if not self.results[slot].poll(self.timeout): raise EOFError('no result in %g s'%self.timeout)
+      result = self.results[slot].recv_bytes()
+    except (EOFError,IOError): # the process died or is stuck
+      self._retire(slot)
+      return
+    try:
+      if result[:1]!='K': return # should not happen. the chunk is left to the caller
+      reply = frombuffer(result,'i4',offset=1)
+      offsets,failed = reply[:len(chunk)+1],reply[len(chunk)+1:].tolist()
+      packets = self.slots[slot][:offsets[-1]].copy() # the slot is reused once freed
+      for i,g in zip(chunk,_gmpeakrecords([frames[i] for i in chunk],packets,offsets,failed)): records[i] = g
+      self.decoded += len(chunk)-len(failed)
+    finally:
+      self.free.put(slot)
+
+  def _retire(self,slot):
+    'stop using a slot that failed. disable the pool if no process or slot is left'
+    with self.lock:
+      self.failures += 1
+      self.retired.add(slot)
+      if len(self.retired)==len(self.slots) or not any([p.is_alive() for p in self.processes]):
+        self.disabled = True
+        self.active = False
+    print >> sys.stderr,'gmpeak decoding process failed (slot %d). %s'%(slot,'pool disabled' if self.disabled else '%d slots left'%(len(self.slots)-len(self.retired)))
+
+  def close(self):
+    'stop the pool processes'
+    self.disabled = True
+    for p in self.processes: self.tasks.put(None)
+    for p in self.processes: p.join(1)
+
+# decoders registry. first byte of a message -> record class decoding it
+decoders = {
+            'T':Trigger,
+            'G':GMPeak,
+            'P':TrigParam,
+            'D':RawData,
+            '<':algXML
+           }
+
+def register_decoder(key,cls):
+  'register a record class for messages starting with key. cls(m) should return a decoded record.'
+  decoders[key] = cls
+
+def decode(m):
+  'decode a raw message using the decoders registry. raises KeyError for unknown messages.'
+  return decoders[m[0]](m)
+
+# index of the binary triggers log (see triglog.py). one entry per station per frame.
+TRIGINDEXtype = dtype([('offset','<i8'), # file offset of the frame length prefix
+                       ('length','<i4'), # frame length (without the prefix)
+                       ('type','S1'), # frame type (T or P)
+                       ('station','S12'), # net.sta
+                       ('ts','<f8')]) # packet time stamp (seconds since epoch)
+
+def indexframe(m,offset=0):
+  'index entries of a raw trigger (T) or trigger parameters (P) frame stored at offset'
+  if m[:1]=='T':
+    packets = frombuffer(m,Triggerrawtype,1)
+  elif m[:1]=='P':
+    packets = frombuffer(zlib.decompress(buffer(m,HEADERtype.itemsize+1)),TrigParamrawtype,_npacketsfmt.unpack_from(m,_npacketsoffset)[0])
+  else:
+    return zeros(0,TRIGINDEXtype)
+  index = zeros(len(packets),TRIGINDEXtype)
+  index['offset'] = offset
+  index['length'] = len(m)
+  index['type'] = m[0]
+  index['station'] = [n+'.'+s for n,s in zip(packets['net'],packets['sta'])]
+  index['ts'] = packets['sec']+packets['msec']/1000.0
+  return index
+
+def skipentry(offset,length):
+  '''an index entry (empty type and station) covering a frame at offset that has no entries (bad or not T/P).
+     keeps the index contiguous from the log start, so readers don't rebuild it'''
+  index = zeros(1,TRIGINDEXtype)
+  index['offset'] = offset
+  index['length'] = length
+  index['ts'] = nan
+  return index
+
+# coalescing of ground motion peaks
+class PeakCoalescer(object):
+  '''Collect gmpeak values per station between consumer ticks.
+     mode 'max' keeps the maximal absolute amax/vmax/dmax of each channel seen since the last pop,
+     mode 'latest' keeps the values of the newest packet of each channel.
+     pop returns one entry per station no matter how many messages arrived.
+     received and decoded stamps (see LatencyMonitor) of the oldest message of each station are kept too.
+     with a station index (see stations.StationIndex) packets of unknown stations are ignored, and in
+     'max' mode the packets of a message are mapped to stations and coalesced in a few vectorized steps.'''
+  modes = ('max','latest')
+  values = ('amax','vmax','dmax')
+  def __init__(self,mode='max',index=None):
+    if not mode in self.modes: raise ValueError('Unknown coalescing mode: %s'%mode)
+    self.mode = mode
+    self.lock = threading.Lock()
+    self.pending = {} # net.sta -> {loc.chn: [amax,vmax,dmax,ts]}
+    self.stamps = {} # net.sta -> (received,decoded) of the oldest pending message
+    self.received = 0 # packets added
+    self.setindex(index)
+  def setindex(self,index):
+    'use a new station index (or None). pending peaks are discarded'
+    with self.lock:
+      self.index = index
+      self.pending = {}
+      self.stamps = {}
+      n = len(index) if index is not None else 0
+      self.peaks = zeros((n,4)) # amax,vmax,dmax,ts per station record ('max' mode with an index)
+      self.touched = zeros(n,dtype=bool) # records with pending peaks
+      self.rxstamps = empty((n,2)) # received,decoded of the oldest pending message per record
+      self.rxstamps.fill(nan)
+  def add(self,packets,received=None,decoded=None):
+    '''add gmpeak packets (a GMPeak packets structured array) of a message received and decoded at the given times.
+       packets looked up in an index replaced meanwhile (see setindex) are discarded like pending peaks'''
+    index = self.index # setindex may replace it and the arrays, see _addmax
+    if index is not None:
+      records = index.lookup(packets['net'],packets['sta']) # one lookup for all packets
+      known = records>=0
+      if not known.all():
+        packets,records = packets[known],records[known]
+      if self.mode=='max': return self._addmax(packets,records,received,decoded,index)
+    rows = zip(packets['net'],packets['sta'],packets['loc'],packets['chn'],
+               abs(packets['amax']),abs(packets['vmax']),abs(packets['dmax']),packets['ts'])
+    latest = self.mode=='latest'
+    with self.lock:
+      self.received += len(rows)
+      for net,sta,loc,chn,a,v,d,ts in rows:
+        station = net+'.'+sta
+        channels = self.pending.get(station)
+        if channels is None:
+          channels = self.pending[station] = {}
+          if received is not None: self.stamps[station] = (received,decoded)
+        chan = loc+'.'+chn
+        old = channels.get(chan)
+        if old is None or (latest and ts>=old[3]):
+          channels[chan] = [a,v,d,ts]
+        elif not latest:
+          old[0] = max(old[0],a)
+          old[1] = max(old[1],v)
+          old[2] = max(old[2],d)
+          old[3] = max(old[3],ts)
+  def _addmax(self,packets,records,received,decoded,index):
+    'coalesce packets of known station records of index: the maximum per record in one reduction'
+    if not len(records): return
+    order = argsort(records,kind='mergesort')
+    records = records[order]
+    starts = flatnonzero(records[1:]!=records[:-1])+1
+    starts = array([0]+starts.tolist())
+    vals = column_stack([abs(packets['amax'][order]),abs(packets['vmax'][order]),abs(packets['dmax'][order]),packets['ts'][order]])
+    peaks = maximum.reduceat(vals,starts,axis=0) # per station maximum of this message
+    records = records[starts]
+    with self.lock:
+      if index is not self.index: return # the records are not rows of the current arrays
+      self.received += len(order)
+      new = records[~self.touched[records]]
+      self.peaks[new] = -inf
+      self.touched[new] = True
+      if received is not None: self.rxstamps[new] = (received,decoded)
+      self.peaks[records] = maximum(self.peaks[records],peaks)
+  def pop(self):
+    '''return and clear the pending batch:
+       {net.sta: {'amax':..,'vmax':..,'dmax':..,'ts':..}} with the maximum over channels
+       and 'received' and 'decoded' stamps if they were given'''
+    with self.lock:
+      index = self.index
+      pending = self.pending
+      stamps = self.stamps
+      self.pending = {}
+      self.stamps = {}
+      records = flatnonzero(self.touched)
+      if len(records):
+        peaks,rxstamps = self.peaks[records],self.rxstamps[records]
+        self.touched[records] = False
+        self.rxstamps[records] = nan
+    batch = {}
+    for i,p,(rx,dc) in (zip(records,peaks.tolist(),rxstamps.tolist()) if len(records) else []):
+      batch[index.ids[i]] = entry = dict(zip(self.values+('ts',),p))
+      if not isnan(rx): entry['received'],entry['decoded'] = rx,dc
+    for station,channels in pending.items():
+      vals = zip(*channels.values())
+      batch[station] = dict(zip(self.values+('ts',),[max(v) for v in vals]))
+      if station in stamps: batch[station]['received'],batch[station]['decoded'] = stamps[station]
+    return batch
+  def __len__(self):
+    return len(self.pending)+int(self.touched.sum())
+
+# end to end latency of the message path
+def _epoch(t):
+  'seconds since epoch of a datetime or a datetime64 array'
+  if isinstance(t,datetime.datetime): return calendar.timegm(t.utctimetuple())+t.microsecond/1e6
+  return t.astype('M8[us]').astype('i8')/1e6
+
+def _sources(message):
+  '''(stations,source times,reported latencies) of a decoded message.
+     source time is the time stamp the message carries: gmpeak sample time, trigger time or alert time.
+     reported latency is the upstream delay the sender reports: gmpeak latency, trigger parameters sndtime.
+     stations of packet messages are the (net,sta) arrays, see _stationnames.'''
+  t = message.type
+  if t=='G':
+    p = message.packets
+    return (p['net'],p['sta']),p['ts'],p['latency']
+  if t=='P':
+    p = message.packets
+    return (p['net'],p['sta']),_epoch(p['ts']),p['sndtime']
+  if t=='T':
+    return [message.net+'.'+message.sta],[_epoch(message.ts)],None
+  if t=='X':
+    return [None],[_epoch(message.msgtime)],None
+  return [],[],None
+
+def _stationnames(stations):
+  'station names (net.sta) of a list of names or a (net,sta) pair of arrays'
+  if isinstance(stations,tuple): return [n+'.'+s for n,s in zip(*stations)]
+  return stations
+
+class LatencyMonitor(object):
+  '''Rolling latency histograms of the message path, per message type and per station.
+     a message is stamped when received, decoded, applied by the viewer and drawn on screen. stages:
+       'source' - source time stamp carried by the message to receive (clock offsets included)
+       'reported' - upstream latency reported inside the message (gmpeak latency, trigger parameters sndtime)
+       'origin' - event origin time to receive (event messages)
+       'decode' - receive to decoded (queueing and decoding)
+       'apply' - decoded to applied by the viewer (coalescing included)
+       'draw' - applied to drawn on screen
+       'console' - receive to drawn. the delay added by the console
+     each type keeps the last window samples of a stage, each station the last stationwindow samples.
+     source and reported stages of a type get one sample per message: the median over its stations.
+     station samples are queued as arrays and sorted into the stations off the decoding threads, by a
+     thread every sortinterval seconds (None to not start it) and when read (samples, keys, summary).
+     up to maxunsorted samples are queued. older ones are dropped (counted in stationdropped).'''
+  stages = ('source','reported','origin','decode','apply','draw','console')
+  bins = logspace(-4,4,81) # 0.1 ms to 10000 s, 10 bins per decade
+  def __init__(self,window=10000,stationwindow=500,source=True,stations=True,sortinterval=1.0,maxunsorted=1000000):
+    self.window = window
+    self.stationwindow = stationwindow
+    self.maxunsorted = maxunsorted
+    self.source = source # record source stages. off when replaying logs
+    self.stations = stations # keep per station samples
+    self.types = {} # (type,stage) -> deque of seconds
+    self.bystation = {} # (station,stage) -> deque of seconds
+    self.unsorted = deque() # (stage,stations,seconds) not in bystation yet
+    self.unsortedsamples = 0 # samples in unsorted
+    self.stationdropped = 0 # station samples dropped before they were sorted
+    self.pending = [] # (type,stations,received,applied) waiting for the next draw
+    self.lock = threading.Lock()
+    self.sortlock = threading.Lock()
+    self._stop = threading.Event()
+    if sortinterval:
+      self.thread = threading.Thread(target=self._run,args=(sortinterval,),name='latency-sorter')
+      self.thread.daemon = True
+      self.thread.start()
+  def _run(self,interval):
+    while not self._stop.wait(interval): self.sortstations()
+  def close(self):
+    'stop the sorting thread'
+    self._stop.set()
+  def _queue(self,stage,stations,dt):
+    'queue station samples for sortstations, dropping the oldest beyond maxunsorted. called holding lock'
+    self.unsorted.append((stage,stations,dt))
+    self.unsortedsamples += len(dt)
+    while self.unsortedsamples>self.maxunsorted and len(self.unsorted)>1:
+      n = len(self.unsorted.popleft()[2])
+      self.unsortedsamples -= n
+      self.stationdropped += n
+  def add(self,type,stage,dt,station=None):
+    '''add latency samples (a number or a list of seconds). station may be a list matching dt.
+       per station samples are only queued here, see sortstations'''
+    if not isinstance(dt,list): dt,station = [dt],[station]
+    with self.lock:
+      q = self.types.get((type,stage))
+      if q is None: q = self.types[(type,stage)] = deque(maxlen=self.window)
+      q.extend(dt)
+      if self.stations and station is not None: self._queue(stage,station,dt)
+  def sortstations(self):
+    'move queued station samples into the per station histograms'
+    with self.sortlock: # one sorter at a time keeps the samples in order
+      with self.lock:
+        unsorted = self.unsorted
+        self.unsorted = deque()
+        self.unsortedsamples = 0
+      grouped = {} # (station,stage) -> samples. grouped without the lock so decoding is not blocked
+      for stage,stations,dt in unsorted:
+        if hasattr(dt,'tolist'): dt = dt.tolist()
+        for sta,d in zip(_stationnames(stations),dt):
+          if sta is None: continue
+          g = grouped.get((sta,stage))
+          if g is None: g = grouped[(sta,stage)] = []
+          g.append(d)
+      with self.lock:
+        for key,v in grouped.iteritems():
+          q = self.bystation.get(key)
+          if q is None: q = self.bystation[key] = deque(maxlen=self.stationwindow)
+          q.extend(v)
+  def _addstations(self,type,stage,dt,stations):
+    'one sample per message (the median of dt) for the type, all of dt for the stations'
+    with self.lock:
+      q = self.types.get((type,stage))
+      if q is None: q = self.types[(type,stage)] = deque(maxlen=self.window)
+      q.append(float(median(dt)))
+      if self.stations: self._queue(stage,stations,dt)
+  def decoded(self,message,received,decoded):
+    'stamp a decoded message. called by AMQListener'
+    t = message.type
+    self.add(t,'decode',decoded-received)
+    if not self.source: return
+    stations,sources,reported = _sources(message)
+    if not len(sources): return
+    self._addstations(t,'source',received-asarray(sources,dtype=float),stations)
+    if reported is not None: self._addstations(t,'reported',asarray(reported,dtype=float),stations)
+    if t=='X': self.add(t,'origin',received-_epoch(message.orig_time))
+  def applied(self,type,received,decoded,stations=None,applied=None):
+    '''stamp a message (or coalesced messages) applied by the viewer at time applied (default now).
+       drawn stamps it as drawn.'''
+    applied = applied or time.time()
+    if stations: self.add(type,'apply',[applied-decoded]*len(stations),stations) # one sample per station
+    else: self.add(type,'apply',applied-decoded)
+    with self.lock:
+      self.pending.append((type,stations,received,applied))
+  def drawn(self,t=None):
+    'stamp everything applied since the last call as drawn. call after the canvas was drawn'
+    t = t or time.time()
+    with self.lock:
+      pending = self.pending
+      self.pending = []
+    for type,stations,received,applied in pending:
+      if stations:
+        self.add(type,'draw',[t-applied]*len(stations),stations)
+        self.add(type,'console',[t-received]*len(stations),stations)
+      else:
+        self.add(type,'draw',t-applied)
+        self.add(type,'console',t-received)
+  def samples(self,stage,type=None,station=None):
+    'recent samples (seconds) of a stage, of a message type, a station or all types'
+    if station: self.sortstations()
+    with self.lock:
+      if station: return list(self.bystation.get((station,stage),[]))
+      if type: return list(self.types.get((type,stage),[]))
+      return sum([list(v) for (t,s),v in self.types.items() if s==stage],[])
+  def histogram(self,stage,type=None,station=None):
+    '(counts,bins) of a stage. samples out of the bins range are counted in the first or last bin'
+    return histogram(clip(self.samples(stage,type,station),self.bins[0],self.bins[-1]),self.bins)
+  def keys(self):
+    'sorted ([(type,stage)],[(station,stage)]) with samples'
+    order = lambda k: (k[0],self.stages.index(k[1]))
+    self.sortstations()
+    with self.lock:
+      return sorted(self.types,key=order),sorted(self.bystation,key=order)
+  def summary(self,types=True,stations=False):
+    'rows of (type or station,stage,n,p50,p90,p99,max) in seconds'
+    bytype,bystation = self.keys()
+    rows = []
+    for keys,arg in ((bytype if types else [],'type'),(bystation if stations else [],'station')):
+      for key,stage in keys:
+        v = self.samples(stage,**{arg:key})
+        if not v: continue
+        p50,p90,p99 = percentile(v,[50,90,99])
+        rows.append((key,stage,len(v),p50,p90,p99,max(v)))
+    return rows
+  def report(self,stations=False):
+    'the summary as a text table in milliseconds'
+    lines = ['%-14s %-9s %7s %10s %10s %10s %10s'%('type/station','stage','n','p50[ms]','p90[ms]','p99[ms]','max[ms]')]
+    for key,stage,n,p50,p90,p99,mx in self.summary(True,stations):
+      lines.append('%-14s %-9s %7d %10.2f %10.2f %10.2f %10.2f'%(key,stage,n,p50*1e3,p90*1e3,p99*1e3,mx*1e3))
+    return '\n'.join(lines)
+  def export(self,path):
+    'write the summary of all types and stations and their histograms to a text file'
+    types,bystation = self.keys()
+    with open(path,'w') as f:
+      f.write('# ElViS latency report %sZ\n'%_msec(datetime.datetime.utcnow()))
+      f.write('\n'.join(['# '+l for l in self.report(True).split('\n')])+'\n')
+      f.write('# histograms. bin edges [s]:\n# %s\n'%' '.join(['%g'%b for b in self.bins]))
+      for keys,arg in ((types,'type'),(bystation,'station')):
+        for key,stage in keys:
+          counts,bins = self.histogram(stage,**{arg:key})
+          f.write('%s %s %s %s\n'%(arg,key,stage,' '.join([str(c) for c in counts])))
+  def clear(self):
+    with self.lock:
+      self.types = {}
+      self.bystation = {}
+      self.unsorted = deque()
+      self.unsortedsamples = 0
+      self.pending = []
+
+# bounded buffer of received messages
+class MessageBuffer(object):
+  '''A bounded ring buffer of received (headers,message) pairs with a sub buffer per topic.
+     the oldest messages are evicted once maxmessages or maxbytes (0 for no limit) is exceeded.
+     a message larger than maxbytes is dropped and not buffered at all.'''
+  def __init__(self,maxmessages=200,maxbytes=0):
+    self.maxmessages = maxmessages
+    self.maxbytes = maxbytes
+    self.topics = {} # destination -> deque of (headers,message), oldest first
+    self._order = deque() # destination of each buffered message, oldest first
+    self.nbytes = 0 # total size of buffered messages
+    self.received = 0 # messages offered to the buffer
+    self.topicreceived = {} # destination -> messages offered to the buffer
+    self.dropped = 0 # messages rejected for being larger than maxbytes
+    self.evicted = 0 # old messages removed to make room for new ones
+    self.lock = threading.Lock()
+  def append(self,headers,message):
+    'add a message. O(1) for any buffer size.'
+    size = len(message)
+    with self.lock:
+      self.received += 1
+      topic = headers.get('destination') if headers else None
+      self.topicreceived[topic] = self.topicreceived.get(topic,0)+1
+      if self.maxbytes and size>self.maxbytes:
+        self.dropped += 1
+        return
+      if not topic in self.topics: self.topics[topic] = deque()
+      self.topics[topic].append((headers,message))
+      self._order.append(topic)
+      self.nbytes += size
+      while len(self._order)>self.maxmessages or (self.maxbytes and self.nbytes>self.maxbytes):
+        self.nbytes -= len(self.topics[self._order.popleft()].popleft()[1])
+        self.evicted += 1
+  def __len__(self):
+    return len(self._order)
+  def __iter__(self):
+    'iterate over a snapshot of buffered messages, oldest first'
+    with self.lock:
+      topics = dict([(k,iter(list(v))) for k,v in self.topics.items()])
+      order = list(self._order)
+    return (topics[t].next() for t in order)
+  def topic(self,destination):
+    'a list of buffered messages of a topic, oldest first'
+    with self.lock:
+      return list(self.topics.get(destination,[]))
+  def last(self):
+    'the last buffered (headers,message) or None'
+    with self.lock:
+      if not self._order: return None
+      return self.topics[self._order[-1]][-1]
+  def clear(self):
+    with self.lock:
+      self.topics = {}
+      self._order.clear()
+      self.nbytes = 0
+
+# queue of raw frames waiting to be decoded
+class MessageQueue(object):
+  '''Raw frames waiting for the decode workers, in priority lanes.
+     a lower lane number is always served first, so event messages are never queued behind peaks.
+     each lane holds up to maxsize frames. on overflow the policy decides:
+       'drop-oldest' - evict the oldest frame of the lane
+       'drop-newest' - reject the new frame
+       'block' - wait for room (backpressure on the receiver)
+     a lane is served by one worker at a time (see done), so frames of a lane are processed in order
+     with any number of workers. drops are reported on stderr at most once per warninterval seconds.'''
+  policies = ('drop-oldest','drop-newest','block')
+  priorities = {'<':0, # event messages (DM/E2 xml)
+                'T':1,'P':1, # triggers and trigger parameters
+                'G':2,'D':2} # peaks and raw data. anything else goes to the last lane too
+  lanenames = ('events','triggers','peaks') # lane names by priority
+  def __init__(self,maxsize=1000,policy='drop-oldest',name='queue',warninterval=10.0):
+    if not policy in self.policies: raise ValueError('Unknown overflow policy: %s'%policy)
+    self.maxsize = maxsize
+    self.policy = policy
+    self.name = name
+    self.warninterval = warninterval
+    self.lanes = [deque() for i in range(max(self.priorities.values())+1)]
+    self.busy = [False]*len(self.lanes) # a worker is processing a frame of the lane
+    self.cond = threading.Condition()
+    self.closed = False
+    self.enqueued = 0 # frames accepted
+    self.dropped = 0 # frames lost to overflow
+    self.lanedropped = [0]*len(self.lanes) # frames lost to overflow in each lane
+    self._warned = 0.0 # time of the last drop warning
+    self._warneddropped = 0 # dropped count at the last drop warning
+  def put(self,m,policy=None,received=None):
+    '''add a frame received at time received. policy overrides the overflow policy for this frame.
+       returns False if it was dropped.'''
+    policy = policy or self.policy
+    i = self.priorities.get(m[:1],len(self.lanes)-1)
+    lane = self.lanes[i]
+    with self.cond:
+      if len(lane)>=self.maxsize:
+        if policy=='drop-newest':
+          self.dropped += 1
+          self.lanedropped[i] += 1
+          self._warn(i)
+          return False
+        elif policy=='drop-oldest':
+          lane.popleft()
+          self.dropped += 1
+          self.lanedropped[i] += 1
+          self._warn(i)
+        else:
+          while len(lane)>=self.maxsize and not self.closed: self.cond.wait()
+      if self.closed: return False
+      lane.append((m,received))
+      self.enqueued += 1
+      self.cond.notify_all()
+      return True
+  def _warn(self,i):
+    'report drops, at most once per warninterval seconds. called holding cond'
+    t = time.time()
+    if t-self._warned<self.warninterval: return
+    print >> sys.stderr,'%s: decoding queue is full, %d frames dropped since the last warning (%d in %s lane, %d in total)'%(self.name,self.dropped-self._warneddropped,self.lanedropped[i],self.lanenames[i],self.dropped)
+    self._warned,self._warneddropped = t,self.dropped
+  def get(self,batch=1):
+    '''wait for the next ([(frame,received),...],lane) by priority. returns None once the queue is closed.
+       up to batch consecutive gmpeak frames of a lane are returned together, other frames one at a time.
+       the lane is not served to other workers until done(lane) is called.'''
+    with self.cond:
+      while not self.closed:
+        for i,lane in enumerate(self.lanes):
+          if lane and not self.busy[i]:
+            frames = [lane.popleft()]
+            if frames[0][0][:1]=='G':
+              while lane and len(frames)<batch and lane[0][0][:1]=='G': frames.append(lane.popleft())
+            self.busy[i] = True
+            self.cond.notify_all() # wake a blocked producer
+            return frames,i
+        self.cond.wait()
+      return None
+  def done(self,i):
+    'the frames of lane i were processed. the lane can be served again'
+    with self.cond:
+      self.busy[i] = False
+      self.cond.notify_all()
+  def depth(self):
+    'number of frames waiting'
+    return sum([len(lane) for lane in self.lanes])
+  def depths(self):
+    'number of frames waiting in each lane'
+    return [len(lane) for lane in self.lanes]
+  def __len__(self):
+    return self.depth()
+  def close(self):
+    'wake up and release all workers and producers'
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+
+# background log writer
+class LogWriter(object):
+  '''Append data to log files from a dedicated thread.
+     writes are buffered in memory and flushed once flushsize bytes are pending or
+     flushinterval seconds passed. with fsync the files are synced once per flush.
+     files are kept open between flushes and closed once they are not written to,
+     so daily files named by UTC date rotate at midnight.'''
+  def __init__(self,flushsize=65536,flushinterval=1.0,fsync=False):
+    self.flushsize = flushsize
+    self.flushinterval = flushinterval
+    self.fsync = fsync
+    self.pending = [] # (path,data,callback) waiting to be written
+    self.pendingbytes = 0
+    self.byteswritten = 0 # bytes written to disk
+    self.flushes = 0 # number of flushes
+    self.errors = 0 # failed writes
+    self.files = {} # open files by path
+    self.cond = threading.Condition()
+    self.closed = False
+    self._forced = False
+    self._busy = False
+    self._lastflush = time.time()
+    self.thread = threading.Thread(target=self._run,name='log-writer')
+    self.thread.daemon = True
+    self.thread.start()
+  def write(self,path,data,callback=None):
+    '''queue data to be appended to path. never touches the disk.
+       callback(path,offset,data) is called by the writer thread once data is written at offset,
+       and may return a list of (path,data) to be written in the same flush (e.g. index entries).'''
+    with self.cond:
+      if self.closed: raise ValueError('LogWriter is closed')
+      self.pending.append((path,data,callback))
+      self.pendingbytes += len(data)
+      if self.pendingbytes>=self.flushsize: self.cond.notify_all()
+  def depth(self):
+    'number of writes waiting to be flushed'
+    return len(self.pending)
+  def flush(self):
+    'flush pending writes now and wait for it'
+    with self.cond:
+      self._forced = True
+      self.cond.notify_all()
+      while (self.pending or self._busy) and self.thread.is_alive(): self.cond.wait(0.1)
+  def close(self):
+    'flush pending writes, close files and stop the thread'
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+    self.thread.join()
+  def _run(self):
+    while True:
+      with self.cond:
+        while not (self.closed or self._forced or self.pendingbytes>=self.flushsize):
+          remaining = self._lastflush+self.flushinterval-time.time()
+          if self.pending and remaining<=0: break
+          self.cond.wait(remaining if self.pending else self.flushinterval)
+        batch = self.pending
+        self.pending = []
+        self.pendingbytes = 0
+        self._forced = False
+        self._busy = True
+        closed = self.closed
+      self._write(batch)
+      with self.cond:
+        self._busy = False
+        self._lastflush = time.time()
+        self.cond.notify_all()
+      if closed:
+        [f.close() for f in self.files.values()]
+        self.files = {}
+        return
+  def _write(self,batch):
+    used = {}
+    for path,data,callback in batch: # batch may grow with callback writes
+      try:
+        f = used.get(path) or self.files.get(path)
+        if not f:
+          f = open(path,'ab')
+          f.seek(0,2) # make tell() report the end of file
+        used[path] = f
+        offset = f.tell()
+        f.write(data)
+        self.byteswritten += len(data)
+        if callback: batch.extend([(p,d,None) for p,d in callback(path,offset,data) or []])
+      except (IOError,OSError):
+        self.errors += 1
+    for f in used.values():
+      try:
+        f.flush()
+        if self.fsync: os.fsync(f.fileno())
+      except (IOError,OSError):
+        self.errors += 1
+    [f.close() for path,f in self.files.items() if not path in used] # close files we are done with (e.g. yesterday's)
+    self.files = used
+    if batch: self.flushes += 1
+
 # listner class for connecting to activeMQ
 class AMQListener(object):
-  def __init__(self,subscribeTo='/topic/eew.sys.dm.data',usr='monitor',passwd='monitor',name='listner',ID=1,verbose=False,log=False,host_and_ports=[('localhost',61613)],**kwargs):
-    self.MESSAGES = []
+  def __init__(self,subscribeTo='/topic/eew.sys.dm.data',usr='monitor',passwd='monitor',name='listner',ID=1,verbose=False,log=False,host_and_ports=[('localhost',61613)],maxmessages=200,maxbytes=0,workers=1,queuesize=1000,overflow='drop-oldest',logwriter=None,trigindex=True,latency=None,pool=None,batch=16,**kwargs):
+    self.MESSAGES = MessageBuffer(maxmessages,maxbytes) # recent messages. see MessageBuffer
     self.SUBSCRIBES = {}
-    self.maxmessages=200
     self.subscribeTo=subscribeTo
     self.name=name
     self.usr=usr
@@ -182,23 +1110,84 @@ class AMQListener(object):
     self.id=ID
     self.logit=log
     self._lastMessage = None
+    self._lastStamps = None # (received,decoded) times of the last message
+    self.latency = latency # a LatencyMonitor stamping decoded messages, or None
+    self.pool = pool # a GMPeakPool decoding gmpeak frames at high rates, or None
+    self.batch = batch # queued gmpeak frames a worker takes at once, so the pool decodes them together
+    self.decoded = {} # message type -> frames decoded
+    self.decodeerrors = 0 # frames that failed to decode
+    self.unknown = 0 # frames of an unknown type
+    self.processerrors = 0 # frames whose processing raised (e.g. in processMessages)
+    self._errorwarned = 0.0 # time of the last processing error report
     self._verbose=verbose
     self.host_and_ports=host_and_ports
-    self._procfuncs = {
-                       'T':Trigger,
-                       'G':GMPeak,
-                       'P':TrigParam,
-                       'D':RawData,
-                       '<':algXML
-                      }
+    self._procfuncs = decoders # shared decoders registry
     self.triglogpath='log/triggers_'
     self.triglogext='.trig'
+    self.trigindexext='.idx' # index file of a triggers log is the log file name + trigindexext
+    self.trigindex=trigindex # index triggers log as it is written
     self.evntlogpath='log/events_'
     self.evntlogext='.log'
+    self.logwriter = logwriter or (LogWriter() if log else None) # writes the logs off the processing path
+    self.queue = MessageQueue(queuesize,overflow,name) # frames waiting for the decode workers
+    self.workers = []
     self.conn = stomp.Connection(host_and_ports=host_and_ports,**kwargs)
     self.conn.set_listener(self.name, self)
     if log and not os.path.exists('log'):
       sys.exit("Can't find logging directory: ./log\nCreate a directory:\nmkdir log")
+    self.startWorkers(workers)
+
+  def startWorkers(self,n=1):
+    '''start n decode worker threads. with no workers frames are processed by the receiver thread.'''
+    for i in range(n):
+      w = threading.Thread(target=self._worker,name='%s-decoder-%d'%(self.name,len(self.workers)))
+      w.daemon = True
+      w.start()
+      self.workers.append(w)
+
+  def stopWorkers(self):
+    'stop decode worker threads. frames still queued are discarded.'
+    self.queue.close()
+    [w.join() for w in self.workers]
+    self.workers = []
+
+  def _worker(self):
+    while True:
+      task = self.queue.get(self.batch)
+      if task is None: return
+      frames,lane = task
+      try:
+        self._processFrames(frames)
+      finally:
+        self.queue.done(lane)
+
+  def _processFrames(self,frames):
+    '''process [(frame,received),...] in order. at high rates their gmpeak frames are decoded
+       by the pool all at once, so all its processes are busy'''
+    records = [None]*len(frames)
+    gmpeaks = [k for k,(m,received) in enumerate(frames) if m[:1]=='G']
+    if gmpeaks and self.pool and self.pool.use(n=len(gmpeaks)):
+      try:
+        for k,g in zip(gmpeaks,self.pool.decodebatch([frames[k][0] for k in gmpeaks])): records[k] = g
+      except Exception: # frames not decoded by the pool are decoded by _processMessages
+        pass
+    for (m,received),message in zip(frames,records): self._process(m,received,message)
+
+  def _process(self,m,received=None,message=None):
+    '''_processMessages that never raises, so one bad frame or a failing processMessages does not stop
+       the worker. errors are counted and reported on stderr at most once per queue warninterval'''
+    try:
+      self._processMessages(m,received,message)
+    except Exception,msg:
+      self.processerrors += 1
+      t = time.time()
+      if self._verbose or t-self._errorwarned>=self.queue.warninterval:
+        self._errorwarned = t
+        print >> sys.stderr,'%s: processing a %s frame failed (%d errors): %s'%(self.name,m[:1] or 'empty',self.processerrors,str(msg) or type(msg).__name__)
+
+  def queueDepth(self):
+    'number of frames waiting to be decoded'
+    return self.queue.depth()
 
   def connectToActiveMQ(self):
     if self._verbose: print >> sys.stderr,self.name+' Trying to Connect to AMQ server'
@@ -215,52 +1204,90 @@ class AMQListener(object):
   def on_error(self, headers, message):
     if self._verbose: print >> sys.stderr,self.name+' received an error %s' % message
 
+  @property
+  def maxmessages(self):
+    return self.MESSAGES.maxmessages
+
+  @maxmessages.setter
+  def maxmessages(self,n):
+    self.MESSAGES.maxmessages = n
+
   def on_message(self, headers, message):
-    self.MESSAGES += [(headers,message)]
-    if len(self.MESSAGES)>self.maxmessages: self.MESSAGES.pop(0)
-    self._processMessages(message)
+    'runs in the receiver thread. only buffers and queues the frame.'
+    received = time.time()
+    self.MESSAGES.append(headers,message)
+    if self.workers:
+      self.queue.put(message,received=received)
+    else:
+      self._processFrames([(message,received)])
+
+  def feed(self,headers,message):
+    'inject a frame as if it was received. waits for room in the decoding queue instead of dropping.'
+    received = time.time()
+    self.MESSAGES.append(headers,message)
+    if self.workers:
+      self.queue.put(message,'block',received)
+    else:
+      self._processFrames([(message,received)])
 
   def processMessages(self):
     'process messages. replace with your own function.'
     pass
 
   def savebin(self,m):
+    'queue a length prefixed raw frame for the daily triggers log'
     ts = datetime.datetime.utcnow().strftime("%Y%m%d")
-    f = open(self.triglogpath+ts+self.triglogext,'ab')
-    l = array([len(m)],dtype='>i4').tostring()
-    f.write(l)
-    f.write(m)
-    f.close()
+    self.logwriter.write(self.triglogpath+ts+self.triglogext,_lengthfmt.pack(len(m))+m,self._indextrig if self.trigindex else None)
+
+  def _indextrig(self,path,offset,data):
+    'LogWriter callback. returns the index entries of a frame written to the triggers log'
+    try:
+      index = indexframe(buffer(data,_lengthfmt.size),offset)
+    except Exception:
+      index = [] # a bad frame is still logged. the reader will skip it
+    if not len(index): index = skipentry(offset,len(data)-_lengthfmt.size)
+    return [(path+self.trigindexext,index.tostring())]
 
   def savetxt(self,m):
+    'queue a time stamped message for the daily events log'
     t = datetime.datetime.utcnow()
-    ts = datetime.datetime.utcnow().strftime("%Y%m%d")
-    f = open(self.evntlogpath+ts+self.evntlogext,'a')
-    print >> f,t.isoformat()[:-3]+'Z'
-    print >> f,m
-    f.close()
+    ts = t.strftime("%Y%m%d")
+    self.logwriter.write(self.evntlogpath+ts+self.evntlogext,_msec(t)+'Z\n'+m+'\n')
 
-  def _processMessages(self,lastmessage):
-    msglock.acquire()
+  def _processMessages(self,lastmessage,received=None,message=None):
+    '''log, decode and pass a frame received at time received to processMessages. only the last step holds msglock.
+       message is the frame already decoded, if it was (see _processFrames).'''
     m = lastmessage
+    received = received or time.time()
     if m[0] in ['T','P'] and self.logit:
       self.savebin(m)
     if m[0] in ['<'] and self.logit:
       self.savetxt(m)
-    if m[0] in self._procfuncs:
+    if message is not None:
+      if self._verbose: print >> sys.stdout,message
+    elif m[0] in self._procfuncs:
       try:
-        self._lastMessage = self._procfuncs[m[0]](m)
-        if self._verbose: print >> sys.stdout,self._lastMessage
+        message = self._procfuncs[m[0]](m)
+        if self._verbose: print >> sys.stdout,message
       except Exception,msg:
+        self.decodeerrors += 1
         if self._verbose: print >> sys.stderr,self.name+' Unknown message %s \n*************\n%s\n*************\n'% (m,msg)
-        msglock.release()
         return
     else:
+      self.unknown += 1
       if self._verbose: print >> sys.stderr,self.name+' Unknown message %s'% m
-      msglock.release()
       return
-    self.processMessages()
-    msglock.release()
+    self.decoded[m[0]] = self.decoded.get(m[0],0)+1
+    decoded = time.time()
+    if self.latency:
+      try:
+        self.latency.decoded(message,received,decoded)
+      except Exception,msg:
+        if self._verbose: print >> sys.stderr,self.name+' Latency stamping failed: %s'%msg
+    with msglock:
+      self._lastMessage = message
+      self._lastStamps = (received,decoded)
+      self.processMessages()
 
   def subscribeToActiveMQ(self,destination=None,ID=None,usr=None,passwd=None,ack='auto'):
     if not destination: destination = self.subscribeTo
@@ -284,11 +1311,94 @@ class AMQListener(object):
     self.conn.disconnect()
 
 
-def getDMxmlmsg(Eid,mag,lat,lon,depth,delay,msgcat='test'):
-  now = datetime.datetime.utcnow()
-  T = (now-datetime.timedelta(0,delay)).isoformat()[:-3]
+# topic sharded ingestion
+class ListenerShards(object):
+  '''AMQListeners splitting the subscriptions by topic group. each shard has its own connection,
+     receiver thread, messages buffer, decoding queue and workers, so a flood on one topic group
+     can't delay another. shards is {shard name: {'topics':[subscription ids],'hosts':[(host,port),...]}}.
+     hosts (optional, default host_and_ports) are tried in order on (re)connection, for failover.
+     subscriptions not listed in any shard go to the default shard.
+     shards without topics are not created and the default shard is created once a subscription
+     (or listener()) falls to it. only shards with subscriptions are connected.
+     processMessages(listener) is called with the shard listener of each message.'''
+  def __init__(self,shards={},default='ActiveMQ',host_and_ports=[('localhost',61613)],**kwargs):
+    self.default = default
+    self.host_and_ports = host_and_ports
+    self.kwargs = kwargs # AMQListener arguments
+    self.routes = {} # subscription id -> shard name
+    self.listeners = {}
+    if default in shards: raise ValueError('Duplicate shard name: %s'%default)
+    for name,shard in shards.items():
+      if not shard.get('topics'): continue
+      for topic in shard['topics']:
+        if topic in self.routes: raise ValueError('Topic %s is in shards %s and %s'%(topic,self.routes[topic],name))
+        self.routes[topic] = name
+      self._create(name,shard.get('hosts',host_and_ports))
+
+  def _create(self,name,host_and_ports):
+    'create the listener of a shard'
+    l = AMQListener(name=name,host_and_ports=host_and_ports,**self.kwargs)
+    l.processMessages = lambda l=l: self.processMessages(l) # report the shard with the message
+    self.listeners[name] = l
+    return l
+
+  def processMessages(self,listener):
+    'process the last message of a shard listener. replace with your own function.'
+    pass
+
+  def listener(self,ID=None):
+    'the shard listener of a subscription id. creates the default shard if the id falls to it'
+    name = self.routes.get(ID,self.default)
+    return self.listeners.get(name) or self._create(name,self.host_and_ports)
+
+  def __iter__(self):
+    'shard listeners, default shard first'
+    return iter([self.listeners[n] for n in sorted(self.listeners,key=lambda n: (n!=self.default,n))])
+
+  def __len__(self):
+    return len(self.listeners)
+
+  def connectToActiveMQ(self):
+    'connect the shards that have subscriptions. subscribeToActiveMQ connects the others'
+    for l in self:
+      if l.SUBSCRIBES: l.connectToActiveMQ()
+
+  def subscribeToActiveMQ(self,destination=None,ID=None,*args,**kwargs):
+    'subscribe the shard of ID. connects it first if needed'
+    l = self.listener(ID)
+    if not l.conn.is_connected():
+      try:
+        l.connectToActiveMQ()
+      except Exception,msg:
+        if l._verbose: print >> sys.stderr,l.name+" Can't connect: %s"%msg
+        return 0
+    return l.subscribeToActiveMQ(destination,ID,*args,**kwargs)
+
+  def unsubscribeToActiveMQ(self,ID=None):
+    return self.listener(ID).unsubscribeToActiveMQ(ID)
+
+  def disconnectToActiveMQ(self):
+    for l in self:
+      if l.conn.is_connected(): l.disconnectToActiveMQ()
+
+  def is_connected(self):
+    'True if all shards with subscriptions are connected'
+    return all([l.conn.is_connected() for l in self if l.SUBSCRIBES])
+
+  def stopWorkers(self):
+    [l.stopWorkers() for l in self]
+
+
+def _msec(t):
+  'ISO time stamp of a datetime with milliseconds (YYYY-MM-DDTHH:MM:SS.mmm). isoformat drops zero microseconds'
+  return t.strftime('%Y-%m-%dT%H:%M:%S.')+'%03d'%(t.microsecond//1000)
+
+def getDMxmlmsg(Eid,mag,lat,lon,depth,delay,msgcat='test',now=None):
+  'a DM event message sent at now (default utcnow) with an origin time delay seconds earlier'
+  now = now or datetime.datetime.utcnow()
+  T = _msec(now-datetime.timedelta(0,delay))
   xmlexampl ='''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
-<event_message alg_vers="2.0.11 2014-04-08" category="'''+msgcat+'''" instance="./dm@eew2" message_type="new" orig_sys="elarms" timestamp="'''+now.isoformat()[:-3]+'''Z" version="0">
+<event_message alg_vers="2.0.11 2014-04-08" category="'''+msgcat+'''" instance="./dm@eew2" message_type="new" orig_sys="elarms" timestamp="'''+_msec(now)+'''Z" version="0">
 
   <core_info id="'''+Eid+'''">
     <mag units="Mw">'''+str(mag)+'''</mag>
@@ -308,11 +1418,12 @@ def getDMxmlmsg(Eid,mag,lat,lon,depth,delay,msgcat='test'):
   return xmlexampl
 
 
-def getE2xmlmsg(Eid,mag,lat,lon,depth,delay,msgcat='test'):
-  now = datetime.datetime.utcnow()
-  T = (now-datetime.timedelta(0,delay)).isoformat()[:-3]
+def getE2xmlmsg(Eid,mag,lat,lon,depth,delay,msgcat='test',now=None):
+  'an E2 event message sent at now (default utcnow) with an origin time delay seconds earlier'
+  now = now or datetime.datetime.utcnow()
+  T = _msec(now-datetime.timedelta(0,delay))
   xmlexampl ='''<?xml version="1.0" encoding="UTF-8" standalone="no" ?>
-<event_message alg_vers="2.0.11 2014-04-08" category="'''+msgcat+'''" instance="./E2@eew2" message_type="new" orig_sys="elarms" timestamp="'''+now.isoformat()[:-3]+'''Z" version="3">
+<event_message alg_vers="2.0.11 2014-04-08" category="'''+msgcat+'''" instance="./E2@eew2" message_type="new" orig_sys="elarms" timestamp="'''+_msec(now)+'''Z" version="3">
 
   <core_info id="'''+Eid+'''">
     <mag units="Mw">'''+str(mag)+'''</mag>
@@ -334,7 +1445,11 @@ def getE2xmlmsg(Eid,mag,lat,lon,depth,delay,msgcat='test'):
 
 # writer class for connecting to activeMQ
 class AMQWriter(object):
-  def __init__(self,dest='/topic/eew.sys.dm.data',usr='decimod',passwd='decimod',name='writer',id=1,verbose=False,host_and_ports=[('localhost',61613)]):
+  '''Send messages to the AMQ server over one long lived connection.
+     the connection is opened on the first send and reopened after it is lost.
+     send queues a message (up to queuesize waiting) for a background sender thread and returns at once,
+     sendActiveMQmsg sends on the calling thread. see getAMQWriter for shared writers.'''
+  def __init__(self,dest='/topic/eew.sys.dm.data',usr='decimod',passwd='decimod',name='writer',id=1,verbose=False,host_and_ports=[('localhost',61613)],retries=3,retrydelay=1.0,queuesize=1000):
     self.MESSAGES = []
     self.maxmessages=200
     self.dest=dest
@@ -344,6 +1459,18 @@ class AMQWriter(object):
     self.id=id
     self._verbose=verbose
     self.host_and_ports = host_and_ports
+    self.retries = retries # reconnection attempts per message before giving up
+    self.retrydelay = retrydelay # seconds between reconnection attempts
+    self.conn = None
+    self.lock = threading.RLock() # serializes use of the connection
+    self.queuesize = queuesize
+    self.outbox = deque() # (body,dest,callback) waiting for the sender thread. up to queuesize
+    self.cond = threading.Condition()
+    self.sender = None
+    self.closed = False
+    self.sent = 0 # messages sent
+    self.failed = 0 # messages given up on
+    self.connects = 0 # connections made, including reconnections
 
   def on_disconnected(self):
     if self._verbose: print >> sys.stderr,self.name+' Disconnected.'
@@ -355,14 +1482,116 @@ class AMQWriter(object):
     'process messages. replace with your own function.'
     pass
 
+  def is_connected(self):
+    return bool(self.conn) and self.conn.is_connected()
+
   def connectToActiveMQ(self):
-    self.conn = stomp.Connection(host_and_ports=self.host_and_ports)
-    self.conn.set_listener(self.name, self)
-    self.conn.start()
-    self.conn.connect(self.usr,self.passwd)
+    'connect unless already connected. the connection is reused after it was lost'
+    with self.lock:
+      if self.is_connected(): return
+      if self.conn is None:
+        self.conn = stomp.Connection(host_and_ports=self.host_and_ports)
+        self.conn.set_listener(self.name, self)
+      try:
+        self.conn.start()
+        self.conn.connect(self.usr,self.passwd,wait=True)
+      except Exception:
+        self.conn = None # start over with a fresh connection next time
+        raise
+      self.connects += 1
 
   def disconnectToActiveMQ(self):
-    self.conn.disconnect()
+    'disconnect. the next send connects again'
+    with self.lock:
+      if self.conn is None: return
+      try:
+        if self.conn.is_connected(): self.conn.disconnect()
+      finally:
+        self.conn = None
 
   def sendActiveMQmsg(self,body,dest='/topic/eew.sys.dm.data'):
-    self.conn.send(destination=dest,body=body)
+    'send a message on this thread. connects (or reconnects) first if needed'
+    with self.lock:
+      for attempt in range(self.retries+1):
+        try:
+          self.connectToActiveMQ()
+          self.conn.send(destination=dest,body=body)
+          self.sent += 1
+          return
+        except Exception,msg:
+          if self._verbose: print >> sys.stderr,self.name+' send failed (%s). attempt %d of %d'%(str(msg) or type(msg).__name__,attempt+1,self.retries+1)
+          if attempt==self.retries:
+            self.failed += 1
+            raise
+          time.sleep(self.retrydelay)
+
+  def send(self,body,dest=None,callback=None):
+    '''queue a message for the sender thread and return at once. True if queued.
+       callback(ok,error) is called from the sender thread once the message was sent or given up on.
+       a message is rejected (False, callback called here with an error) when queuesize messages are waiting.'''
+    with self.cond:
+      if self.closed: raise ValueError('Writer %s is closed'%self.name)
+      full = len(self.outbox)>=self.queuesize
+      if full:
+        self.failed += 1
+      else:
+        if self.sender is None:
+          self.sender = threading.Thread(target=self._run,name='%s-sender'%self.name)
+          self.sender.daemon = True
+          self.sender.start()
+        self.outbox.append((body,dest or self.dest,callback))
+        self.cond.notify()
+    if full:
+      if self._verbose: print >> sys.stderr,self.name+' outbox is full (%d messages). message rejected'%self.queuesize
+      if callback: callback(False,'outbox is full (%d messages)'%self.queuesize)
+      return False
+    return True
+
+  def depth(self):
+    'messages waiting to be sent'
+    return len(self.outbox)
+
+  def close(self):
+    'send what is queued, stop the sender thread and disconnect'
+    with self.cond:
+      self.closed = True
+      self.cond.notify()
+    if self.sender: self.sender.join()
+    self.disconnectToActiveMQ()
+
+  def _run(self):
+    while True:
+      with self.cond:
+        while not self.outbox and not self.closed: self.cond.wait()
+        if not self.outbox: return
+        body,dest,callback = self.outbox.popleft()
+      try:
+        self.sendActiveMQmsg(body,dest)
+        error = None
+      except Exception,msg:
+        error = str(msg) or type(msg).__name__
+      if callback:
+        try:
+          callback(error is None,error)
+        except Exception,msg:
+          if self._verbose: print >> sys.stderr,self.name+' send callback failed: %s'%msg
+
+# shared writers. one per server, port, user and settings
+_writers = {}
+_writerslock = threading.Lock()
+
+def getAMQWriter(usr='decimod',passwd='decimod',host_and_ports=[('localhost',61613)],**kwargs):
+  'a shared AMQWriter of a server, user and settings. created on first use'
+  key = (tuple([tuple(h) for h in host_and_ports]),usr,passwd,tuple(sorted(kwargs.items())))
+  with _writerslock:
+    writer = _writers.get(key)
+    if writer is None or writer.closed:
+      writer = _writers[key] = AMQWriter(usr=usr,passwd=passwd,host_and_ports=host_and_ports,**kwargs)
+    return writer
+
+def closeAMQWriters():
+  'close all shared writers'
+  with _writerslock:
+    writers = _writers.values()
+    _writers.clear()
+  [w.close() for w in writers]
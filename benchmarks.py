@@ -0,0 +1,302 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# micro benchmarks for ElViS message handling and end to end throughput.
+# run: python benchmarks.py [name ...]
+
+import sys,os,time,timeit,zlib,tempfile
+import numpy as np
+import argparse
+import amq2py as AMQ
+import loadgen
+import stompbroker
+import stations
+
+def report(name,n,t):
+  'print a benchmark result line'
+  print '%-30s %8d runs %10.2f us/run'%(name,n,t/n*1e6)
+
+def bench_xml(n=2000):
+  'compare the streaming (expat) and DOM (minidom) event message parsers'
+  for msgtype,getmsg in (('DM',AMQ.getDMxmlmsg),('E2',AMQ.getE2xmlmsg)):
+    m = getmsg('1234',5.5,32.1,35.2,10.0,3.0)
+    x = AMQ.algXML()
+    report('algXML %s expat'%msgtype,n,timeit.timeit(lambda: x.decode(m),number=n))
+    report('algXML %s minidom'%msgtype,n,timeit.timeit(lambda: x.decode_dom(m),number=n))
+
+def _header(t,n):
+  'a raw message header of type t with n packets'
+  h = np.zeros(1,AMQ.HEADERtype)
+  h['type'] = t
+  h['npackets'] = n
+  return h.tostring()+'\0'
+
+def bench_decoders(n=20000,npackets=10):
+  'decode time per message type using the decoders registry'
+  gm = np.zeros(npackets,AMQ.GMPeakdatatype)
+  tp = np.zeros(npackets,AMQ.TrigParamrawtype)
+  tr = np.zeros(1,AMQ.Triggerrawtype)
+  tr['type'] = 'T'
+  messages = {'G':_header('G',npackets)+zlib.compress(gm.tostring()),
+              'P':_header('P',npackets)+zlib.compress(tp.tostring()),
+              'T':tr.tostring(),
+              'D':_header('D',0),
+              '<':AMQ.getDMxmlmsg('1234',5.5,32.1,35.2,10.0,3.0)}
+  for k,m in sorted(messages.items()):
+    cls = AMQ.decoders[k]
+    report('decode %s (%s)'%(k,cls.__name__),n,timeit.timeit(lambda: AMQ.decode(m),number=n))
+
+def report_rate(name,n,t):
+  'print a throughput result line'
+  print '%-30s %8d msgs %10.0f msgs/s'%(name,n,n/t if t else 0)
+
+def report_latency(name,latencies):
+  'print latency percentiles (seconds)'
+  if not len(latencies): return
+  p50,p90,p99 = np.percentile(latencies,[50,90,99])*1e3
+  print '%-30s %8d msgs p50 %.3f ms p90 %.3f ms p99 %.3f ms max %.3f ms'%(name,len(latencies),p50,p90,p99,max(latencies)*1e3)
+
+def probe(listener):
+  '''wrap listener.processMessages to record when each fed frame was processed.
+     returns (fed,latencies): fill fed[id(frame)] with the feed time before feeding a frame.'''
+  fed = {}
+  latencies = []
+  process = listener.processMessages
+  def processMessages():
+    process()
+    t = fed.pop(id(listener._lastMessage.raw),None)
+    if t is not None: latencies.append(time.time()-t)
+  listener.processMessages = processMessages
+  return fed,latencies
+
+def feed(listener,frames,fed,realtime=True,tick=None,interval=0.25):
+  '''feed (relative time,frame) pairs to a listener. with realtime frames are fed on schedule.
+     tick() is called every interval seconds. returns the time it took.'''
+  t0 = time.time()
+  nexttick = t0+interval
+  for dt,m in frames:
+    if realtime:
+      while time.time()<t0+dt:
+        time.sleep(min(t0+dt-time.time(),0.001))
+    fed[id(m)] = time.time()
+    listener.feed({'destination':'/benchmark'},m)
+    if tick and time.time()>=nexttick:
+      tick()
+      nexttick += interval
+  if tick: tick()
+  return time.time()-t0
+
+def _schedule(n,duration,rates):
+  gen = loadgen.LoadGenerator(n,seed=0)
+  return gen,gen.schedule(rates,duration,max(1,n/10))
+
+def bench_pipeline(n=500,duration=5.0,workers=1,realtime=False):
+  '''headless throughput of n stations (gmpeak frames carry n/10 stations) through
+     decoding and AMQListener processing, with latency percentiles from feed to processMessages.'''
+  gen,frames = _schedule(n,duration,{'G':10*10,'T':n/50.0,'P':n/50.0,'X':0.2})
+  t = time.time()
+  [AMQ.decode(m) for dt,m in frames]
+  report_rate('decode (%d stations)'%n,len(frames),time.time()-t)
+  listener = AMQ.AMQListener(name='benchmark',workers=workers)
+  fed,latencies = probe(listener)
+  t0 = time.time()
+  feed(listener,frames,fed,realtime)
+  while fed and time.time()-t0<60: time.sleep(0.001) # wait for the workers
+  report_rate('process (%d workers)'%workers,len(frames),time.time()-t0)
+  report_latency('latency feed->process',latencies)
+  listener.stopWorkers()
+
+def bench_gui(n=500,duration=5.0,realtime=False):
+  '''headless end to end throughput through AppForm.processAMQmsg, coalesced peaks and canvas drawing.
+     needs PyQt4. without a display run with QT_QPA_PLATFORM=offscreen (Qt QPA builds) or under xvfb-run.'''
+  os.environ.setdefault('QT_QPA_PLATFORM','offscreen')
+  try:
+    import ElViS
+  except ImportError,msg:
+    print 'gui benchmark skipped: %s'%msg
+    return
+  gen,frames = _schedule(n,duration,{'G':10*10,'T':n/50.0,'P':n/50.0,'X':0.2})
+  app = ElViS.QApplication(sys.argv[:1])
+  stations = tempfile.NamedTemporaryFile(suffix='.cfg',delete=False)
+  stations.close()
+  gen.savestations(stations.name)
+  ElViS.STATIONS_FILE = stations.name
+  ElViS.AMQWORKERS = 0 # process on this thread so timing is deterministic
+  form = ElViS.AppForm(ElViS.QSplashScreen(ElViS.QPixmap()),ElViS.parser.parse_args(['--offline']))
+  form.resize(1200,800)
+  fed,latencies = probe(form.amq)
+  ticks,draws = [],[]
+  def tick():
+    t = time.time()
+    form.processpeaks()
+    ticks.append(time.time()-t)
+    t = time.time()
+    form.canvas.draw()
+    draws.append(time.time()-t)
+    app.processEvents()
+  t = feed(form.amq,frames,fed,realtime,tick,ElViS.PEAKSWINDOW/1000.0)
+  report_rate('gui process (%d stations)'%n,len(frames),t)
+  report_latency('latency feed->processAMQmsg',latencies)
+  report_latency('processpeaks per tick',ticks)
+  report_latency('canvas draw per tick',draws)
+  os.remove(stations.name)
+
+def bench_broker(n=500,duration=5.0,latency=0.0,burst=1000):
+  '''throughput and latency over STOMP through the in-process broker (stompbroker.py):
+     AMQWriter -> broker -> AMQListener, followed by a burst of gmpeak messages.'''
+  gen,frames = _schedule(n,duration,{'G':10*10,'T':n/50.0,'P':n/50.0,'X':0.2})
+  broker = stompbroker.StompBroker(port=0,latency=latency).start()
+  listener = AMQ.AMQListener(name='benchmark',host_and_ports=broker.host_and_ports)
+  listener.connectToActiveMQ()
+  listener.subscribeToActiveMQ('/topic/benchmark','benchmark')
+  writer = AMQ.AMQWriter(name='benchmark',host_and_ports=broker.host_and_ports)
+  writer.connectToActiveMQ()
+  while not broker.subscribers('/topic/benchmark'): time.sleep(0.01)
+  sent = {}
+  latencies = []
+  process = listener.processMessages
+  def processMessages():
+    process()
+    t = sent.pop(listener._lastMessage.raw,None)
+    if t is not None: latencies.append(time.time()-t)
+  listener.processMessages = processMessages
+  t0 = time.time()
+  for dt,m in frames:
+    sent[m] = time.time()
+    writer.sendActiveMQmsg(m,'/topic/benchmark')
+  while sent and time.time()-t0<60: time.sleep(0.001)
+  report_rate('broker (%d stations)'%n,len(frames),time.time()-t0)
+  report_latency('latency send->process',latencies)
+  bodies = [gen.gmpeak() for i in range(burst)]
+  del latencies[:]
+  t0 = time.time()
+  for m in bodies: sent[m] = t0
+  broker.burst('/topic/benchmark',bodies)
+  while sent and time.time()-t0<60: time.sleep(0.001)
+  report_rate('broker burst',burst,time.time()-t0)
+  report_latency('latency burst->process',latencies)
+  writer.disconnectToActiveMQ()
+  listener.stopWorkers()
+  broker.stop()
+
+def bench_pool(n=2000,nstations=500,processes=2,threads=2,batch=16):
+  '''gmpeak decoding in this process vs the GMPeakPool processes, one frame at a time and in batches
+     (as the listener workers submit them), with this process CPU time per frame and the longest stall
+     of a thread ticking every millisecond meanwhile (a stand-in for the GUI event loop).
+     the pool throughput only beats this process with more free cores than processes.'''
+  pool = AMQ.GMPeakPool(processes,rate=0)
+  gen = loadgen.LoadGenerator(nstations,seed=0)
+  frames = [gen.gmpeak() for i in range(n)]
+  import threading
+  def batches(frames):
+    for i in range(0,len(frames),batch): pool.decodebatch(frames[i:i+batch])
+  for name,decode in (('in process',lambda frames: [AMQ.GMPeak(m) for m in frames]),
+                      ('pool (%d processes)'%processes,lambda frames: [pool.decode(m) for m in frames]),
+                      ('pool (%d processes, batches of %d)'%(processes,batch),batches)):
+    gaps = []
+    running = [True]
+    def ticker():
+      t = time.time()
+      while running[0]:
+        time.sleep(0.001)
+        gaps.append(time.time()-t)
+        t = time.time()
+    tick = threading.Thread(target=ticker)
+    tick.start()
+    chunks = [frames[i::threads] for i in range(threads)]
+    workers = [threading.Thread(target=decode,args=(c,)) for c in chunks]
+    cpu = sum(os.times()[:2])
+    t = time.time()
+    [w.start() for w in workers]
+    [w.join() for w in workers]
+    t = time.time()-t
+    cpu = sum(os.times()[:2])-cpu
+    running[0] = False
+    tick.join()
+    report_rate('gmpeak decode %s'%name,n,t)
+    report('this process cpu per frame',n,cpu)
+    report_latency('ticker period',gaps)
+  pool.close()
+
+def bench_stations(n=500,nmessages=200):
+  '''mapping gmpeak packets of n stations to stations and coalescing them:
+     per packet (no index), one vectorized lookup and reduction per message (station index).'''
+  gen = loadgen.LoadGenerator(n,seed=0)
+  index = stations.StationIndex(gen.stations['net'],gen.stations['sta'])
+  messages = [AMQ.GMPeak(gen.gmpeak()) for i in range(nmessages)]
+  for name,peaks in (('per packet',AMQ.PeakCoalescer()),('station index',AMQ.PeakCoalescer(index=index))):
+    t = time.time()
+    for m in messages: peaks.add(m.packets)
+    peaks.pop()
+    report_rate('coalesce %s (%d stations)'%(name,n),nmessages,time.time()-t)
+
+def bench_colors(n=500,runs=200):
+  'coloring n station values one at a time vs one lookup per batch (colormaps.ColorScale)'
+  try:
+    import colormaps
+  except ImportError,msg:
+    print 'colors benchmark skipped: %s'%msg
+    return
+  values = 10**np.random.RandomState(0).uniform(-3,2,n)
+  scales = {'linear':colormaps.ColorScale(['blue','cyan','yellow','red'],0.0,98.1),
+            'log':colormaps.ColorScale(['blue','cyan','yellow','red'],1e-9,10.0,log=True),
+            'banded':colormaps.ColorScale(['blue','green','yellow','red'],bounds=[1e-2,1e-1,1.0])}
+  for name,scale in sorted(scales.items()):
+    t = time.time()
+    for i in range(runs): [scale([v])[0] for v in values]
+    report_rate('colors %s one by one (%d stations)'%(name,n),runs,time.time()-t)
+    t = time.time()
+    for i in range(runs): scale(values)
+    report_rate('colors %s batch (%d stations)'%(name,n),runs,time.time()-t)
+
+def bench_inventory(n=5000,runs=20):
+  'loading a stations file of n stations: parsing it vs its cache (stations.loadinventory)'
+  gen = loadgen.LoadGenerator(n,seed=0)
+  cachedir = tempfile.mkdtemp()
+  path = os.path.join(cachedir,'stations.cfg')
+  gen.savestations(path)
+  for name,cache in (('parse',''),('cached',cachedir)):
+    stations.loadinventory(path,cache) # fill the cache
+    t = time.time()
+    for i in range(runs): stations.loadinventory(path,cache)
+    report(name+' inventory (%d stations)'%n,runs,time.time()-t)
+  [os.remove(os.path.join(cachedir,f)) for f in os.listdir(cachedir)]
+  os.rmdir(cachedir)
+
+benchmarks = {'xml':bench_xml,
+              'decoders':bench_decoders,
+              'pipeline':bench_pipeline,
+              'broker':bench_broker,
+              'pool':bench_pool,
+              'stations':bench_stations,
+              'colors':bench_colors,
+              'inventory':bench_inventory,
+              'gui':bench_gui}
+
+parser = argparse.ArgumentParser(description='ElViS micro benchmarks')
+parser.add_argument('names',nargs='*',default=None,help='benchmarks to run (%s). default: all'%', '.join(sorted(benchmarks)))
+parser.add_argument('-n',type=int,default=None,help='number of runs (number of stations for pipeline and gui)')
+
+if __name__=="__main__":
+  args = parser.parse_args(sys.argv[1:])
+  for name in args.names or sorted(benchmarks):
+    if args.n: benchmarks[name](args.n)
+    else: benchmarks[name]()
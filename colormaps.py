@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# batch color scales for station values.
+# a scale maps an array of values to an (n,4) RGBA array through a precomputed lookup table.
+# scales are built from a configuration dict (see COLORSCALES in ElViS.py), so sites can plug in their own:
+#   scales = colorscales({'amax':{'colors':'acc','vmin':0.0,'vmax':98.1},
+#                         'dmax':{'colors':'acc','vmin':1e-9,'vmax':10.0,'log':True},
+#                         'vmax':{'colors':['blue','green','red'],'bounds':[1e-3,1e-2]}})
+#   scales['amax']([0.0,12.5,200.0]) -> 3x4 RGBA array
+# any callable taking an array of values and returning RGBA rows can be used as a scale too.
+
+from numpy import asarray,array,linspace,interp,column_stack,concatenate,searchsorted,floor,isnan,log10,errstate,int64
+from matplotlib import cm
+from matplotlib.colors import colorConverter
+
+class ColorScale(object):
+  '''Map values to RGBA colors with a lookup table.
+     continuous: colors is a colormap (or its name) or a list of colors, sampled to n colors spread
+     linearly between vmin and vmax, or logarithmically with log.
+     banded: with bounds, colors[i] is used for bounds[i-1] <= value < bounds[i].
+     values are taken as absolute values with absolute. out of range values get the end colors with clip,
+     or the bad color. nan values always get the bad color.'''
+  def __init__(self,colors,vmin=0.0,vmax=1.0,log=False,bounds=None,clip=True,absolute=True,n=256,bad=(0.0,0.0,0.0,1.0)):
+    if isinstance(colors,basestring): colors = cm.get_cmap(colors)
+    if bounds is not None:
+      lut = array([colorConverter.to_rgba(c) for c in colors])
+      if len(lut)!=len(bounds)+1: raise ValueError('%d colors for %d bounds. expected %d colors'%(len(lut),len(bounds),len(bounds)+1))
+      self.bounds = asarray(bounds,dtype=float)
+    else:
+      if log and (vmin<=0 or vmax<=0): raise ValueError('Log scale limits must be positive: %s,%s'%(vmin,vmax))
+      if vmax<=vmin: raise ValueError('vmax (%s) must be larger than vmin (%s)'%(vmax,vmin))
+      if callable(colors): # a colormap
+        lut = asarray(colors(linspace(0,1,n)))
+      else: # a list of colors, interpolated
+        lut = array([colorConverter.to_rgba(c) for c in colors])
+        x = linspace(0,1,n)
+        lut = column_stack([interp(x,linspace(0,1,len(lut)),lut[:,k]) for k in range(4)])
+      self.bounds = None
+    self.lut = concatenate([lut,[colorConverter.to_rgba(bad)]]) # the bad color is the last entry
+    self.n = len(lut)
+    self.log = log
+    self.clip = clip
+    self.absolute = absolute
+    self.vmin,self.vmax = vmin,vmax
+    self.lo,self.hi = (log10(vmin),log10(vmax)) if log and bounds is None else (vmin,vmax)
+
+  def indices(self,values):
+    'lookup table entries of values. the bad color entry is n'
+    v = asarray(values,dtype=float)
+    if self.absolute: v = abs(v)
+    bad = isnan(v)
+    if self.bounds is not None:
+      i = searchsorted(self.bounds,v,side='right')
+    else:
+      with errstate(divide='ignore',invalid='ignore'):
+        if self.log: v = log10(v) # 0 is -inf, below everything
+        f = (v-self.lo)/(self.hi-self.lo)
+      if not self.clip: bad |= (f<0)|(f>1)
+      f[isnan(f)] = 0
+      i = floor(f.clip(0,1)*(self.n-1)).astype(int64)
+    i[bad] = self.n
+    return i
+
+  def __call__(self,values):
+    'RGBA colors of values as an (n,4) array'
+    return self.lut[self.indices(values)]
+
+def colorscales(config):
+  '''color scales by quantity from {quantity: ColorScale keyword arguments or a scale}.
+     a scale is any callable mapping an array of values to RGBA rows.'''
+  return dict([(k,v if callable(v) else ColorScale(**v)) for k,v in config.items()])
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+# embedded event history. every event solution (DM/E2 xml message) is kept in an SQLite database,
+# written by a background thread and indexed by event id, origin time, magnitude and location.
+#
+# usage:
+#   store = EventStore('log/events.db')
+#   store.add(message) # an amq2py.algXML record. returns at once
+#   store.events(t0,t1,minmag=4,region=(31,33,34,36)) # latest solution of matching events
+#   store.history(Eid) # all solutions of an event
+#
+# command line: python eventstore.py DB [-b BEGIN] [-e END] [-m MIN MAX] [-r LAT0 LAT1 LON0 LON1] [--eid EID] [--import LOG ...]
+
+import sys,time,datetime,threading,calendar
+import sqlite3
+from collections import deque,namedtuple
+import argparse
+import amq2py as AMQ
+import triglog
+import replay
+
+FIELDS = ('eid','orig_sys','msgtype','msgtime','received','orig_time','lat','lon','depth','mag','magu')
+Solution = namedtuple('Solution',FIELDS) # one event solution. times are datetime (UTC)
+Event = namedtuple('Event',('eid','first','last','nsolutions','orig_time','lat','lon','depth','mag','magu')) # an event and its latest solution
+_times = ('msgtime','received','orig_time','first','last') # fields stored as seconds since epoch
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS solutions (id INTEGER PRIMARY KEY, eid TEXT NOT NULL, orig_sys TEXT, msgtype TEXT,
+  msgtime REAL, received REAL, orig_time REAL, lat REAL, lon REAL, depth REAL, mag REAL, magu TEXT, raw TEXT);
+CREATE INDEX IF NOT EXISTS solutions_eid ON solutions (eid,msgtime);
+CREATE TABLE IF NOT EXISTS events (eid TEXT PRIMARY KEY, first REAL, last REAL, nsolutions INTEGER,
+  orig_time REAL, lat REAL, lon REAL, depth REAL, mag REAL, magu TEXT);
+CREATE INDEX IF NOT EXISTS events_time ON events (orig_time);
+CREATE INDEX IF NOT EXISTS events_mag ON events (mag);
+CREATE INDEX IF NOT EXISTS events_location ON events (lat,lon);
+'''
+
+def _epoch(t):
+  if isinstance(t,datetime.datetime): return calendar.timegm(t.utctimetuple())+t.microsecond/1e6
+  return triglog.totimestamp(t)
+
+def _row(cls,row):
+  'a Solution or Event of a database row'
+  row = dict(zip(cls._fields,row))
+  for k in _times:
+    if row.get(k) is not None: row[k] = datetime.datetime.utcfromtimestamp(row[k])
+  return cls(**row)
+
+class EventStore(object):
+  '''SQLite store of event solutions. add queues a solution for the writer thread,
+     queries run on the calling thread and see everything added before flush returned.
+     path may be ':memory:' for a store that lasts as long as the process.'''
+  def __init__(self,path='log/events.db',flushinterval=1.0,raw=True):
+    self.path = path
+    self.flushinterval = flushinterval # maximal seconds between commits
+    self.raw = raw # keep the raw xml message
+    self.db = sqlite3.connect(path,check_same_thread=False)
+    self.db.executescript(SCHEMA)
+    self.lock = threading.Lock() # serializes use of the database connection
+    self.pending = deque() # (message,received) waiting for the writer
+    self.cond = threading.Condition()
+    self.writing = 0 # solutions taken by the writer and not committed yet
+    self.closed = False
+    self.written = 0 # solutions committed
+    self.errors = 0 # failed commits
+    self.thread = threading.Thread(target=self._run,name='event-store')
+    self.thread.daemon = True
+    self.thread.start()
+
+  def add(self,m,received=None):
+    'queue an algXML solution received at time received (default now)'
+    with self.cond:
+      if self.closed: raise ValueError('Event store %s is closed'%self.path)
+      self.pending.append((m,received or time.time()))
+      self.cond.notify_all()
+
+  def depth(self):
+    'solutions waiting to be written'
+    return len(self.pending)+self.writing
+
+  def flush(self):
+    'wait until all queued solutions are committed'
+    with self.cond:
+      self.cond.notify_all()
+      while self.pending or self.writing: self.cond.wait(0.1)
+
+  def close(self):
+    'write what is queued and close the database'
+    with self.cond:
+      self.closed = True
+      self.cond.notify_all()
+    self.thread.join()
+    with self.lock: self.db.close()
+
+  def _run(self):
+    while True:
+      with self.cond:
+        if not self.pending and not self.closed: self.cond.wait(self.flushinterval)
+        batch = list(self.pending)
+        self.pending.clear()
+        self.writing = len(batch)
+        if not batch and self.closed: return
+      if batch:
+        try:
+          self._write(batch)
+          self.written += len(batch)
+        except sqlite3.Error,msg:
+          self.errors += 1
+          print >> sys.stderr,'Event store %s: %s'%(self.path,msg)
+      with self.cond:
+        self.writing = 0
+        self.cond.notify_all()
+
+  def _write(self,batch):
+    rows = [(m.Eid,m.msgorigsys,m.msgtype,_epoch(m.msgtime),received,_epoch(m.orig_time),m.lat,m.lon,m.depth,m.mag,m.magU,
+             m.raw if self.raw else None) for m,received in batch]
+    with self.lock:
+      with self.db: # one transaction per batch
+        self.db.executemany('INSERT INTO solutions (eid,orig_sys,msgtype,msgtime,received,orig_time,lat,lon,depth,mag,magu,raw) VALUES (?,?,?,?,?,?,?,?,?,?,?,?)',rows)
+        for eid,orig_sys,msgtype,msgtime,received,orig_time,lat,lon,depth,mag,magu,raw in rows:
+          self.db.execute('UPDATE events SET last=?,nsolutions=nsolutions+1,orig_time=?,lat=?,lon=?,depth=?,mag=?,magu=? WHERE eid=?',
+                          (msgtime,orig_time,lat,lon,depth,mag,magu,eid))
+          self.db.execute('INSERT OR IGNORE INTO events VALUES (?,?,?,1,?,?,?,?,?,?)',(eid,msgtime,msgtime,orig_time,lat,lon,depth,mag,magu))
+
+  def events(self,t0=None,t1=None,minmag=None,maxmag=None,region=None,limit=None):
+    '''events by their latest solution, oldest first: origin time between t0 and t1
+       (datetime, ISO string or seconds since epoch), magnitude between minmag and maxmag
+       and location in region (minlat,maxlat,minlon,maxlon). None is no limit.'''
+    where,args = [],[]
+    for cond,value in (('orig_time>=?',_epoch(t0)),('orig_time<=?',_epoch(t1)),('mag>=?',minmag),('mag<=?',maxmag)):
+      if value is not None:
+        where.append(cond)
+        args.append(value)
+    if region:
+      where.append('lat BETWEEN ? AND ? AND lon BETWEEN ? AND ?')
+      args += list(region)
+    sql = 'SELECT * FROM events'+(' WHERE '+' AND '.join(where) if where else '')+' ORDER BY orig_time'
+    if limit: sql += ' LIMIT %d'%limit
+    with self.lock:
+      return [_row(Event,r) for r in self.db.execute(sql,args)]
+
+  def history(self,Eid):
+    'all solutions of an event in the order they were sent'
+    with self.lock:
+      rows = self.db.execute('SELECT %s FROM solutions WHERE eid=? ORDER BY msgtime,id'%','.join(FIELDS),(Eid,)).fetchall()
+    return [_row(Solution,r) for r in rows]
+
+  def messages(self,Eid):
+    'raw xml messages of an event'
+    with self.lock:
+      return [r[0] for r in self.db.execute('SELECT raw FROM solutions WHERE eid=? ORDER BY msgtime,id',(Eid,))]
+
+  def __len__(self):
+    'number of events'
+    with self.lock:
+      return self.db.execute('SELECT COUNT(*) FROM events').fetchone()[0]
+
+  def importlog(self,path):
+    'add the solutions of an ElViS event log (log/events_YYYYMMDD.log). returns the number added'
+    n = 0
+    for ts,message in replay.readeventlog(path):
+      try:
+        m = AMQ.algXML(message)
+      except Exception:
+        continue # not an event message
+      self.add(m,ts)
+      n += 1
+    self.flush()
+    return n
+
+parser = argparse.ArgumentParser(description='Query the ElViS event history database.')
+parser.add_argument('db',help='event database (log/events.db)')
+parser.add_argument('-b','--begin',default=None,help='origin time from (YYYY-MM-DDTHH:MM:SS[.ffffff] UTC or seconds since epoch)')
+parser.add_argument('-e','--end',default=None,help='origin time to (YYYY-MM-DDTHH:MM:SS[.ffffff] UTC or seconds since epoch)')
+parser.add_argument('-m','--mag',nargs=2,type=float,default=(None,None),metavar=('MIN','MAX'),help='magnitude range')
+parser.add_argument('-r','--region',nargs=4,type=float,default=None,metavar=('LAT0','LAT1','LON0','LON1'),help='latitude and longitude range')
+parser.add_argument('--eid',default=None,help='show the solutions history of an event')
+parser.add_argument('--import',dest='logs',nargs='+',default=None,metavar='LOG',help='add event log files (log/events_YYYYMMDD.log) to the database first')
+
+if __name__=="__main__":
+  args = parser.parse_args(sys.argv[1:])
+  store = EventStore(args.db)
+  for path in args.logs or []:
+    print >> sys.stderr,'%s: %d solutions imported'%(path,store.importlog(path))
+  if args.eid:
+    for s in store.history(args.eid):
+      print '%s | %s (%s - %s) %f %f %f %f%s'%(s.msgtime.isoformat(),s.eid,s.orig_sys,s.msgtype,s.lat,s.lon,s.depth,s.mag,s.magu)
+  else:
+    for e in store.events(args.begin,args.end,args.mag[0],args.mag[1],args.region):
+      print '%s | %s %f %f %f %f%s (%d solutions)'%(e.orig_time.isoformat(),e.eid,e.lat,e.lon,e.depth,e.mag,e.magu,e.nsolutions)
+  store.close()
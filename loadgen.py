@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# synthetic ElarmS traffic for load testing.
+# frames match the data types in amq2py and can be fed to AMQListener or published to a server.
+
+import time,zlib
+import numpy as np
+import amq2py as AMQ
+
+CHANNELS = ('HHE','HHN','HHZ') # channels reported by every station
+
+class LoadGenerator(object):
+  '''Generate gmpeak, trigger, trigger parameters and DM event frames for n synthetic stations.
+     stations are named net.S0000 ... and spread randomly around (lat0,lon0).'''
+  def __init__(self,nstations=100,net='XX',lat0=31.5,lon0=35.0,spread=2.0,seed=None):
+    self.random = np.random.RandomState(seed)
+    self.net = net
+    self.stations = np.zeros(nstations,dtype=[('net','S2'),('sta','S5'),('lat',float),('lon',float)])
+    self.stations['net'] = net
+    self.stations['sta'] = ['S%04d'%i for i in range(nstations)]
+    self.stations['lat'] = lat0+self.random.uniform(-spread,spread,nstations)
+    self.stations['lon'] = lon0+self.random.uniform(-spread,spread,nstations)
+    self.lat0 = lat0
+    self.lon0 = lon0
+    self.eventid = 0
+    self._next = 0 # next station for round robin generation
+
+  def _pick(self,n):
+    'indices of the next n stations, round robin'
+    i = (self._next+np.arange(n))%len(self.stations)
+    self._next = (self._next+n)%len(self.stations)
+    return i
+
+  def _header(self,t,n):
+    h = np.zeros(1,AMQ.HEADERtype)
+    h['type'] = t
+    h['version'] = 1
+    h['source'] = 'loadgen'
+    h['npackets'] = n
+    return h.tostring()+'\0'
+
+  def gmpeak(self,nstations=None,ts=None):
+    'a gmpeak frame with all channels of nstations stations (default all)'
+    i = self._pick(nstations or len(self.stations)).repeat(len(CHANNELS))
+    ts = time.time() if ts is None else ts
+    p = np.zeros(len(i),AMQ.GMPeakdatatype)
+    for k in ('net','sta','lat','lon'): p[k] = self.stations[k][i]
+    p['chn'] = np.tile(CHANNELS,len(i)/len(CHANNELS))
+    p['loc'] = '--'
+    p['ts'] = ts
+    p['nsamps'] = 100
+    p['samprate'] = 100
+    p['amax'] = 10**self.random.uniform(-3,2,len(i)) # cm/s^2
+    p['vmax'] = p['amax']/10**self.random.uniform(0.5,1.5,len(i))
+    p['dmax'] = p['vmax']/10**self.random.uniform(0.5,1.5,len(i))
+    p['latency'] = self.random.uniform(0.5,2,len(i))
+    return self._header('G',len(p))+zlib.compress(p.tostring())
+
+  def trigger(self,ts=None):
+    'a trigger frame of the next station'
+    i = self._pick(1)
+    ts = time.time() if ts is None else ts
+    t = np.zeros(1,AMQ.Triggerrawtype)
+    t['type'] = 'T'
+    t['version'] = 1
+    t['source'] = 'loadgen'
+    for k in ('net','sta','lat','lon'): t[k] = self.stations[k][i]
+    t['chn'] = 'HHZ'
+    t['loc'] = '--'
+    t['sec'] = int(ts)
+    t['msec'] = int((ts%1)*1000)
+    return t.tostring()
+
+  def trigparam(self,npackets=1,ts=None):
+    'a trigger parameters frame of the next npackets stations'
+    i = self._pick(npackets)
+    ts = time.time() if ts is None else ts
+    p = np.zeros(npackets,AMQ.TrigParamrawtype)
+    for k in ('net','sta','lat','lon'): p[k] = self.stations[k][i]
+    p['chn'] = 'HHZ'
+    p['loc'] = '--'
+    p['sec'] = int(ts)
+    p['msec'] = int((ts%1)*1000)
+    p['samplerate'] = 100
+    p['arrtime'] = ts
+    p['trigvalues']['tauP'] = self.random.uniform(0,2,(npackets,10))
+    return self._header('P',npackets)+zlib.compress(p.tostring())
+
+  def event(self,mag=None,delay=5.0):
+    'a DM event message somewhere in the network'
+    self.eventid += 1
+    mag = self.random.uniform(3,7) if mag is None else mag
+    lat = self.lat0+self.random.uniform(-1,1)
+    lon = self.lon0+self.random.uniform(-1,1)
+    return AMQ.getDMxmlmsg('%s%d'%(self.net,self.eventid),round(mag,1),round(lat,4),round(lon,4),8.0,delay)
+
+  def frame(self,t,**kwargs):
+    'a frame of message type t (G, T, P or X)'
+    return {'G':self.gmpeak,'T':self.trigger,'P':self.trigparam,'X':self.event}[t](**kwargs)
+
+  def schedule(self,rates,duration,gmstations=None):
+    '''list of (relative time,frame) for duration seconds.
+       rates are messages per second by type, e.g. {'G':10,'T':5,'P':5,'X':0.1}.
+       gmpeak frames carry gmstations stations each (default all stations).'''
+    times = []
+    for t,rate in rates.items():
+      if rate<=0: continue
+      n = int(round(rate*duration))
+      times += [(k/float(rate),t) for k in range(n)]
+    times.sort()
+    t0 = time.time()
+    frames = []
+    for dt,t in times:
+      if t=='G':
+        frames.append((dt,self.gmpeak(gmstations,t0+dt)))
+      elif t=='X':
+        frames.append((dt,self.event()))
+      else:
+        frames.append((dt,self.frame(t,ts=t0+dt)))
+    return frames
+
+  def loadstations(self,path):
+    'use the stations of an ElViS stations file ([net] [sta] [lat] [lon])'
+    stations = np.loadtxt(path,dtype=self.stations.dtype,usecols=range(4),ndmin=1)
+    if not len(stations): raise ValueError('No stations in %s'%path)
+    self.stations = stations
+    self._next = 0
+
+  def savestations(self,path):
+    'write the stations in the ElViS stations file format ([net] [sta] [lat] [lon])'
+    with open(path,'w') as f:
+      for s in self.stations:
+        print >> f,'%s %s %.5f %.5f'%(s['net'],s['sta'],s['lat'],s['lon'])
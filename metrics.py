@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# a minimal Prometheus text format endpoint for ElViS health metrics.
+# metrics are collected on every request by a callable returning a list of
+# (name,type,help,samples). samples are (labels,value) or (suffix,labels,value),
+# where labels is a dict and suffix is appended to name (e.g. '_count' of a summary).
+#
+# usage:
+#   server = MetricsServer(collect,port=9108).start()
+#   ...
+#   server.stop()
+
+import threading
+import BaseHTTPServer,SocketServer
+
+CONTENTTYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _escape(v):
+  'escape a label value'
+  return str(v).replace('\\','\\\\').replace('\n','\\n').replace('"','\\"')
+
+def _value(v):
+  if v is None: return 'NaN'
+  if v==float('inf'): return '+Inf'
+  if v==float('-inf'): return '-Inf'
+  return repr(float(v)) if isinstance(v,float) else str(v)
+
+def formatmetrics(metrics,comments=True):
+  'metrics in the Prometheus text exposition format. without comments HELP and TYPE lines are left out'
+  lines = []
+  for name,type,help,samples in metrics:
+    if comments:
+      lines.append('# HELP %s %s'%(name,help.replace('\\','\\\\').replace('\n','\\n')))
+      lines.append('# TYPE %s %s'%(name,type))
+    for sample in samples:
+      suffix,labels,value = sample if len(sample)==3 else ('',)+tuple(sample)
+      labels = ','.join(['%s="%s"'%(k,_escape(v)) for k,v in sorted(labels.items())])
+      lines.append('%s%s%s %s'%(name,suffix,'{%s}'%labels if labels else '',_value(value)))
+  return '\n'.join(lines)+'\n'
+
+def summary(rows,labels={},quantiles=(0.5,0.9,0.99)):
+  '''summary samples from rows of (extra labels,n,q1,q2,...,sum) with one value per quantile.
+     n and sum may be None if unknown, and their samples are skipped.'''
+  samples = []
+  for row in rows:
+    l = dict(labels,**row[0])
+    n,values,total = row[1],row[2:2+len(quantiles)],row[2+len(quantiles)]
+    samples += [(dict(l,quantile=str(q)),v) for q,v in zip(quantiles,values)]
+    if total is not None: samples.append(('_sum',l,total))
+    if n is not None: samples.append(('_count',l,n))
+  return samples
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+  def do_GET(self):
+    if self.path.split('?')[0] not in ('/metrics','/'):
+      self.send_error(404)
+      return
+    try:
+      body = formatmetrics(self.server.collect())
+    except Exception,msg:
+      self.send_error(500,str(msg) or type(msg).__name__)
+      return
+    self.send_response(200)
+    self.send_header('Content-Type',CONTENTTYPE)
+    self.send_header('Content-Length',str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self,format,*args):
+    if self.server.verbose: BaseHTTPServer.BaseHTTPRequestHandler.log_message(self,format,*args)
+
+class _Server(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class MetricsServer(object):
+  '''Serve the metrics returned by collect() on http://host:port/metrics.
+     the default host only accepts local connections.'''
+  def __init__(self,collect,host='127.0.0.1',port=9108,verbose=False):
+    self.server = _Server((host,port),_Handler)
+    self.server.collect = collect
+    self.server.verbose = verbose
+    self.thread = None
+
+  @property
+  def address(self):
+    '(host,port) the server listens on'
+    return self.server.server_address[:2]
+
+  def start(self):
+    'serve in a background thread. returns self'
+    self.thread = threading.Thread(target=self.server.serve_forever,name='metrics-server')
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    self.server.shutdown()
+    self.server.server_close()
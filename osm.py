@@ -36,6 +36,9 @@ class OSM(object):
   lonmin = -180.0
   maxlevel=17
   maxtilecash=500
+  tilehits = 0 # tiles served from the in-memory cache
+  tilemisses = 0 # tiles read from the archive or downloaded
+  tiledownloads = 0 # tiles fetched over http
   def __init__(self,ax,tileurl="http://a.tile.openstreetmap.org/",tilepat="{Z}/{X}/{Y}.png",tilearchive=''):
     # constants and defaults
     self.ax = ax # where to plot tiles
@@ -151,7 +154,9 @@ class OSM(object):
     for t in tiles:
       tID = t.replace(self.tileurl,'').replace(self.tilearchive,'').replace('/',os.sep)
       if not tID in self.cashedtiles: # if tiles are not already in cash
+        OSM.tilemisses += 1
         if t.startswith('http'): # if we need to download
+          OSM.tiledownloads += 1
           datafile = StringIO(self.http.request(t)[1]) # download tile image to stream
           if self.tilearchive: # archive tile if we set the archive
             d = datafile.read() # read the downloaded data from stream
@@ -172,6 +177,7 @@ class OSM(object):
           old = self.tilesorder.pop(0)
           self.cashedtiles.pop(old)
       else:
+        OSM.tilehits += 1
         im = self.cashedtiles[tID]
       self.ax.images.append(im) # add image to axes
       self.currentimages.append(im) # add image to current images list
@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# broker free replay of ElViS logs.
+# frames from triggers logs (log/triggers_YYYYMMDD.trig) and event logs (log/events_YYYYMMDD.log)
+# are fed to an AMQListener in time order, as if they were received from the ActiveMQ server.
+
+import re,time,datetime,threading
+import numpy as np
+import triglog
+
+MINSPEED = 0.5 # slowest replay speed factor
+MAXSPEED = 50.0 # fastest replay speed factor. speed 0 replays as fast as possible
+_eventts = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d(\.\d+)?Z$') # time stamp line of the event log
+
+def readtriglog(path):
+  'list of (time stamp,frame) of a triggers log. a frame with several entries is timed by its first one'
+  log = triglog.TrigLog(path)
+  first = log.index[np.unique(log.index['offset'],return_index=True)[1]] # one entry per frame
+  frames = [(float(e['ts']),log.frame(e)) for e in first]
+  log.close()
+  return frames
+
+def readeventlog(path):
+  'list of (time stamp,message) of an event log. time stamp is the time the message was received'
+  frames = []
+  ts,lines = None,[]
+  for line in open(path,'r'):
+    if _eventts.match(line.rstrip('\n')):
+      if ts is not None and lines: frames.append((ts,''.join(lines)[:-1]))
+      ts = triglog.totimestamp(line.strip()[:-1])
+      lines = []
+    elif ts is not None:
+      lines.append(line)
+  if ts is not None and lines: frames.append((ts,''.join(lines)[:-1]))
+  return frames
+
+class Replay(object):
+  '''Replay logged frames into an AMQListener in time order.
+     speed is a factor between MINSPEED and MAXSPEED, or 0 for as fast as possible.
+     the replay can be paused, resumed, sped up or slowed down and moved to any time.'''
+  def __init__(self,listener,trigfiles=[],eventfiles=[],speed=1.0,destination='/replay'):
+    self.listener = listener
+    self.headers = {'destination':destination}
+    frames = []
+    for path in trigfiles: frames += readtriglog(path)
+    for path in eventfiles: frames += readeventlog(path)
+    frames.sort(key=lambda f: f[0]) # stable. keeps file order of equal times
+    self.times = np.array([f[0] for f in frames],dtype=float)
+    self.frames = [f[1] for f in frames]
+    self.pos = 0 # next frame to feed
+    self.fed = 0 # frames fed
+    self.cond = threading.Condition()
+    self.paused = True
+    self.stopped = False
+    self.speed = self._checkspeed(speed)
+    self._anchor = (time.time(),self.times[0] if len(self.times) else 0.0) # (wall time, replay time)
+    self.thread = None
+
+  def _checkspeed(self,speed):
+    if speed and not MINSPEED<=speed<=MAXSPEED:
+      raise ValueError('Replay speed should be 0 or between %s and %s'%(MINSPEED,MAXSPEED))
+    return float(speed)
+
+  def __len__(self):
+    return len(self.frames)
+
+  def _clock(self):
+    'replay time now (seconds since epoch). called with the lock held'
+    wall,t = self._anchor
+    if self.paused or not self.speed: return t
+    return t+(time.time()-wall)*self.speed
+
+  def now(self):
+    'replay time now as a datetime'
+    with self.cond:
+      t = self._clock()
+    return datetime.datetime.utcfromtimestamp(t)
+
+  def start(self):
+    'start (or resume) the replay'
+    with self.cond:
+      if self.thread is None:
+        self.thread = threading.Thread(target=self._run,name='replay')
+        self.thread.daemon = True
+        self.thread.start()
+      self._anchor = (time.time(),self._clock())
+      self.paused = False
+      self.cond.notify_all()
+
+  resume = start
+
+  def pause(self):
+    with self.cond:
+      self._anchor = (time.time(),self._clock())
+      self.paused = True
+      self.cond.notify_all()
+
+  def setspeed(self,speed):
+    speed = self._checkspeed(speed)
+    with self.cond:
+      self._anchor = (time.time(),self._clock())
+      self.speed = speed
+      self.cond.notify_all()
+
+  def seek(self,t):
+    'move the replay to time t (datetime, ISO time string or seconds since epoch)'
+    t = triglog.totimestamp(t)
+    with self.cond:
+      self.pos = int(np.searchsorted(self.times,t,'left'))
+      self._anchor = (time.time(),t)
+      self.cond.notify_all()
+
+  def stop(self):
+    with self.cond:
+      self.stopped = True
+      self.cond.notify_all()
+    if self.thread: self.thread.join()
+
+  def done(self):
+    return self.pos>=len(self.frames)
+
+  def _run(self):
+    while True:
+      with self.cond:
+        while not self.stopped:
+          if not self.paused and self.pos<len(self.frames):
+            if not self.speed: break
+            wait = (self.times[self.pos]-self._clock())/self.speed
+            if wait<=0: break
+            self.cond.wait(wait)
+          else:
+            self.cond.wait()
+        if self.stopped: return
+        frame = self.frames[self.pos]
+        if not self.speed: self._anchor = (time.time(),self.times[self.pos])
+        self.pos += 1
+      self.listener.feed(self.headers,frame)
+      self.fed += 1
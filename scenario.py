@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+# scripted scenarios of timed event solutions and synthetic station traffic.
+# a scenario file has one message (or a series of messages) per line:
+#   TIME TYPE [ARGS] [OPTION=VALUE ...]
+# TIME is in seconds from the start of the scenario. types:
+#   dm ID MAG LAT LON DEPTH   a decision module (DM) event solution
+#   e2 ID MAG LAT LON DEPTH   an E2 event solution
+#   trigger                   a synthetic trigger of the next station
+#   params [N]                synthetic trigger parameters of the next N stations (default 1)
+#   peaks [N]                 synthetic ground motion peaks of N stations (default all)
+# options:
+#   count=N every=SECONDS     repeat N times every SECONDS (default 1 and 1)
+#   delay=SECONDS             seconds from origin time to the first solution (dm and e2, default 5)
+#   dmag=X dlat=X dlon=X      change of magnitude and location on every repetition (dm and e2)
+#   topic=DESTINATION         publish to DESTINATION instead of the default topic of the type
+# synthetic messages use 100 random stations unless a line without TIME sets them:
+#   stations FILE|N           stations from an ElViS stations file or N random stations
+# '#' starts a comment. example:
+#   stations stations.cfg
+#   0    peaks count=600 every=0.1
+#   2.0  trigger count=20 every=0.05
+#   3.5  dm test1 4.2 31.7 35.2 10 delay=4 count=10 every=1 dmag=0.1
+#
+# run: python scenario.py FILE [--host HOST] [--port PORT] [--speed X]
+
+import sys,time,datetime,threading
+import argparse
+import amq2py as AMQ
+import loadgen
+
+TOPICS = {'dm':'/topic/eew.sys.dm.data', # see ElViS.py for topics
+          'e2':'/topic/eew.alg.elarms.data',
+          'trigger':'/topic/eew.alg.elarms.trigger.data',
+          'params':'/topic/eew.alg.elarms.trigger.data',
+          'peaks':'/topic/eew.alg.elarms.gmpeak.data'}
+NARGS = {'dm':(5,5),'e2':(5,5),'trigger':(0,0),'params':(0,1),'peaks':(0,1)} # (min,max) arguments per type
+
+class Scenario(object):
+  '''Timed messages of a scenario file. render returns the message bodies ready to publish.'''
+  def __init__(self,path=None,seed=None):
+    self.entries = [] # (time,type,args,options), in file order
+    self.generator = loadgen.LoadGenerator(100,seed=seed) # synthetic stations
+    if path: self.load(path)
+
+  def load(self,path):
+    'add the entries of a scenario file. raises ValueError on a bad line'
+    with open(path) as f:
+      for n,line in enumerate(f):
+        try:
+          self.parse(line)
+        except (ValueError,IOError),msg:
+          raise ValueError('%s line %d: %s'%(path,n+1,msg))
+    return self
+
+  def parse(self,line):
+    'add the entry of a scenario line'
+    words = line.split('#')[0].split()
+    if not words: return
+    if words[0]=='stations':
+      if len(words)!=2: raise ValueError('expected: stations FILE|N')
+      if words[1].isdigit():
+        self.generator = loadgen.LoadGenerator(int(words[1]),seed=self.generator.random.randint(1<<30))
+      else:
+        self.generator.loadstations(words[1])
+      return
+    if len(words)<2: raise ValueError('expected: TIME TYPE [ARGS] [OPTION=VALUE ...]')
+    t = float(words[0])
+    type = words[1]
+    if not type in NARGS: raise ValueError('unknown type %s'%type)
+    args = [w for w in words[2:] if not '=' in w]
+    options = dict([w.split('=',1) for w in words[2:] if '=' in w])
+    if not NARGS[type][0]<=len(args)<=NARGS[type][1]: raise ValueError('wrong number of arguments for %s'%type)
+    if type in ('dm','e2'): args = [args[0]]+[float(a) for a in args[1:]]
+    else: args = [int(a) for a in args]
+    for k in options:
+      if k=='topic': continue
+      if not k in ('count','every','delay','dmag','dlat','dlon'): raise ValueError('unknown option %s'%k)
+      options[k] = float(options[k])
+    self.entries.append((t,type,args,options))
+
+  def times(self):
+    'sorted (time,entry index,repetition) of all messages'
+    times = []
+    for i,(t,type,args,options) in enumerate(self.entries):
+      every = options.get('every',1.0)
+      times += [(t+k*every,i,k) for k in range(int(options.get('count',1)))]
+    times.sort()
+    return times
+
+  def __len__(self):
+    return sum([int(o.get('count',1)) for t,type,args,o in self.entries])
+
+  def duration(self):
+    'time of the last message'
+    times = self.times()
+    return times[-1][0] if times else 0.0
+
+  def render(self,t0=None,speed=1.0):
+    '''list of (time,destination,body) of all messages, sorted by time.
+       message time stamps are the times they should be sent: t0 (default now) plus scenario time / speed.'''
+    t0 = time.time() if t0 is None else t0
+    rendered = []
+    for t,i,k in self.times():
+      entry,type,args,options = self.entries[i]
+      ts = t0+t/speed
+      if type in ('dm','e2'):
+        Eid,mag,lat,lon,depth = args
+        mag += k*options.get('dmag',0.0)
+        lat += k*options.get('dlat',0.0)
+        lon += k*options.get('dlon',0.0)
+        delay = options.get('delay',5.0)+(t-entry)/speed # origin time stays put (at entry) as the solution is updated
+        render = AMQ.getDMxmlmsg if type=='dm' else AMQ.getE2xmlmsg
+        body = render(Eid,round(mag,2),round(lat,4),round(lon,4),depth,delay,now=datetime.datetime.utcfromtimestamp(ts))
+      elif type=='trigger':
+        body = self.generator.trigger(ts=ts)
+      elif type=='params':
+        body = self.generator.trigparam(args[0] if args else 1,ts=ts)
+      else:
+        body = self.generator.gmpeak(args[0] if args else None,ts=ts)
+      rendered.append((t/speed,options.get('topic',TOPICS[type]),body))
+    return rendered
+
+class ScenarioPlayer(object):
+  '''Publish a scenario through an AMQWriter at its relative times.
+     all bodies are rendered before playing starts and the writer connection is kept open.
+     late is the maximal delay (seconds) of a message from its planned time.'''
+  def __init__(self,writer,scenario,speed=1.0,lead=1.0):
+    if speed<=0: raise ValueError('Speed must be positive')
+    self.writer = writer
+    self.scenario = scenario
+    self.speed = speed
+    self.lead = lead # seconds between rendering and the first message
+    self.messages = []
+    self.t0 = None
+    self.sent = 0
+    self.failed = 0
+    self.late = 0.0
+    self.stopped = threading.Event()
+    self.thread = None
+
+  def start(self):
+    'render and start playing in a background thread. returns self'
+    self.writer.connectToActiveMQ() # don't pay the handshake on the first message
+    self.t0 = time.time()+self.lead
+    self.messages = self.scenario.render(self.t0,self.speed)
+    self.thread = threading.Thread(target=self._run,name='scenario-player')
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def _run(self):
+    for t,dest,body in self.messages:
+      wait = self.t0+t-time.time()
+      if wait>0 and self.stopped.wait(wait): return
+      if self.stopped.is_set(): return
+      self.late = max(self.late,time.time()-self.t0-t)
+      try:
+        self.writer.sendActiveMQmsg(body,dest)
+        self.sent += 1
+      except Exception:
+        self.failed += 1
+
+  def stop(self):
+    'stop playing'
+    self.stopped.set()
+
+  def wait(self,timeout=None):
+    'wait for the scenario to end'
+    if self.thread: self.thread.join(timeout)
+
+  def done(self):
+    return self.thread is not None and not self.thread.is_alive()
+
+  def __len__(self):
+    return len(self.messages)
+
+parser = argparse.ArgumentParser(description='Play an ElViS scenario file to an ActiveMQ server.')
+parser.add_argument('scenario',help='scenario file')
+parser.add_argument('--host',default='localhost',help='ActiveMQ host')
+parser.add_argument('--port',default=61613,type=int,help='ActiveMQ STOMP port')
+parser.add_argument('--user',default='decimod',help='ActiveMQ user')
+parser.add_argument('--passwd',default='decimod',help='ActiveMQ password')
+parser.add_argument('--speed',default=1.0,type=float,help='speed factor')
+parser.add_argument('--seed',default=None,type=int,help='random seed of synthetic stations and values')
+
+if __name__=="__main__":
+  args = parser.parse_args(sys.argv[1:])
+  try:
+    scenario = Scenario(args.scenario,args.seed)
+  except (ValueError,IOError),msg:
+    sys.exit(str(msg))
+  writer = AMQ.AMQWriter(usr=args.user,passwd=args.passwd,host_and_ports=[(args.host,args.port)])
+  player = ScenarioPlayer(writer,scenario,args.speed)
+  print >> sys.stderr,'Playing %d messages over %.1f seconds...'%(len(scenario),scenario.duration()/args.speed)
+  player.start()
+  try:
+    while not player.done(): player.wait(0.5)
+  except KeyboardInterrupt:
+    player.stop()
+  print >> sys.stderr,'Sent %d messages, %d failed. Maximal delay %.1f ms'%(player.sent,player.failed,player.late*1e3)
+  writer.disconnectToActiveMQ()
@@ -0,0 +1,353 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# station inventory, lookup and markers for the viewer.
+# a station record is the position of the station in the inventory (the order of the stations file),
+# which is also its position in the StationMarkers arrays (AppForm.stations).
+#
+# usage:
+#   stations = loadinventory('stations.cfg','cache') # parsed once, then read from the cache until the file changes
+#   index = StationIndex(stations['net'],stations['sta'])
+#   index.get('IS.MMA') -> 3, index.get('IS.MMA.00.HHZ') -> 3, index.get('XX.NONE') -> None
+#   index.lookup(packets['net'],packets['sta']) -> array of records, -1 for unknown stations
+#   markers = StationMarkers(ax,lon,lat,index.ids)
+#   markers.setvalues([3],[0.5],'amax',[(1,0,0,1)]); markers.trigger([3]); markers.update(); canvas.draw()
+#   active = Expiry(60.0); active.touch([3]); ... markers.deactivate(active.expired())
+#   hover = HoverIndex(5.0); hover.build(ax.transData.transform(lonlat),keys,ax.bbox.extents); hover.query(evt.x,evt.y)
+
+import os,time,threading,hashlib
+from heapq import heappush,heappop,heapify
+from numpy import loadtxt,load,save,atleast_1d,array,asarray,argsort,searchsorted,where,empty,dtype,int64,zeros,ones,nan,isnan,column_stack,isfinite,floor,hypot,concatenate,arange
+
+STATIONtype = dtype([('net','|S8'),('sta','|S8'),('lat',float),('lon',float)]) # inventory records. StationXML codes are up to 8 characters
+XMLEXTENSIONS = ('.xml','.stationxml') # files read as StationXML
+
+def readstations(path):
+  '''parse a stations file as a STATIONtype array. the file is in the format of:
+       [network] [station] [latitude] [longitude]
+     additional columns are ignored and '#' starts a comment.
+     StationXML files (see XMLEXTENSIONS) are read with obspy.'''
+  if os.path.splitext(path)[1].lower() in XMLEXTENSIONS: return readstationxml(path)
+  return atleast_1d(loadtxt(path,dtype=STATIONtype,usecols=range(4)))
+
+def readstationxml(path):
+  'the stations of a StationXML file as a STATIONtype array'
+  from obspy import read_inventory # only needed for StationXML
+  inventory = read_inventory(path,format='STATIONXML')
+  return array([(n.code,s.code,s.latitude,s.longitude) for n in inventory for s in n],dtype=STATIONtype)
+
+def _digest(path):
+  'md5 of a file content'
+  h = hashlib.md5()
+  with open(path,'rb') as f:
+    for block in iter(lambda: f.read(1<<20),''): h.update(block)
+  return h.hexdigest()
+
+def _replace(path,write):
+  'write a file through a temporary file, so readers never see it half written'
+  tmp = '%s.%d.tmp'%(path,os.getpid())
+  with open(tmp,'wb') as f: write(f)
+  os.rename(tmp,path)
+
+def loadinventory(path,cachedir=''):
+  '''the stations of a stations file (see readstations) as a STATIONtype array.
+     with cachedir the parsed stations are cached there as a .npy file and memory mapped from it
+     as long as the file size and mtime, or else its content (md5), did not change.'''
+  if not cachedir: return readstations(path)
+  st = os.stat(path)
+  cache = os.path.join(cachedir,'%s.%s.npy'%(os.path.basename(path),hashlib.md5(os.path.abspath(path)).hexdigest()[:8]))
+  stamp = '%d %r'%(st.st_size,st.st_mtime)
+  try:
+    with open(cache+'.key') as f: cachedstamp,digest = f.read().strip().rsplit(' ',1)
+  except (IOError,ValueError):
+    cachedstamp,digest = None,None
+  if cachedstamp==stamp and os.path.exists(cache):
+    stations = load(cache,mmap_mode='r')
+    if stations.dtype==STATIONtype: return stations
+    digest = None # cached with other record widths. parse again
+  current = _digest(path)
+  if current==digest and os.path.exists(cache): # touched but not changed
+    stations = load(cache,mmap_mode='r')
+  else:
+    stations = readstations(path)
+    try:
+      if not os.path.exists(cachedir): os.makedirs(cachedir)
+      _replace(cache,lambda f: save(f,stations))
+    except (IOError,OSError):
+      return stations # can't cache. parse again next time
+  try:
+    _replace(cache+'.key',lambda f: f.write('%s %s\n'%(stamp,current)))
+  except (IOError,OSError):
+    pass
+  return stations
+
+def diffinventory(old,new):
+  '''(added,removed,moved) net.sta ids between two lists of (id,lon,lat)'''
+  old = dict([(ID,(lon,lat)) for ID,lon,lat in reversed(old)])
+  new = dict([(ID,(lon,lat)) for ID,lon,lat in reversed(new)])
+  added = [ID for ID in new if not ID in old]
+  removed = [ID for ID in old if not ID in new]
+  moved = [ID for ID in new if ID in old and new[ID]!=old[ID]]
+  return sorted(added),sorted(removed),sorted(moved)
+
+class StationIndex(object):
+  '''Map net.sta and net.sta.loc.chn station ids to station records.
+     single ids are looked up in a dict. arrays of net and sta codes (e.g. all packets of a message)
+     are looked up at once by a binary search over fixed width net+sta keys.'''
+  widths = (3,5) # minimal (net,sta) key widths. those of the gmpeak and trigger packets
+  def __init__(self,net=[],sta=[]):
+    self.net = asarray(net,dtype=str)
+    self.sta = asarray(sta,dtype=str)
+    self.ids = ['.'.join(k) for k in zip(self.net.tolist(),self.sta.tolist())] # net.sta of each record
+    self.index = dict([(ID,i) for i,ID in reversed(list(enumerate(self.ids)))]) # net.sta -> record. the first of duplicated ids wins
+    self.channels = {} # net.sta.loc.chn -> record, filled as channels are looked up
+    self._keys = {} # (net width,sta width) -> (sorted keys,records)
+  def __len__(self):
+    return len(self.ids)
+  def __contains__(self,ID):
+    return self.get(ID) is not None
+  def get(self,ID,default=None):
+    'the record of a net.sta or net.sta.loc.chn id'
+    i = self.index.get(ID)
+    if i is not None: return i
+    i = self.channels.get(ID)
+    if i is not None: return i
+    parts = ID.split('.')
+    if len(parts)!=4: return default
+    i = self.index.get('.'.join(parts[:2]))
+    if i is None: return default
+    self.channels[ID] = i
+    return i
+  def records(self,ids):
+    'records of a list of net.sta or net.sta.loc.chn ids. unknown stations get -1'
+    return array([self.get(ID,-1) for ID in ids],dtype=int64)
+  def _key(self,net,sta,widths):
+    'fixed width net+sta keys as one string array'
+    k = empty(len(net),dtype([('net','S%d'%widths[0]),('sta','S%d'%widths[1])]))
+    k['net'] = net
+    k['sta'] = sta
+    return k.view('S%d'%sum(widths))
+  def lookup(self,net,sta):
+    'records of arrays of net and sta codes in one vectorized step. unknown stations get -1'
+    net,sta = asarray(net),asarray(sta)
+    if not len(self.ids) or not len(net): return array([-1]*len(net),dtype=int64)
+    widths = tuple([max(w,a.itemsize,b.itemsize) for w,a,b in zip(self.widths,(net,sta),(self.net,self.sta))])
+    if not widths in self._keys: # sort the inventory keys once per key width
+      keys = self._key(self.net,self.sta,widths)
+      order = argsort(keys,kind='mergesort') # stable, so the first of duplicated ids is found
+      self._keys[widths] = (keys[order],order)
+    keys,order = self._keys[widths]
+    k = self._key(net,sta,widths)
+    pos = searchsorted(keys,k).clip(0,len(keys)-1)
+    return where(keys[pos]==k,order[pos],-1)
+
+class StationMarkers(object):
+  '''All stations drawn as one scatter collection backed by arrays of positions, face colors,
+     edge colors, sizes and values. changes are array writes. update() pushes them to the collection,
+     so the cost of a redraw doesn't depend on how many stations changed.
+     stations are drawn in order of their state: idle, active (got values) and triggered on top.
+     colors are RGBA tuples or (n,4) arrays.'''
+  IDLE,ACTIVE,TRIGGERED = 0,1,2 # draw order of station states
+  def __init__(self,ax,lon,lat,ids,marker='^',size=6,trigsize=10,color=(0,0,0,1),edgecolor=(0,0,0,1),trigedgecolor=(1,0,0,1),zorder=3):
+    self.ax = ax
+    self.ids = list(ids)
+    n = len(self.ids)
+    self.positions = column_stack([asarray(lon,dtype=float),asarray(lat,dtype=float)]).reshape(n,2)
+    self.color = tuple(color)
+    self.edgecolor = tuple(edgecolor)
+    self.trigedgecolor = tuple(trigedgecolor)
+    self.size = size**2 # marker size in points, the scatter size is its square
+    self.trigsize = trigsize**2
+    self.facecolors = array([self.color]*n,dtype=float).reshape(n,4)
+    self.edgecolors = array([self.edgecolor]*n,dtype=float).reshape(n,4)
+    self.sizes = ones(n)*self.size
+    self.values = empty(n) # last value of each station, nan for none
+    self.values.fill(nan)
+    self.quantities = [None]*n # the quantity (amax,vmax,dmax) of each value
+    self.active = zeros(n,dtype=bool) # got values and not expired yet
+    self.triggered = zeros(n,dtype=bool)
+    self.order = argsort(zeros(n),kind='mergesort') # records in draw order
+    self.collection = ax.scatter(self.positions[:,0],self.positions[:,1],s=self.sizes,c=self.facecolors,marker=marker,
+                                 edgecolors=self.edgecolors,linewidths=1.0,zorder=zorder)
+    self.stale = False # arrays changed since the last update
+  def __len__(self):
+    return len(self.ids)
+  def setvalues(self,records,values,quantity,colors):
+    'set the values (of quantity) and face colors of station records. the stations become active'
+    records = asarray(records,dtype=int64)
+    self.values[records] = values
+    for i in records.tolist(): self.quantities[i] = quantity
+    self.facecolors[records] = colors
+    self.active[records] = True
+    self.stale = True
+  def deactivate(self,records):
+    'mark station records as inactive (no recent values)'
+    records = asarray(records,dtype=int64)
+    self.facecolors[records] = self.color
+    self.active[records] = False
+    self.stale = True
+  def trigger(self,records):
+    'highlight station records as triggered'
+    records = asarray(records,dtype=int64)
+    self.sizes[records] = self.trigsize
+    self.edgecolors[records] = self.trigedgecolor
+    self.triggered[records] = True
+    self.stale = True
+  def untrigger(self,records):
+    'remove the trigger highlight of station records'
+    records = asarray(records,dtype=int64)
+    self.sizes[records] = self.size
+    self.edgecolors[records] = self.edgecolor
+    self.triggered[records] = False
+    self.stale = True
+  def reload(self,lon,lat,ids):
+    '''change to a new station list in place. stations in both lists keep their state (values,
+       colors, activity and trigger), others start idle. returns {old record: new record} of kept stations'''
+    old = dict([(ID,i) for i,ID in reversed(list(enumerate(self.ids)))])
+    ids = list(ids)
+    kept = [(old[ID],i) for i,ID in enumerate(ids) if ID in old]
+    o,k = (array(x,dtype=int64) for x in zip(*kept)) if kept else (array([],dtype=int64),)*2
+    n = len(ids)
+    facecolors,edgecolors,sizes,values = array([self.color]*n,dtype=float).reshape(n,4),array([self.edgecolor]*n,dtype=float).reshape(n,4),ones(n)*self.size,empty(n)
+    values.fill(nan)
+    active,triggered,quantities = zeros(n,dtype=bool),zeros(n,dtype=bool),[None]*n
+    facecolors[k],edgecolors[k],sizes[k],values[k] = self.facecolors[o],self.edgecolors[o],self.sizes[o],self.values[o]
+    active[k],triggered[k] = self.active[o],self.triggered[o]
+    for i,j in kept: quantities[j] = self.quantities[i]
+    self.ids = ids
+    self.positions = column_stack([asarray(lon,dtype=float),asarray(lat,dtype=float)]).reshape(n,2)
+    self.facecolors,self.edgecolors,self.sizes,self.values = facecolors,edgecolors,sizes,values
+    self.active,self.triggered,self.quantities = active,triggered,quantities
+    self.stale = True
+    return dict(kept)
+  def label(self,i):
+    'the label of a station record with its last value'
+    if isnan(self.values[i]): return self.ids[i]
+    return self.ids[i]+' (%s=%0.2e)'%(self.quantities[i],self.values[i])
+  def update(self):
+    'push changed arrays to the collection. call before drawing'
+    if not self.stale: return
+    self.stale = False
+    state = where(self.triggered,self.TRIGGERED,where(self.active,self.ACTIVE,self.IDLE))
+    self.order = order = argsort(state,kind='mergesort') # stable, so stations keep the inventory order within a state
+    self.collection.set_offsets(self.positions[order])
+    self.collection.set_facecolors(self.facecolors[order])
+    self.collection.set_edgecolors(self.edgecolors[order])
+    self.collection.set_sizes(self.sizes[order])
+  def contains(self,evt):
+    'station records under a mouse event'
+    hit,info = self.collection.contains(evt)
+    if not hit: return []
+    return self.order[info['ind']].tolist()
+  def remove(self):
+    self.collection.remove()
+
+class Expiry(object):
+  '''Keys (e.g. station records) that expire timeout seconds after they were last touched.
+     the deadlines are kept in a min-heap with at most one entry per key. touching a key again only
+     moves its deadline, and its heap entry is pushed back when it comes due, so expired() only visits
+     keys that expired or were touched since their entry was pushed.'''
+  def __init__(self,timeout):
+    self.timeout = timeout
+    self.deadlines = {} # key -> deadline
+    self.heap = [] # (deadline,key) with a deadline not later than the key's deadline
+    self.lock = threading.Lock()
+  def __len__(self):
+    return len(self.deadlines)
+  def __contains__(self,key):
+    return key in self.deadlines
+  def touch(self,keys,now=None):
+    'keys (a list) were seen now. they expire timeout seconds from now'
+    deadline = (time.time() if now is None else now)+self.timeout
+    with self.lock:
+      for key in keys:
+        if not key in self.deadlines: heappush(self.heap,(deadline,key))
+        self.deadlines[key] = deadline
+  def expired(self,now=None):
+    'remove and return the keys that expired by now'
+    if now is None: now = time.time()
+    expired = []
+    with self.lock:
+      while self.heap and self.heap[0][0]<=now:
+        deadline,key = heappop(self.heap)
+        current = self.deadlines.get(key)
+        if current is None: continue # discarded
+        if current<=now:
+          del self.deadlines[key]
+          expired.append(key)
+        else: # touched since. wait for the new deadline
+          heappush(self.heap,(current,key))
+    return expired
+  def remap(self,mapping):
+    'rename keys by mapping ({old key: new key}). keys not in mapping are forgotten'
+    with self.lock:
+      self.deadlines = dict([(mapping[k],d) for k,d in self.deadlines.items() if k in mapping])
+      self.heap = [(d,k) for k,d in self.deadlines.items()]
+      heapify(self.heap)
+  def discard(self,key):
+    'forget a key without expiring it'
+    with self.lock:
+      self.deadlines.pop(key,None)
+  def clear(self):
+    with self.lock:
+      self.deadlines = {}
+      self.heap = []
+
+class HoverIndex(object):
+  '''Screen space index of map items for mouse hover lookup. points (display pixels) are binned in a
+     grid of radius sized cells kept as sorted cell keys, so a lookup is a binary search for each of
+     the 3x3 cells around the pointer. build it again when the view or the items change.'''
+  def __init__(self,radius=5.0):
+    self.radius = radius
+    self.build([],[])
+  def __len__(self):
+    return len(self.keys)
+  def build(self,points,keys,extents=None):
+    '''index points ((n,2) display pixels) with their keys. with extents (x0,y0,x1,y1), usually the axes
+       bounding box, only points within radius of it are kept'''
+    xy = asarray(points,dtype=float).reshape(-1,2)
+    keep = isfinite(xy).all(1)
+    if extents is not None:
+      x0,y0,x1,y1 = extents
+      r = self.radius
+      keep &= (xy[:,0]>=x0-r)&(xy[:,0]<=x1+r)&(xy[:,1]>=y0-r)&(xy[:,1]<=y1+r)
+    xy = xy[keep]
+    cells = self._cells(xy[:,0],xy[:,1])
+    order = argsort(cells,kind='mergesort')
+    self.cells = cells[order]
+    self.xy = xy[order]
+    keys = [k for k,ok in zip(keys,keep.tolist()) if ok]
+    self.keys = [keys[i] for i in order.tolist()]
+  def _cells(self,x,y):
+    'cell keys of display coordinates'
+    return (floor(asarray(x)/self.radius).astype(int64)<<32)+floor(asarray(y)/self.radius).astype(int64)
+  def query(self,x,y):
+    'keys of the items within radius of display point (x,y), nearest first'
+    if not len(self.keys): return []
+    c = self._cells(x,y)
+    near = array([c+(dx<<32)+dy for dx in (-1,0,1) for dy in (-1,0,1)])
+    lo = searchsorted(self.cells,near,'left')
+    hi = searchsorted(self.cells,near,'right')
+    i = concatenate([arange(a,b) for a,b in zip(lo,hi)])
+    if not len(i): return []
+    d = hypot(self.xy[i,0]-x,self.xy[i,1]-y)
+    hit = d<=self.radius
+    return [self.keys[j] for j in i[hit][argsort(d[hit],kind='mergesort')]]
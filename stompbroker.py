@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# a lightweight in-process STOMP 1.0-1.2 broker for tests and benchmarks.
+# supports topics only: CONNECT/STOMP, SUBSCRIBE, UNSUBSCRIBE, SEND, DISCONNECT and receipts.
+# delivery can be delayed (latency, jitter) and bursts of messages can be published from the broker side.
+#
+# usage:
+#   broker = StompBroker(port=0).start()
+#   listener = amq2py.AMQListener(host_and_ports=broker.host_and_ports)
+#   ...
+#   broker.stop()
+
+import sys,time,random,socket,threading,itertools
+import SocketServer
+import heapq
+import argparse
+
+VERSIONS = ('1.0','1.1','1.2')
+_escapes = [('\\','\\\\'),('\r','\\r'),('\n','\\n'),(':','\\c')]
+
+def escape(s,version):
+  'escape a header value'
+  if version=='1.0': return s
+  for a,b in _escapes: s = s.replace(a,b)
+  return s
+
+def unescape(s,version):
+  'unescape a header value'
+  if version=='1.0': return s
+  out,i = [],0
+  while i<len(s):
+    if s[i]=='\\' and i+1<len(s):
+      out.append({'\\':'\\','r':'\r','n':'\n','c':':'}.get(s[i+1],s[i+1]))
+      i += 2
+    else:
+      out.append(s[i])
+      i += 1
+  return ''.join(out)
+
+def encodeframe(command,headers,body='',version='1.2'):
+  'a STOMP frame as a string'
+  lines = [command]+['%s:%s'%(escape(str(k),version),escape(str(v),version)) for k,v in headers.items()]
+  return '\n'.join(lines)+'\n\n'+body+'\0'
+
+class FrameReader(object):
+  'read STOMP frames from a socket'
+  def __init__(self,sock):
+    self.sock = sock
+    self.buf = ''
+  def _fill(self):
+    data = self.sock.recv(65536)
+    if not data: raise EOFError
+    self.buf += data
+  def read(self,version='1.0'):
+    'next (command,headers,body). raises EOFError when the peer is gone'
+    while True: # skip heart beats
+      self.buf = self.buf.lstrip('\r\n')
+      if self.buf: break
+      self._fill()
+    while True:
+      end = self.buf.find('\n\n')
+      crlf = self.buf.find('\r\n\r\n')
+      if crlf>=0 and (end<0 or crlf<end): end,sep = crlf,4
+      else: sep = 2
+      if end>=0: break
+      self._fill()
+    lines = self.buf[:end].replace('\r\n','\n').split('\n')
+    self.buf = self.buf[end+sep:]
+    command = lines[0]
+    headers = {}
+    for line in lines[1:]:
+      k,v = line.split(':',1)
+      k = unescape(k,version)
+      if not k in headers: headers[k] = unescape(v,version) # first one wins
+    if 'content-length' in headers:
+      n = int(headers['content-length'])
+      while len(self.buf)<n+1: self._fill()
+      body = self.buf[:n]
+      self.buf = self.buf[n+1:]
+    else:
+      while not '\0' in self.buf: self._fill()
+      body,self.buf = self.buf.split('\0',1)
+    return command,headers,body
+
+class _Client(SocketServer.BaseRequestHandler):
+  'one broker connection'
+  def setup(self):
+    self.broker = self.server.broker
+    self.version = '1.0'
+    self.subscriptions = {} # id -> destination
+    self.outbox = [] # heap of (delivery time,sequence,frame)
+    self.seq = itertools.count()
+    self.cond = threading.Condition()
+    self.closed = False
+    self.sender = threading.Thread(target=self._send,name='stomp-broker-sender')
+    self.sender.daemon = True
+    self.sender.start()
+    self.broker._add(self)
+
+  def handle(self):
+    reader = FrameReader(self.request)
+    try:
+      while not self.closed:
+        command,headers,body = reader.read(self.version)
+        if not self.dispatch(command,headers,body): break
+    except (EOFError,socket.error,ValueError):
+      pass
+
+  def finish(self):
+    self.close()
+    self.broker._remove(self)
+
+  def dispatch(self,command,headers,body):
+    'handle a client frame. returns False to close the connection'
+    if command in ('CONNECT','STOMP'):
+      versions = [v for v in headers.get('accept-version','1.0').split(',') if v in VERSIONS]
+      if not versions:
+        self.post('ERROR',{'version':','.join(VERSIONS),'message':'Supported protocol versions are %s'%' '.join(VERSIONS)},'',0)
+        return False
+      self.version = max(versions)
+      connected = {'session':'session-%d'%id(self),'server':'ElViS-stompbroker/1.0'}
+      if self.version!='1.0':
+        connected['version'] = self.version
+        connected['heart-beat'] = '0,0'
+      self.post('CONNECTED',connected,'',0)
+    elif command=='SUBSCRIBE':
+      self.subscriptions[headers.get('id',headers.get('destination'))] = headers.get('destination')
+    elif command=='UNSUBSCRIBE':
+      self.subscriptions.pop(headers.get('id',headers.get('destination')),None)
+    elif command=='SEND':
+      self.broker.publish(headers.get('destination'),body,dict([(k,v) for k,v in headers.items() if not k in ('destination','content-length','receipt')]))
+    elif command=='DISCONNECT':
+      if 'receipt' in headers: self.post('RECEIPT',{'receipt-id':headers['receipt']},'',0)
+      return False
+    if 'receipt' in headers: self.post('RECEIPT',{'receipt-id':headers['receipt']},'',0)
+    return True
+
+  def deliver(self,destination,body,headers,messageid,delay):
+    'send a message to all of this client subscriptions of destination'
+    for sid,dest in self.subscriptions.items():
+      if dest==destination:
+        h = dict(headers)
+        h.update({'destination':destination,'message-id':messageid,'subscription':sid,'content-length':len(body)})
+        self.post('MESSAGE',h,body,delay)
+
+  def post(self,command,headers,body,delay):
+    'queue a frame to be sent after delay seconds'
+    frame = encodeframe(command,headers,body,self.version)
+    with self.cond:
+      heapq.heappush(self.outbox,(time.time()+delay,self.seq.next(),frame))
+      self.cond.notify()
+
+  def _send(self):
+    while True:
+      with self.cond:
+        while not self.closed:
+          if self.outbox:
+            wait = self.outbox[0][0]-time.time()
+            if wait<=0: break
+            self.cond.wait(wait)
+          else:
+            self.cond.wait()
+        if self.closed: return
+        frame = heapq.heappop(self.outbox)[2]
+      try:
+        self.request.sendall(frame)
+        self.broker.sent += 1
+      except socket.error:
+        self.close()
+        return
+
+  def close(self):
+    'stop sending and drop the connection'
+    with self.cond:
+      if self.closed: return
+      self.closed = True
+      self.cond.notify_all()
+    try:
+      self.request.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+      pass
+
+class _Server(SocketServer.ThreadingMixIn,SocketServer.TCPServer):
+  daemon_threads = True
+  allow_reuse_address = True
+
+class StompBroker(object):
+  '''An in-process STOMP broker with topics only.
+     latency (seconds) delays every delivery, jitter adds a random delay of up to jitter seconds.'''
+  def __init__(self,host='localhost',port=61613,latency=0.0,jitter=0.0):
+    self.latency = latency
+    self.jitter = jitter
+    self.server = _Server((host,port),_Client,bind_and_activate=True)
+    self.server.broker = self
+    self.clients = []
+    self.lock = threading.Lock()
+    self.received = 0 # messages published
+    self.sent = 0 # frames sent to clients
+    self._ids = itertools.count()
+    self.thread = None
+
+  @property
+  def host_and_ports(self):
+    'address to connect to, as used by stomp.Connection'
+    return [self.server.server_address[:2]]
+
+  def start(self):
+    'serve in a background thread. returns self'
+    self.thread = threading.Thread(target=self.server.serve_forever,name='stomp-broker')
+    self.thread.daemon = True
+    self.thread.start()
+    return self
+
+  def stop(self):
+    'stop serving and drop all connections'
+    self.server.shutdown()
+    self.server.server_close()
+    self.disconnect()
+
+  def _add(self,client):
+    with self.lock: self.clients.append(client)
+
+  def _remove(self,client):
+    with self.lock:
+      if client in self.clients: self.clients.remove(client)
+
+  def disconnect(self):
+    'drop all client connections (e.g. to test reconnection)'
+    with self.lock: clients = list(self.clients)
+    [c.close() for c in clients]
+
+  def subscribers(self,destination):
+    'number of subscriptions to destination'
+    with self.lock:
+      return sum([c.subscriptions.values().count(destination) for c in self.clients])
+
+  def publish(self,destination,body,headers={}):
+    'deliver a message to all subscribers of destination'
+    delay = self.latency+(random.uniform(0,self.jitter) if self.jitter else 0)
+    messageid = 'message-%d'%self._ids.next()
+    with self.lock:
+      self.received += 1
+      clients = list(self.clients)
+    for c in clients: c.deliver(destination,body,headers,messageid,delay)
+
+  def burst(self,destination,bodies,headers={}):
+    'publish a burst of messages to destination at once'
+    for body in bodies: self.publish(destination,body,headers)
+
+parser = argparse.ArgumentParser(description='A lightweight STOMP broker for ElViS testing.')
+parser.add_argument('--host',default='localhost',help='interface to listen on')
+parser.add_argument('--port',default=61613,type=int,help='port to listen on')
+parser.add_argument('--latency',default=0.0,type=float,help='delivery latency in seconds')
+parser.add_argument('--jitter',default=0.0,type=float,help='random additional delivery latency up to jitter seconds')
+
+if __name__=="__main__":
+  args = parser.parse_args(sys.argv[1:])
+  broker = StompBroker(args.host,args.port,args.latency,args.jitter)
+  print >> sys.stderr,'STOMP broker listening on %s:%d'%broker.host_and_ports[0]
+  try:
+    broker.server.serve_forever()
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+# end to end: frames published through the in-process STOMP broker (stompbroker.py) to an AMQListener,
+# decoded by its workers and logged with the triggers log index (see triglog.py).
+# run: python -m unittest discover -s tests
+
+import sys,os,glob,time,shutil,tempfile,unittest
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)) # the ElViS modules
+import amq2py as AMQ
+import loadgen
+import stompbroker
+import triglog
+import replay
+
+def wait(condition,timeout=10.0):
+  'wait until condition() is true. returns its last value'
+  t = time.time()
+  while not condition() and time.time()-t<timeout: time.sleep(0.01)
+  return condition()
+
+class BrokerTest(unittest.TestCase):
+  def setUp(self):
+    self.cwd = os.getcwd()
+    self.dir = tempfile.mkdtemp()
+    os.chdir(self.dir) # the listener logs to ./log
+    os.mkdir('log')
+    self.broker = stompbroker.StompBroker(port=0).start()
+    self.logwriter = AMQ.LogWriter(flushsize=512) # many small flushes, so the log and index grow in steps
+    self.listener = AMQ.AMQListener(name='test',host_and_ports=self.broker.host_and_ports,log=True,workers=2,logwriter=self.logwriter)
+    self.processed = []
+    self.listener.processMessages = lambda: self.processed.append(self.listener._lastMessage)
+    self.listener.connectToActiveMQ()
+    self.listener.subscribeToActiveMQ('/topic/test','test')
+    self.assertTrue(wait(lambda: self.broker.subscribers('/topic/test')))
+
+  def tearDown(self):
+    self.listener.disconnectToActiveMQ()
+    self.listener.stopWorkers()
+    self.logwriter.close()
+    self.broker.stop()
+    os.chdir(self.cwd)
+    shutil.rmtree(self.dir)
+
+  def test_publish(self):
+    gen = loadgen.LoadGenerator(20,seed=2)
+    frames = []
+    for i in range(40):
+      frames += [gen.trigger(),gen.gmpeak()]
+      if i%10==0: frames += [gen.trigparam(3),'P'+'\0'*40,gen.event()] # a bad trigger parameters frame is logged too
+    for m in frames: self.broker.publish('/topic/test',m)
+    self.assertTrue(wait(lambda: sum(self.listener.decoded.values())+self.listener.decodeerrors==len(frames)))
+    self.assertEqual(self.listener.decodeerrors,4)
+    self.assertEqual(self.listener.decoded,{'T':40,'G':40,'P':4,'<':4})
+    triggers = [m for m in frames if m[0]=='T']
+    self.assertEqual([g.raw for g in self.processed if g.type=='T'],triggers) # a lane is processed in order
+    self.assertEqual([g.raw for g in self.processed if g.type=='G'],[m for m in frames if m[0]=='G'])
+    self.logwriter.flush()
+    path, = glob.glob('log/triggers_*.trig')
+    index = open(triglog.indexpath(path),'rb').read() # written as the log was written
+    self.assertEqual(index,triglog.buildindex(path).tostring())
+    log = triglog.TrigLog(path)
+    self.assertEqual(list(log.frames(log.query(types='T'))),triggers)
+    self.assertEqual(len(log.query(types='P')),4*3)
+    log.close()
+    replayed = AMQ.AMQListener(name='replay',workers=0) # the logs fed back, as fast as possible
+    fed = []
+    replayed.processMessages = lambda: fed.append(replayed._lastMessage.raw)
+    player = replay.Replay(replayed,[path],glob.glob('log/events_*.log'),speed=0)
+    player.start()
+    self.assertTrue(wait(player.done))
+    player.stop()
+    self.assertEqual(sorted(fed),sorted([m for m in frames if m[0] in 'T<' or (m[0]=='P' and m[1:]!='\0'*40)]))
+
+if __name__=="__main__":
+  unittest.main()
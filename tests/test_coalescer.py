@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+# PeakCoalescer with a station index replaced while peaks are added.
+# run: python -m unittest discover -s tests
+
+import sys,os,unittest
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)) # the ElViS modules
+import amq2py as AMQ
+import stations
+
+def packets(stas,amax=1.0):
+  'gmpeak packets of IS stations'
+  p = np.zeros(len(stas),AMQ.GMPeakdatatype)
+  p['net'] = 'IS'
+  p['sta'] = stas
+  p['amax'] = amax
+  return p
+
+class PeakCoalescerTest(unittest.TestCase):
+  def test_add_max(self):
+    peaks = AMQ.PeakCoalescer(index=stations.StationIndex(['IS']*3,['A','B','C']))
+    peaks.add(packets(['C','A','C'],[1.0,-2.0,3.0]))
+    batch = peaks.pop()
+    self.assertEqual(sorted(batch),['IS.A','IS.C'])
+    self.assertEqual((batch['IS.A']['amax'],batch['IS.C']['amax']),(2.0,3.0))
+
+  def test_index_replaced_during_add(self):
+    old = stations.StationIndex(['IS']*3,['A','B','C'])
+    new = stations.StationIndex(['IS'],['B'])
+    peaks = AMQ.PeakCoalescer(index=old)
+    lookup = old.lookup
+    def replacing(net,sta): # setindex from another thread between the lookup and the update
+      records = lookup(net,sta)
+      peaks.setindex(new)
+      return records
+    old.lookup = replacing
+    peaks.add(packets(['C'])) # a row of the old arrays only
+    self.assertEqual(peaks.pop(),{})
+    peaks.add(packets(['B','C']))
+    self.assertEqual(sorted(peaks.pop()),['IS.B'])
+
+if __name__=="__main__":
+  unittest.main()
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# GMPeakBatch against GMPeak, in process and in the GMPeakPool processes.
+# run: python -m unittest discover -s tests
+
+import sys,os,unittest
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)) # the ElViS modules
+import amq2py as AMQ
+import loadgen
+
+def raw(packets):
+  'an uncompressed gmpeak frame'
+  h = np.zeros(1,AMQ.HEADERtype)
+  h['type'] = 'G'
+  h['npackets'] = len(packets)
+  return h.tostring()+'\0'+packets.tostring()
+
+class GMPeakBatchTest(unittest.TestCase):
+  def setUp(self):
+    gen = loadgen.LoadGenerator(20,seed=1)
+    self.frames = [gen.gmpeak(),gen.gmpeak(5),raw(AMQ.GMPeak(gen.gmpeak(3)).packets),gen.gmpeak(1)]
+
+  def assertSamePackets(self,a,b):
+    self.assertEqual(len(a),len(b))
+    for name in AMQ.GMPeakdatatype.names:
+      np.testing.assert_array_equal(a[name],b[name])
+
+  def test_decode(self):
+    packets,offsets,failed = AMQ.GMPeakBatch(size=8).decode(self.frames) # grows
+    self.assertEqual(failed,[])
+    self.assertEqual(packets.dtype,AMQ.GMPeaknativetype)
+    for i,m in enumerate(self.frames):
+      self.assertSamePackets(packets[offsets[i]:offsets[i+1]],AMQ.GMPeak(m).packets)
+
+  def test_records(self):
+    batcher = AMQ.GMPeakBatch()
+    records = batcher.records(self.frames)
+    batcher.decode(self.frames[::-1]) # reusing the buffer does not change the records
+    for g,m in zip(records,self.frames):
+      self.assertEqual(g.raw,m)
+      self.assertEqual(g.header['npackets'],AMQ.GMPeak(m).header['npackets'])
+      self.assertSamePackets(g.packets,AMQ.GMPeak(m).packets)
+
+  def test_bad_frames(self):
+    frames = [self.frames[0],self.frames[1][:-20],'G',self.frames[3]]
+    records = AMQ.GMPeakBatch().records(frames)
+    self.assertEqual([r is None for r in records],[False,True,True,False])
+    self.assertSamePackets(records[3].packets,AMQ.GMPeak(frames[3]).packets)
+
+  def test_fixed_buffer(self):
+    batcher = AMQ.GMPeakBatch(out=np.zeros(4,AMQ.GMPeaknativetype))
+    self.assertRaises(ValueError,batcher.decode,self.frames)
+
+  def test_pool(self):
+    pool = AMQ.GMPeakPool(1,rate=0,slots=2)
+    try:
+      for m in self.frames:
+        self.assertSamePackets(pool.decode(m).packets,AMQ.GMPeak(m).packets)
+    finally:
+      pool.close()
+
+  def test_pool_batch(self):
+    pool = AMQ.GMPeakPool(2,rate=0,slots=3,slotsize=64) # more chunks than slots
+    frames = self.frames*3+['G',raw(np.zeros(100,AMQ.GMPeakdatatype))] # a bad frame and one too large for a slot
+    try:
+      records = pool.decodebatch(frames)
+      self.assertEqual([r is None for r in records[-2:]],[True,True])
+      for g,m in zip(records[:-2],frames):
+        self.assertEqual(g.raw,m)
+        self.assertSamePackets(g.packets,AMQ.GMPeak(m).packets)
+      self.assertEqual(pool.decoded,len(frames)-2)
+      self.assertEqual(pool.failures,0)
+      self.assertEqual(pool.free.qsize(),3)
+    finally:
+      pool.close()
+
+if __name__=="__main__":
+  unittest.main()
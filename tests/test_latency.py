@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+# LatencyMonitor per station samples.
+# run: python -m unittest discover -s tests
+
+import sys,os,time,unittest
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)) # the ElViS modules
+import amq2py as AMQ
+import loadgen
+
+class LatencyMonitorTest(unittest.TestCase):
+  def setUp(self):
+    gen = loadgen.LoadGenerator(20,seed=1)
+    self.messages = [AMQ.GMPeak(gen.gmpeak()) for i in range(300)]
+    self.station = self.messages[0].packets['net'][0]+'.'+self.messages[0].packets['sta'][0]
+
+  def test_unpolled_stations(self):
+    latency = AMQ.LatencyMonitor(stationwindow=1000,sortinterval=None)
+    for g in self.messages: latency.decoded(g,time.time(),time.time())
+    self.assertEqual(len(latency.samples('source',station=self.station)),300*3) # 3 channels
+    self.assertEqual(latency.stationdropped,0)
+
+  def test_sorter_thread(self):
+    latency = AMQ.LatencyMonitor(sortinterval=0.01)
+    try:
+      for g in self.messages: latency.decoded(g,time.time(),time.time())
+      t = time.time()
+      while latency.unsorted and time.time()-t<5: time.sleep(0.01)
+      self.assertEqual(latency.unsortedsamples,0)
+    finally:
+      latency.close()
+
+  def test_bounded(self):
+    latency = AMQ.LatencyMonitor(stationwindow=1000,sortinterval=None,maxunsorted=1000)
+    unbounded = AMQ.LatencyMonitor(stationwindow=1000,sortinterval=None)
+    for g in self.messages:
+      latency.decoded(g,time.time(),time.time())
+      unbounded.decoded(g,time.time(),time.time())
+    self.assertTrue(0<latency.unsortedsamples<=1000)
+    self.assertEqual(latency.stationdropped+latency.unsortedsamples,unbounded.unsortedsamples)
+    self.assertTrue(0<len(latency.samples('source',station=self.station))<300*3)
+
+if __name__=="__main__":
+  unittest.main()
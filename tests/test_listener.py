@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# AMQListener decoding workers and the MessageQueue lanes feeding them.
+# run: python -m unittest discover -s tests
+
+import sys,os,time,unittest
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)) # the ElViS modules
+import amq2py as AMQ
+
+def trigger(sta='ABC'):
+  'a raw trigger frame'
+  t = np.zeros(1,AMQ.Triggerrawtype)
+  t['type'] = 'T'
+  t['net'] = 'IS'
+  t['sta'] = sta
+  return t.tostring()
+
+def wait(condition,timeout=5.0):
+  'wait until condition() is true. returns its last value'
+  t = time.time()
+  while not condition() and time.time()-t<timeout: time.sleep(0.005)
+  return condition()
+
+class WorkerTest(unittest.TestCase):
+  def test_worker_survives_errors(self):
+    listener = AMQ.AMQListener(name='test',workers=1)
+    processed = []
+    def process():
+      processed.append(listener._lastMessage.sta)
+      if len(processed)==1: raise IndexError('a failing processMessages')
+    listener.processMessages = process
+    try:
+      for i in range(5): listener.feed({},trigger('S%d'%i))
+      self.assertTrue(wait(lambda: len(processed)==5))
+      self.assertEqual(processed,['S0','S1','S2','S3','S4'])
+      self.assertEqual(listener.processerrors,1)
+      self.assertTrue(all([w.is_alive() for w in listener.workers]))
+      self.assertEqual(listener.queue.depth(),0)
+    finally:
+      listener.stopWorkers()
+
+class MessageQueueTest(unittest.TestCase):
+  def test_batches(self):
+    queue = AMQ.MessageQueue()
+    for m in ['G1','G2','T1','G3','G4','G5']: queue.put(m)
+    frames,lane = queue.get(batch=2)
+    self.assertEqual(([m for m,received in frames],lane),(['T1'],1)) # by priority
+    frames,lane = queue.get(batch=2)
+    self.assertEqual([m for m,received in frames],['G1','G2'])
+    queue.done(lane)
+    frames,lane = queue.get(batch=8)
+    self.assertEqual([m for m,received in frames],['G3','G4','G5'])
+
+  def test_overflow(self):
+    queue = AMQ.MessageQueue(2,'drop-oldest',warninterval=3600)
+    for m in ['G1','G2','G3','T1']: queue.put(m)
+    self.assertEqual(queue.depths(),[0,1,2])
+    self.assertEqual((queue.dropped,queue.lanedropped),(1,[0,0,1]))
+    self.assertFalse(queue.put('G4',policy='drop-newest'))
+    self.assertEqual(queue.lanedropped,[0,0,2])
+    frames,lane = queue.get()
+    queue.done(lane)
+    self.assertEqual([m for m,received in queue.get(batch=8)[0]],['G2','G3'])
+
+class ListenerShardsTest(unittest.TestCase):
+  def test_shards_with_topics(self):
+    shards = AMQ.ListenerShards({'peaks':{'topics':['gmpeak']},'idle':{'topics':[]}},'default',workers=0)
+    self.assertEqual(sorted(shards.listeners),['peaks']) # no listener without topics
+    connected = []
+    for l in shards: l.connectToActiveMQ = lambda l=l: connected.append(l.name)
+    shards.connectToActiveMQ()
+    self.assertEqual(connected,[]) # nothing subscribed yet
+    shards.listener('gmpeak').SUBSCRIBES['gmpeak'] = '/topic/gmpeak'
+    shards.connectToActiveMQ()
+    self.assertEqual(connected,['peaks'])
+    self.assertEqual(shards.listener('events').name,'default') # created once a subscription falls to it
+    self.assertEqual([l.name for l in shards],['default','peaks'])
+
+if __name__=="__main__":
+  unittest.main()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+# station inventory loading and lookup.
+# run: python -m unittest discover -s tests
+
+import sys,os,shutil,tempfile,unittest
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)) # the ElViS modules
+import stations
+
+class InventoryTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir,'stations.cfg')
+    with open(self.path,'w') as f:
+      f.write('# net sta lat lon\nIS MMA 31.5 35.1\nLONGNET LONGCODE 32.0 34.9 extra\n')
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_long_codes(self):
+    inventory = stations.loadinventory(self.path)
+    self.assertEqual(list(inventory['net']),['IS','LONGNET'])
+    self.assertEqual(list(inventory['sta']),['MMA','LONGCODE'])
+    index = stations.StationIndex(inventory['net'],inventory['sta'])
+    self.assertEqual(index.get('LONGNET.LONGCODE.00.HHZ'),1)
+    self.assertEqual(list(index.lookup(['LONGNET','IS','IS'],['LONGCODE','MMA','LONGC'])),[1,0,-1])
+
+  def test_outdated_cache(self):
+    cachedir = os.path.join(self.dir,'cache')
+    self.assertEqual(list(stations.loadinventory(self.path,cachedir)['sta']),['MMA','LONGCODE'])
+    cache = [os.path.join(cachedir,n) for n in os.listdir(cachedir) if n.endswith('.npy')][0]
+    narrow = np.dtype([('net','|S2'),('sta','|S5'),('lat',float),('lon',float)])
+    np.save(cache,stations.readstations(self.path).astype(narrow)) # cached by an older version. codes truncated
+    self.assertEqual(list(stations.loadinventory(self.path,cachedir)['sta']),['MMA','LONGCODE'])
+    self.assertEqual(stations.loadinventory(self.path,cachedir).dtype,stations.STATIONtype)
+
+if __name__=="__main__":
+  unittest.main()
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+# TrigLog index loading and buildindex.
+# run: python -m unittest discover -s tests
+
+import sys,os,shutil,tempfile,unittest
+import numpy as np
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),os.pardir)) # the ElViS modules
+import amq2py as AMQ
+import triglog
+
+def trigger(sta='ABC',sec=100):
+  'a raw trigger frame'
+  t = np.zeros(1,AMQ.Triggerrawtype)
+  t['type'] = 'T'
+  t['net'] = 'IS'
+  t['sta'] = sta
+  t['sec'] = sec
+  return t.tostring()
+
+class TrigLogTest(unittest.TestCase):
+  def setUp(self):
+    self.dir = tempfile.mkdtemp()
+    self.path = os.path.join(self.dir,'triggers_20200101.trig')
+    self.frames = [trigger('S%d'%i,100+i) for i in range(4)]
+    self.frames.insert(2,'P'+'\0'*40) # a bad frame gets a skip entry
+    with open(self.path,'wb') as f:
+      for m in self.frames: f.write(AMQ._lengthfmt.pack(len(m))+m)
+
+  def tearDown(self):
+    shutil.rmtree(self.dir)
+
+  def test_no_index_file(self):
+    log = triglog.TrigLog(self.path)
+    self.assertEqual(list(log.query()['station']),['IS.S0','IS.S1','IS.S2','IS.S3'])
+    self.assertEqual(list(log.frames(log.query())),[m for m in self.frames if m[0]=='T'])
+    log.close()
+    self.assertFalse(os.path.exists(triglog.indexpath(self.path))) # readers don't write it
+
+  def test_growing_index(self):
+    index = triglog.buildindex(self.path)
+    self.assertEqual(len(index),5)
+    with open(triglog.indexpath(self.path),'ab') as f: f.write('\0'*7) # a partly written entry
+    with open(self.path,'r+b') as f: f.truncate(index['offset'][-1]+2) # the log is behind its index, mid frame
+    log = triglog.TrigLog(self.path)
+    self.assertEqual(list(log.query()['station']),['IS.S0','IS.S1','IS.S2'])
+    log.close()
+    self.assertEqual(os.path.getsize(triglog.indexpath(self.path)),index.nbytes+7)
+
+if __name__=="__main__":
+  unittest.main()
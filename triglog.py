@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#/**********************************************************************************
+#*    Copyright (C) by Ran Novitsky Nof                                            *
+#*                                                                                 *
+#*    This file is part of ElViS                                                   *
+#*                                                                                 *
+#*    ElViS is free software: you can redistribute it and/or modify                *
+#*    it under the terms of the GNU Lesser General Public License as published by  *
+#*    the Free Software Foundation, either version 3 of the License, or            *
+#*    (at your option) any later version.                                          *
+#*                                                                                 *
+#*    This program is distributed in the hope that it will be useful,              *
+#*    but WITHOUT ANY WARRANTY; without even the implied warranty of               *
+#*    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the                *
+#*    GNU Lesser General Public License for more details.                          *
+#*                                                                                 *
+#*    You should have received a copy of the GNU Lesser General Public License     *
+#*    along with this program.  If not, see <http://www.gnu.org/licenses/>.        *
+#***********************************************************************************/
+
+
+# indexed reader of the binary triggers log (log/triggers_YYYYMMDD.trig).
+# the log is a sequence of frames, each prefixed by its length as a big endian int32.
+# the index file (log name + '.idx') holds amq2py.TRIGINDEXtype entries, one per station per frame.
+# it is written by AMQListener as the log is written and can be (re)built here for old files (buildindex, --rebuild).
+# readers only read it, since the log and its index may be growing.
+
+import sys,os,mmap,datetime
+import argparse
+import numpy as np
+import amq2py as AMQ
+
+def indexpath(path):
+  'index file name of a triggers log'
+  return path+'.idx'
+
+def scan(mm,start=0):
+  '''index frames of a mapped log from offset start to its end.
+     returns the index and the offset after the last complete frame'''
+  index = []
+  offset = start
+  size = len(mm)
+  prefix = AMQ._lengthfmt.size
+  while offset+prefix<=size:
+    length = AMQ._lengthfmt.unpack_from(mm,offset)[0]
+    if length<=0 or offset+prefix+length>size: break # truncated or corrupted tail
+    try:
+      entries = AMQ.indexframe(buffer(mm,offset+prefix,length),offset)
+    except Exception:
+      entries = [] # keep going. a bad frame is not indexed
+    index.append(entries if len(entries) else AMQ.skipentry(offset,length)) # the skip entry keeps the index contiguous
+    offset += prefix+length
+  if not index: return np.zeros(0,AMQ.TRIGINDEXtype),offset
+  return np.concatenate(index),offset
+
+def buildindex(path):
+  'build (or rebuild) the index file of a triggers log. returns the index'
+  with open(path,'rb') as f:
+    if os.fstat(f.fileno()).st_size==0:
+      index = np.zeros(0,AMQ.TRIGINDEXtype)
+    else:
+      mm = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+      index = scan(mm)[0]
+      mm.close()
+  with open(indexpath(path),'wb') as f:
+    f.write(index.tostring())
+  return index
+
+class TrigLog(object):
+  '''Memory mapped, indexed triggers log.
+     the index is loaded from the index file and extended in memory by scanning frames past it,
+     or built in memory if the file is missing or not matching the log. the index file is not written,
+     the log may be written meanwhile (see buildindex). frames without entries are covered by skip entries
+     in the file (see amq2py.skipentry) and left out of index.'''
+  def __init__(self,path):
+    self.path = path
+    self._file = open(path,'rb')
+    size = os.fstat(self._file.fileno()).st_size
+    self.mm = mmap.mmap(self._file.fileno(),0,access=mmap.ACCESS_READ) if size else ''
+    index = self._loadindex()
+    self.index = index[index['type']!=''] # without skip entries
+    self._order = np.argsort(self.index['ts'],kind='mergesort') # entries by time
+    self._ts = self.index['ts'][self._order]
+
+  def _loadindex(self):
+    'index of the mapped log. entries of frames written after it was mapped are left out'
+    ipath = indexpath(self.path)
+    index = np.zeros(0,AMQ.TRIGINDEXtype)
+    if os.path.exists(ipath):
+      with open(ipath,'rb') as f: data = f.read()
+      index = np.frombuffer(data,AMQ.TRIGINDEXtype,len(data)//AMQ.TRIGINDEXtype.itemsize) # without a partly written last entry
+      if len(index) and index['offset'][0]!=0: # index does not start at the log start
+        index = np.zeros(0,AMQ.TRIGINDEXtype)
+    index = index[index['offset']+AMQ._lengthfmt.size+index['length']<=len(self.mm)]
+    end = int(index['offset'][-1]+AMQ._lengthfmt.size+index['length'][-1]) if len(index) else 0
+    if end<len(self.mm): # log has frames past the index
+      index = np.concatenate([index,scan(self.mm,end)[0]])
+    return index
+
+  def __len__(self):
+    return len(self.index)
+
+  def query(self,t0=None,t1=None,station=None,types=None):
+    '''index entries with t0<=ts<=t1 (seconds since epoch or datetime), of station (net.sta or a list)
+       and of frame types (e.g. 'T' or 'TP'). entries are in time order.'''
+    t0 = totimestamp(t0)
+    t1 = totimestamp(t1)
+    i0 = np.searchsorted(self._ts,t0,'left') if t0 is not None else 0
+    i1 = np.searchsorted(self._ts,t1,'right') if t1 is not None else len(self._ts)
+    entries = self.index[self._order[i0:i1]]
+    if station is not None:
+      entries = entries[np.in1d(entries['station'],np.atleast_1d(station))]
+    if types:
+      entries = entries[np.in1d(entries['type'],list(types))]
+    return entries
+
+  def frame(self,entry):
+    'raw frame of an index entry'
+    start = int(entry['offset'])+AMQ._lengthfmt.size
+    return self.mm[start:start+int(entry['length'])]
+
+  def frames(self,entries):
+    'raw frames of index entries. a frame is returned once even if it has several entries'
+    seen = set()
+    for e in entries:
+      if e['offset'] in seen: continue
+      seen.add(e['offset'])
+      yield self.frame(e)
+
+  def messages(self,*args,**kwargs):
+    'decoded messages matching a query. see query for arguments'
+    for m in self.frames(self.query(*args,**kwargs)):
+      yield AMQ.decode(m)
+
+  def close(self):
+    if self.mm: self.mm.close()
+    self._file.close()
+
+def totimestamp(t):
+  'seconds since epoch of a datetime, an ISO time string or a number'
+  if t is None or isinstance(t,(int,long,float)): return t
+  if isinstance(t,basestring):
+    try:
+      return float(t)
+    except ValueError:
+      t = datetime.datetime.strptime(t,'%Y-%m-%dT%H:%M:%S.%f' if '.' in t else '%Y-%m-%dT%H:%M:%S')
+  return (t-datetime.datetime(1970,1,1)).total_seconds()
+
+parser = argparse.ArgumentParser(description='Query ElViS binary triggers log files.')
+parser.add_argument('logs',nargs='+',help='triggers log files (log/triggers_YYYYMMDD.trig)')
+parser.add_argument('-s','--station',action='append',default=None,help='station (net.sta). may be repeated')
+parser.add_argument('-b','--begin',default=None,help='start time (YYYY-MM-DDTHH:MM:SS[.ffffff] UTC or seconds since epoch)')
+parser.add_argument('-e','--end',default=None,help='end time (YYYY-MM-DDTHH:MM:SS[.ffffff] UTC or seconds since epoch)')
+parser.add_argument('-t','--types',default=None,help='frame types to show (T, P or TP)')
+parser.add_argument('--rebuild',default=False,action='store_true',help='rebuild the index files first')
+
+if __name__=="__main__":
+  args = parser.parse_args(sys.argv[1:])
+  for path in args.logs:
+    if args.rebuild: buildindex(path)
+    log = TrigLog(path)
+    for m in log.messages(args.begin,args.end,args.station,args.types):
+      print m
+    log.close()